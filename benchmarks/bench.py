@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the parts of ev that get slow as a vault grows. Each run makes a
+synthetic vault (see synth.py) for each band count under a fake home directory,
+puts the stand-in hdiutil (bin/hdiutil) first on the PATH, and times:
+
+    scan            full scan of the LOCAL bands (load_bundle_bands(False))
+    manifest-cold   load_bundle_bands() with no manifest, i.e. scan and save it
+    manifest-warm   load_bundle_bands() from the manifest file, nothing in memory
+    manifest-memo   load_bundle_bands() again in the same process
+    analyze-cold    analyzeBands() on a diverged vault, no manifests
+    analyze-warm    analyzeBands() on a diverged vault, manifests on disk
+    hdiinfo-cold    MountedVolume() with a busy hdiutil info fixture, nothing cached
+    hdiinfo-cached  MountedVolume() again, inside INFO_TTL
+    backup          backup() after fraction of the LOCAL bands were written
+    restore         restore() after fraction of the Dropbox bands were written
+    analyze-insync  analyzeBands() right after a backup (the Merkle fast path)
+    objstore-cold   load_bundle_bands() of the vault in an objdir:// object store
+                    (see ev.objectstore) with no band index, i.e. a Stat per band
+    objstore-warm   the same with the band index, i.e. just the paged listing
+
+and, once per run, plist (C_EVPlist load, change, write). It runs on a plain
+Linux box; nothing in it needs macOS.
+
+The results go to a JSON file. Give it --baseline with an earlier results file
+(e.g. one saved with --save-baseline on the same machine) and it compares the best
+time of each benchmark, and exits with 1 if any got slower by more than the
+tolerance:
+
+    python3 benchmarks/bench.py --bands 1000,100000 --save-baseline baseline.json
+    ... change something ...
+    python3 benchmarks/bench.py --bands 1000,100000 --baseline baseline.json
+
+The default band counts are 1k, 100k and 1M. Making the 1M vault takes a few
+minutes and a few GB of inodes, so the trees are kept in --work and reused by
+later runs with the same settings. The object store has one empty object per band
+(only the listing is timed), and every request to it takes --object-latency.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from synth import C_SynthSpec, MakeHome, Diverge, Settle, Forget, BASE_MTIME, PATTERNS
+
+VAULT = 'bench'
+DEFAULT_BANDS = (1000, 100000, 1000000)
+TOLERANCE = 0.25
+
+# Differences smaller than this are noise, however big the ratio
+NOISE_FLOOR = 0.005
+
+class C_Timing:
+    """The runs of one benchmark.
+
+    runs - Seconds each run took
+    bands - Bands the benchmark looked at, for bands/sec
+    moved - Bands it transferred, if it's a transfer
+    """
+    def __init__(self, runs, bands=None, moved=None):
+        self.runs = runs
+        self.bands = bands
+        self.moved = moved
+
+    def ToDict(self):
+        best = min(self.runs)
+        result = {'min': best, 'median': statistics.median(self.runs), 'runs': self.runs}
+        if self.bands:
+            result['bands'] = self.bands
+            result['bands_per_sec'] = self.bands / best if best else None
+        if self.moved is not None:
+            result['moved'] = self.moved
+        return result
+
+def measure(fn, repeat, setup=None):
+    runs = []
+    for i in range(repeat):
+        if setup is not None:
+            setup(i)
+        started = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - started)
+    return runs
+
+def prepare_home(home, fixture):
+    """Point ev at home and the stand-in hdiutil, and keep snapshots and watchers
+    out of the timings"""
+    from plistlib import dump
+
+    os.environ['HOME'] = home
+    os.environ['PATH'] = os.path.join(HERE, 'bin') + os.pathsep + os.environ.get('PATH', '')
+    os.environ['EV_BENCH_HDIINFO'] = fixture
+
+    os.makedirs(os.path.join(home, 'vaults'), exist_ok=True)
+    with open(os.path.join(home, 'vaults', '.evdefaults.plist'), 'wb') as f:
+        dump({'SnapshotBeforeRestore': False, 'WatchBands': False}, f)
+
+def band_numbers(bands):
+    return sorted(int(name, 16) for name in os.listdir(bands) if not name.startswith('.'))
+
+def ready_for_backup(vault):
+    """Make the plist say this computer had it mounted RW and dismounted it"""
+    import kenl380.pylib as pylib
+    from ev.cryptvault import C_EVPlist
+
+    plist = C_EVPlist(vault)
+    plist.SetMounted(False)
+    plist.SetNeedsBackup(True)
+    plist.SetComputerName(pylib.COMPUTER)
+    plist.WritePlist()
+
+def object_store(home, spec, latency):
+    """Returns the C_ObjectVaultStore of the vault in home/objects, making it if
+    it isn't there for this spec. Each band is an empty object with the band's mtime."""
+    from ev.cryptvault import C_EVDefaults, C_ObjectVaultStore
+    from ev.objectstore import C_DirectoryBackend, META_MTIME
+
+    root = os.path.join(home, 'objects')
+    stamp = os.path.join(root, '.synth.json')
+
+    try:
+        with open(stamp, 'r') as f:
+            made = json.load(f) == spec.ToDict()
+    except (OSError, ValueError):
+        made = False
+
+    if not made:
+        import shutil
+        from ev.bandscan import ScanBands
+
+        shutil.rmtree(root, ignore_errors=True)
+        writer = C_DirectoryBackend(root)
+        remote = C_EVDefaults().RemoteStorePath()
+        for entry in ScanBands(os.path.join(remote, VAULT, VAULT + '.sparsebundle', 'bands')):
+            writer.Write('%s/%s.sparsebundle/bands/%s' % (VAULT, VAULT, entry.name), b'',
+                         {META_MTIME: str(entry.mtime_ns)})
+        with open(stamp, 'w') as f:
+            json.dump(spec.ToDict(), f)
+
+    defaults = C_EVDefaults()
+    defaults.ObjectStore['latency'] = latency
+    url = 'objdir://' + root
+
+    # A new backend for this latency, not the one from an earlier band count
+    from ev import objectstore
+    objectstore._backends.pop(url, None)
+    objectstore.OpenBackend(url, defaults.ObjectStore)
+
+    return C_ObjectVaultStore(url, VAULT)
+
+def bench_bands(home, spec, repeat, only, latency=0.0):
+    """Run the band count benchmarks on the vault in home. Returns {name: C_Timing}."""
+    from ev import manifest
+    from ev import hdiinfo2
+    from ev.cryptvault import C_EncryptedVault
+
+    results = {}
+    n = spec.bands
+
+    def run(name, fn, setup=None, bands=n, moved=None):
+        if only and name not in only:
+            return
+        results[name] = C_Timing(measure(fn, repeat, setup), bands, moved)
+        print('  %-16s %9.4fs  (best of %d)' % (name, min(results[name].runs), repeat), flush=True)
+
+    encvlt = C_EncryptedVault(VAULT)
+    local, remote = encvlt.local, encvlt.remote
+
+    def no_manifests(i=0):
+        local.getManifest().Invalidate()
+        remote.getManifest().Invalidate()
+
+    run('scan', lambda: local.load_bundle_bands(False))
+    run('manifest-cold', local.load_bundle_bands, lambda i: local.getManifest().Invalidate())
+    run('manifest-warm', local.load_bundle_bands, lambda i: manifest._memo.clear())
+    run('manifest-memo', local.load_bundle_bands)
+
+    run('analyze-cold', lambda: C_EncryptedVault(VAULT).analyzeBands(), no_manifests, 2 * n)
+    run('analyze-warm', lambda: C_EncryptedVault(VAULT).analyzeBands(), lambda i: manifest._memo.clear(), 2 * n)
+
+    os.environ['EV_BENCH_HDIINFO'] = 'busy'
+    run('hdiinfo-cold', lambda: hdiinfo2.MountedVolume(local.getBundlePath()), lambda i: hdiinfo2.Invalidate(), None)
+    run('hdiinfo-cached', lambda: hdiinfo2.MountedVolume(local.getBundlePath()), None, None)
+    hdiinfo2.Invalidate()
+
+    rng = random.Random(spec.seed)
+    count = int(n * spec.fraction)
+    tree_changed = False
+
+    def diverge(kind, i):
+        # A new mtime each run, so every run has the same amount of work to do
+        numbers = band_numbers(local.getBands())
+        Diverge(local.getBands(), remote.getBands(), numbers, kind, spec.fraction, spec, rng,
+                BASE_MTIME + 7200 * (i + 2 + (repeat if kind == 'older' else 0)))
+
+    if not only or 'backup' in only or 'analyze-insync' in only:
+        tree_changed = True
+        # Start from a vault that's in sync, then diverge it before each backup
+        ready_for_backup(VAULT)
+        C_EncryptedVault(VAULT).backup()
+        run('backup', lambda: C_EncryptedVault(VAULT).backup(),
+            lambda i: (diverge('newer', i), ready_for_backup(VAULT)), n, count)
+        run('analyze-insync', lambda: C_EncryptedVault(VAULT).analyzeBands(),
+            lambda i: Settle(local.getBands(), remote.getBands()), 2 * n)
+
+    if not only or 'restore' in only:
+        tree_changed = True
+        run('restore', lambda: C_EncryptedVault(VAULT).restore(), lambda i: diverge('older', i), n, count)
+
+    if not only or only & {'objstore-cold', 'objstore-warm'}:
+        store = object_store(home, spec, latency)
+        run('objstore-cold', store.load_bundle_bands, lambda i: store.getManifest().Invalidate())
+        run('objstore-warm', store.load_bundle_bands)
+
+    if tree_changed:
+        Forget(home, VAULT)
+
+    return results
+
+def bench_plist(repeat, ops=200):
+    from ev.cryptvault import C_EVPlist
+
+    def cycle():
+        for i in range(ops):
+            plist = C_EVPlist(VAULT)
+            plist.SetNeedsBackup(not plist.NeedsBackup())
+            plist.WritePlist()
+
+    timing = C_Timing(measure(cycle, repeat))
+    print('  %-16s %9.4fs  (%d load/write cycles, best of %d)' % ('plist', min(timing.runs), ops, repeat))
+    return {'plist': timing}
+
+def Compare(results, baseline, tolerance=TOLERANCE):
+    """Returns the list of (group, name, baseline seconds, seconds, ratio, status) for
+    the benchmarks in both results and baseline. status is 'slower', 'faster' or ok."""
+    rows = []
+
+    for group, benches in sorted(results['results'].items()):
+        for name, timing in sorted(benches.items()):
+            base = baseline.get('results', {}).get(group, {}).get(name)
+            if base is None:
+                continue
+            then, now = base['min'], timing['min']
+            ratio = now / then if then else float('inf')
+            status = 'ok'
+            if abs(now - then) >= NOISE_FLOOR:
+                if ratio > 1 + tolerance:
+                    status = 'slower'
+                elif ratio < 1 / (1 + tolerance):
+                    status = 'faster'
+            rows.append((group, name, then, now, ratio, status))
+
+    return rows
+
+def main():
+    import argparse
+    import tempfile
+    import platform
+
+    parser = argparse.ArgumentParser(description='Time the ev subsystems on synthetic vaults')
+    parser.add_argument('--bands', default=','.join(str(n) for n in DEFAULT_BANDS),
+                        help='comma separated band counts (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', default='', help='comma separated benchmark names')
+    parser.add_argument('--work', default=os.path.join(tempfile.gettempdir(), 'ev-bench'),
+                        help='where the synthetic vaults live (default %(default)s)')
+    parser.add_argument('--size', type=int, default=8 << 20, help='apparent band size in bytes')
+    parser.add_argument('--data', type=int, default=4096, help='bytes written in each band')
+    parser.add_argument('--sparsity', type=float, default=0.0, help='fraction of band numbers missing')
+    parser.add_argument('--pattern', default='mixed', choices=PATTERNS)
+    parser.add_argument('--fraction', type=float, default=0.01, help='fraction of bands diverged')
+    parser.add_argument('--object-latency', type=float, default=0.001,
+                        help='seconds each object store request takes (default %(default)s)')
+    parser.add_argument('--out', default='bench-results.json')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--save-baseline', help='also write the results here')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    only = set(name for name in args.only.split(',') if name)
+    counts = [int(n) for n in args.bands.split(',') if n]
+
+    output = {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                       'machine': platform.machine(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'repeat': args.repeat},
+              'spec': {}, 'results': {}}
+
+    for n in counts:
+        spec = C_SynthSpec(n, args.size, args.data, args.sparsity, args.pattern, args.fraction)
+        home = os.path.join(args.work, str(n))
+
+        prepare_home(home, 'empty')
+
+        print('%d bands: making the vault...' % n, flush=True)
+        started = time.time()
+        diverged = MakeHome(home, VAULT, spec)
+        print('  ready in %.1fs, diverged: %s' % (time.time() - started, diverged or 'nothing'), flush=True)
+
+        output['spec'][str(n)] = dict(spec.ToDict(), diverged=diverged)
+        output['results'][str(n)] = {k: v.ToDict() for k, v in bench_bands(home, spec, args.repeat, only, args.object_latency).items()}
+
+    if not only or 'plist' in only:
+        print('common:')
+        output['results']['common'] = {k: v.ToDict() for k, v in bench_plist(args.repeat).items()}
+
+    for path in filter(None, (args.out, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('wrote %s' % path)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+
+    rows = Compare(output, baseline, args.tolerance)
+
+    print('\n%-8s %-16s %10s %10s %7s' % ('group', 'benchmark', 'baseline', 'now', 'ratio'))
+    for group, name, then, now, ratio, status in rows:
+        print('%-8s %-16s %10.4f %10.4f %6.2fx %s' % (group, name, then, now, ratio,
+                                                      '' if status == 'ok' else status.upper()))
+
+    slower = [row for row in rows if row[5] == 'slower']
+    print('%d benchmark(s) compared, %d slower than the baseline by more than %d%%' %
+          (len(rows), len(slower), args.tolerance * 100))
+
+    return 1 if slower else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for how long ev takes to start, i.e. what every command pays before it
+does anything. Each one runs in a fresh interpreter, best of --repeat, minus what a
+bare 'python3 -c pass' takes on the same machine:
+
+    import-ev           import ev (the package alone)
+    import-cli          import ev.ev (the command line)
+    import-vault        import ev.cryptvault (what the verbs need)
+    cli-bad-verb        ev.ev with a verb that doesn't exist, which is turned away
+                        by the verb registry before anything is built (see ev.verbs)
+
+The results go to a JSON file laid out like bench.py's, so --baseline works the
+same way (see bench.Compare()). --budget-ms is a hard limit on import-cli, for
+CI, where a baseline from another machine wouldn't mean much:
+
+    python3 benchmarks/startup.py --budget-ms 50
+
+Use 'python3 -X importtime -c "import ev.ev"' to see where the time went.
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from bench import C_Timing, Compare, TOLERANCE
+
+BENCHMARKS = {
+    'import-ev': ['-c', 'import ev'],
+    'import-cli': ['-c', 'import ev.ev'],
+    'import-vault': ['-c', 'import ev.cryptvault'],
+    'cli-bad-verb': ['-m', 'ev.ev', 'nosuchvault', 'nosuchverb', '--no-daemon'],
+}
+
+def run_python(argv, repeat, home):
+    """Returns the seconds each of repeat runs of python3 argv took"""
+    env = dict(os.environ, PYTHONPATH=ROOT, HOME=home)
+    runs = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable] + argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        runs.append(time.perf_counter() - started)
+    return runs
+
+def main():
+    import argparse
+    import tempfile
+    import platform
+
+    parser = argparse.ArgumentParser(description='Time how long ev takes to start')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--out', default='startup-results.json')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--save-baseline', help='also write the results here')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--budget-ms', type=float, help='fail if import-cli takes longer than this')
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='ev-startup-')
+
+    # Warm up the bytecode cache, so the first run isn't compiling everything
+    run_python(['-c', 'import ev.cryptvault, ev.ev'], 1, home)
+
+    interpreter = min(run_python(['-c', 'pass'], args.repeat, home))
+    print('  %-16s %9.4fs  (subtracted from the rest)' % ('python', interpreter))
+
+    results = {}
+    for name, argv in BENCHMARKS.items():
+        runs = [max(0.0, run - interpreter) for run in run_python(argv, args.repeat, home)]
+        results[name] = C_Timing(runs)
+        print('  %-16s %9.4fs  (best of %d)' % (name, min(runs), args.repeat), flush=True)
+
+    output = {'meta': {'python': platform.python_version(), 'platform': platform.platform(),
+                       'machine': platform.machine(), 'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'repeat': args.repeat, 'interpreter': interpreter},
+              'results': {'startup': {k: v.ToDict() for k, v in results.items()}}}
+
+    for path in filter(None, (args.out, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+        print('wrote %s' % path)
+
+    rc = 0
+
+    if args.budget_ms is not None:
+        took = min(results['import-cli'].runs) * 1000
+        if took > args.budget_ms:
+            print('import-cli took %.1fms, over the budget of %.1fms' % (took, args.budget_ms))
+            rc = 1
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        rows = Compare(output, baseline, args.tolerance)
+
+        print('\n%-16s %10s %10s %7s' % ('benchmark', 'baseline', 'now', 'ratio'))
+        for group, name, then, now, ratio, status in rows:
+            print('%-16s %10.4f %10.4f %6.2fx %s' % (name, then, now, ratio, '' if status == 'ok' else status.upper()))
+
+        slower = [row for row in rows if row[5] == 'slower']
+        print('%d benchmark(s) compared, %d slower than the baseline by more than %d%%' %
+              (len(rows), len(slower), args.tolerance * 100))
+        if slower:
+            rc = 1
+
+    return rc
+
+if __name__ == "__main__":
+    sys.exit(main())
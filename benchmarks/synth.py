@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+This module makes synthetic vaults for the benchmarks: a LOCAL and a Dropbox
+sparsebundle of the same vault, laid out the way C_EVDefaults expects them under a
+fake home directory, with the bands diverged in a chosen pattern.
+
+The bands are sparse files, so a million of them with a realistic 8MB size don't
+need 8TB. Only the first data bytes of each band are written, so a copy still has
+something to move.
+
+Everything here happened "a while ago": the bands directories get the mtime of
+their last change, in the past. Otherwise the band manifest (see ev.manifest) would
+see a directory changed in the last couple of seconds, not trust itself, and every
+benchmark would time a full scan.
+
+Divergence patterns (fraction says how many of the bands are affected):
+
+    none            LOCAL and Dropbox are the same
+    newer           LOCAL bands were written since the last backup
+    older           Dropbox bands were written by another computer
+    localonly       LOCAL bands that Dropbox doesn't have
+    remoteonly      Dropbox bands that LOCAL doesn't have
+    mixed           a bit of each of the above
+"""
+
+import os
+import json
+import random
+
+BASE_MTIME = 1_600_000_000      # seconds; when the "last backup" happened
+PATTERNS = ('none', 'newer', 'older', 'localonly', 'remoteonly', 'mixed')
+
+class C_SynthSpec:
+    """What to generate.
+
+    bands - How many bands each store has (before divergence)
+    size - Apparent size of each band in bytes (8MB is what hdiutil uses)
+    data - Bytes actually written at the start of each band
+    sparsity - Fraction of the band numbers that are missing, i.e. holes in the image
+    pattern - Divergence pattern (see PATTERNS)
+    fraction - Fraction of the bands the divergence touches
+    seed - For the random choices, so the same spec makes the same tree
+    """
+    def __init__(self, bands, size=8 << 20, data=4096, sparsity=0.0, pattern='mixed',
+                 fraction=0.01, seed=380):
+        if pattern not in PATTERNS:
+            raise ValueError("'%s' isn't a divergence pattern, try one of %s" % (pattern, ', '.join(PATTERNS)))
+        if not 0.0 <= sparsity < 1.0:
+            raise ValueError("sparsity has to be at least 0 and less than 1")
+
+        self.bands = int(bands)
+        self.size = int(size)
+        self.data = min(int(data), self.size)
+        self.sparsity = float(sparsity)
+        self.pattern = pattern
+        self.fraction = float(fraction)
+        self.seed = seed
+
+    def ToDict(self):
+        return dict(self.__dict__)
+
+def bundle_path(root, vault):
+    return os.path.join(root, vault, vault + '.sparsebundle')
+
+def write_band(path, number, size, data, mtime):
+    with open(path, 'wb') as f:
+        if data:
+            f.write(number.to_bytes(8, 'little') * (data // 8) + b'\0' * (data % 8))
+        f.truncate(size)
+    os.utime(path, (mtime, mtime))
+
+def make_bundle(root, vault, numbers, spec):
+    """Make one sparsebundle with the given band numbers, all at BASE_MTIME"""
+    bundle = bundle_path(root, vault)
+    bands = os.path.join(bundle, 'bands')
+    os.makedirs(bands, exist_ok=True)
+
+    with open(os.path.join(bundle, 'Info.plist'), 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<plist version="1.0"><dict>'
+                '<key>band-size</key><integer>%d</integer>'
+                '<key>diskimage-bundle-type</key><string>com.apple.diskimage.sparsebundle</string>'
+                '</dict></plist>\n' % spec.size)
+    open(os.path.join(bundle, 'token'), 'w').close()
+
+    for number in numbers:
+        write_band(os.path.join(bands, '%x' % number), number, spec.size, spec.data, BASE_MTIME)
+
+    return bands
+
+def Diverge(local, remote, numbers, pattern, fraction, spec, rng, when=None):
+    """Apply a divergence pattern to the bands directories local and remote, which
+    both have the bands in numbers. when is the mtime of the bands that get written
+    (it has to be after BASE_MTIME, and different every time it's used on the same
+    tree, or the diff can't tell). Returns {kind: count}."""
+    when = when or BASE_MTIME + 3600
+    count = int(len(numbers) * fraction)
+    if pattern == 'none' or count == 0:
+        return {}
+
+    kinds = ['newer', 'older', 'localonly', 'remoteonly'] if pattern == 'mixed' else [pattern]
+    chosen = rng.sample(numbers, min(len(numbers), count))
+    top = max(numbers) + 1 if numbers else 0
+    done = {}
+    touched = set()
+
+    for i, kind in enumerate(kinds):
+        share = chosen[i::len(kinds)]
+        if kind == 'newer':
+            for n in share:
+                write_band(os.path.join(local, '%x' % n), n ^ 0xff, spec.size, spec.data, when)
+        elif kind == 'older':
+            for n in share:
+                write_band(os.path.join(remote, '%x' % n), n ^ 0xff, spec.size, spec.data, when)
+        elif kind == 'localonly':
+            # New bands past the end, like a vault that grew
+            share = range(top, top + len(share))
+            top += len(share)
+            for n in share:
+                write_band(os.path.join(local, '%x' % n), n, spec.size, spec.data, when)
+        elif kind == 'remoteonly':
+            for n in share:
+                os.unlink(os.path.join(local, '%x' % n))
+        done[kind] = len(share)
+        touched.add(remote if kind == 'older' else local)
+
+    Settle(*touched, when=when)
+
+    return done
+
+def Settle(*dirs, when=None):
+    """Move the mtime of dirs into the past (to when, or 10 seconds ago), if it's
+    recent enough that the band manifest wouldn't trust it"""
+    import time
+
+    for path in dirs:
+        st = os.stat(path)
+        if when is not None:
+            os.utime(path, (when, when))
+        elif time.time() - st.st_mtime < 10:
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns - 10 * 1000000000))
+
+def MakeHome(home, vault, spec):
+    """Make a fake home directory with ~/vaults/VAULT and ~/Dropbox/system/vaults/VAULT,
+    diverged as spec says. If home already has the same spec, it's reused as is
+    (making a million bands takes a while). Returns the divergence counts."""
+    import shutil
+
+    stamp = os.path.join(home, '.synth-%s.json' % vault)
+    try:
+        with open(stamp, 'r') as f:
+            made = json.load(f)
+        if made['spec'] == spec.ToDict():
+            return made['diverged']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    for root in ('vaults', 'Dropbox/system/vaults'):
+        shutil.rmtree(os.path.join(home, root, vault), ignore_errors=True)
+    try:
+        os.unlink(os.path.join(home, 'vaults', vault + '.plist'))
+    except FileNotFoundError:
+        pass
+
+    rng = random.Random(spec.seed)
+
+    # With sparsity s, the band numbers run over bands / (1 - s) and skip the holes
+    span = int(spec.bands / (1.0 - spec.sparsity)) if spec.bands else 0
+    numbers = sorted(rng.sample(range(span), spec.bands)) if spec.sparsity else list(range(spec.bands))
+
+    local = make_bundle(os.path.join(home, 'vaults'), vault, numbers, spec)
+    remote = make_bundle(os.path.join(home, 'Dropbox/system/vaults'), vault, numbers, spec)
+
+    Settle(local, remote, when=BASE_MTIME)
+    diverged = Diverge(local, remote, numbers, spec.pattern, spec.fraction, spec, rng)
+
+    with open(stamp, 'w') as f:
+        json.dump({'spec': spec.ToDict(), 'diverged': diverged}, f)
+
+    return diverged
+
+def Forget(home, vault):
+    """Forget that home was made, e.g. because a benchmark changed its bands"""
+    try:
+        os.unlink(os.path.join(home, '.synth-%s.json' % vault))
+    except FileNotFoundError:
+        pass
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Make a synthetic vault under a fake home directory')
+    parser.add_argument('home')
+    parser.add_argument('--vault', default='bench')
+    parser.add_argument('--bands', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=8 << 20)
+    parser.add_argument('--data', type=int, default=4096)
+    parser.add_argument('--sparsity', type=float, default=0.0)
+    parser.add_argument('--pattern', default='mixed', choices=PATTERNS)
+    parser.add_argument('--fraction', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=380)
+    args = parser.parse_args()
+
+    print(MakeHome(args.home, args.vault, C_SynthSpec(args.bands, args.size, args.data, args.sparsity,
+                                                      args.pattern, args.fraction, args.seed)))
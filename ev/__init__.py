@@ -18,6 +18,19 @@ limitations under the License.
 __copyright__ = """Copyright 2018 Ken Lowrie"""
 __license__ = """Apache 2.0"""
 
-from . import ev
-from . import cryptvault
-from . import hdiinfo2
+# The submodules are loaded the first time somebody asks for one (PEP 562), so
+# 'import ev' doesn't drag in everything, and the command line only pays for what
+# the verb it runs uses.
+_submodules = {'ev', 'cryptvault', 'hdiinfo2', 'verbs', 'spans', 'metrics', 'runner',
+               'asyncvault', 'daemon', 'batch', 'bandscan', 'bandtable', 'bandsync',
+               'banddelta', 'journal', 'manifest', 'merkle', 'scheduler', 'snapshot',
+               'fanout', 'versionstore', 'verify', 'watcher', 'objectstore', 'objectsync', 'plan'}
+
+def __getattr__(name):
+    if name in _submodules:
+        import importlib
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(set(globals()) | _submodules)
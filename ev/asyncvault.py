@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+This module is an async front end to C_EncryptedVault, so one process (a menu bar
+app, a script) can run several vault operations at the same time and cancel them:
+
+    results = await asyncio.gather(C_AsyncVault('cv').backup(),
+                                   C_AsyncVault('taxes').backup())
+
+The verbs themselves are still synchronous, so each one runs in a worker thread,
+but the commands they run (hdiutil, rsync) run as asyncio subprocesses in the
+caller's event loop (see ev.runner). Cancelling the task stops the command that's
+running and keeps the verb from starting another one; the verb then fails with a
+VaultError, same as if the command had failed. The band sync engine in between is
+journaled, so a cancelled backup or restore picks up where it left off next time.
+
+Operations that change a vault (see ev.verbs) take turns per
+vault; ones that only look don't wait for anything.
+"""
+
+import asyncio
+
+_locks = {}
+
+def _lock(vault):
+    return _locks.setdefault(vault, asyncio.Lock())
+
+class C_AsyncVault:
+    """Async version of C_EncryptedVault.
+
+    vaultname - Name of the vault
+    message - A function that is called with a string to print status messages
+    records - Optional function that is called with a dictionary for each record,
+              including the progress events of hdiutil and rsync
+    timeout - Seconds each command gets, None for the CommandTimeout in C_EVDefaults
+    volumes - Optional mount points from ev.cryptvault.LocalVolumes(), see RunVaults()
+    """
+    def __init__(self, vaultname, message=print, records=None, timeout=None, volumes=None):
+        self.vaultname = vaultname
+        self.msgout = message
+        self.recordout = records
+        self.timeout = timeout
+        self.volumes = volumes
+
+    async def Run(self, verb, *args):
+        """Run verb with args and return what it returns. Raises VaultError if the
+        verb did, and CancelledError if the task was cancelled."""
+        from ev.cryptvault import C_EncryptedVault, C_EVDefaults, VaultError
+        from ev.runner import C_CommandRunner
+        from ev.verbs import Lookup
+
+        verb = verb.lower()
+        spec = Lookup(verb)
+        if spec is None:
+            raise VaultError(-1, "there's no verb named '%s'" % verb)
+        problem = spec.CheckArgs(args)
+        if problem is not None:
+            raise VaultError(-1, problem)
+
+        loop = asyncio.get_running_loop()
+
+        records = None
+        if self.recordout is not None:
+            records = lambda record: loop.call_soon_threadsafe(self.recordout, record)
+        message = lambda msg: loop.call_soon_threadsafe(self.msgout, msg)
+
+        def prepare():
+            encvlt = C_EncryptedVault(self.vaultname, message, records, needs=spec.needs, volumes=self.volumes)
+            if not encvlt.valid:
+                raise VaultError(4, "the vault %s isn't valid" % self.vaultname)
+
+            timeout = self.timeout if self.timeout is not None else C_EVDefaults().CommandTimeout
+            runnerrecords = None
+            if records is not None:
+                runnerrecords = lambda event: records(dict(event, vault=self.vaultname))
+            encvlt.runner = C_CommandRunner(message, runnerrecords, loop, timeout)
+            return encvlt
+
+        async def run():
+            encvlt = await asyncio.to_thread(prepare)
+            work = asyncio.ensure_future(asyncio.to_thread(encvlt.lookup(verb), *args))
+            try:
+                return await asyncio.shield(work)
+            except asyncio.CancelledError:
+                # Stop the command, then let the verb unwind before giving up
+                encvlt.runner.Cancel()
+                try:
+                    await work
+                except Exception:
+                    pass
+                raise
+
+        if spec.exclusive:
+            async with _lock(self.vaultname):
+                return await run()
+
+        return await run()
+
+    async def mount(self, ReadOnly=False):
+        return await self.Run('mount', ReadOnly)
+
+    async def dismount(self):
+        return await self.Run('dismount')
+
+    async def backup(self):
+        return await self.Run('backup')
+
+    async def restore(self, version=None):
+        return await self.Run('restore', version)
+
+    async def about(self):
+        return await self.Run('about')
+
+async def RunVaults(vaults, verb, *args, message=print, records=None):
+    """Run verb on each of vaults at the same time. Returns a list with what each
+    one returned, or the exception it raised, in the order of vaults. Whether they're
+    mounted is looked up once for all of them."""
+    from ev.cryptvault import LocalVolumes
+
+    volumes = await asyncio.to_thread(LocalVolumes, vaults)
+
+    return await asyncio.gather(*[C_AsyncVault(vault, message, records, volumes=volumes).Run(verb, *args)
+                                  for vault in vaults],
+                                return_exceptions=True)
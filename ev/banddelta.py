@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+This module does block-level delta transfers of a single band. When hdiutil changes
+a band, it usually only rewrites a few 4K blocks of the 8MB file, so instead of
+copying the whole band, we find the blocks that changed and only write those.
+
+For every destination band we keep a signature in a side file: a weak checksum
+(adler32) and a strong hash (blake2b) for each block, plus the size, mtime and
+inode of the band it describes, so a stale signature is never used. To send a band:
+
+1. Load the signature of the destination band (or build it, if it's missing/stale)
+2. Read the source band a block at a time. A block is unchanged only if both its
+   weak checksum and its strong hash match; anything else is a changed block.
+3. Clone the destination band to a temp file (copy_file_range() makes this a
+   reflink on file systems that can), write just the changed blocks into it, fsync,
+   and rename it over the band. The signature is updated to match.
+
+hdiutil never moves data around inside a band, so blocks are only compared at the
+same offset; there's no rolling search for blocks that moved like rsync does.
+"""
+
+import os
+import struct
+from zlib import adler32
+from hashlib import blake2b
+
+BLOCK_SIZE = 4096
+STRONG_SIZE = 16
+
+SIG_MAGIC = b'EVSG'
+SIG_VERSION = 1
+
+_header = struct.Struct('<4sIIqqQ')     # magic, version, block size, size, mtime_ns, ino
+_block = struct.Struct('<I%ds' % STRONG_SIZE)
+
+def BlockSignature(block):
+    """Returns the (weak, strong) signature of a block of data."""
+    return adler32(block), blake2b(block, digest_size=STRONG_SIZE).digest()
+
+class C_BandSignature:
+    """The block signatures of one band, and the stat values of the band they were
+    computed from."""
+
+    def __init__(self, size, mtime_ns, ino, blocks):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.ino = ino
+        self.blocks = blocks
+
+    def Matches(self, st):
+        """Returns True if this signature describes the file that st is the stat of"""
+        return (self.size, self.mtime_ns, self.ino) == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    @classmethod
+    def FromFile(cls, path):
+        """Compute the signature of a band by reading it"""
+        blocks = []
+
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                blocks.append(BlockSignature(block))
+
+        return cls(st.st_size, st.st_mtime_ns, st.st_ino, blocks)
+
+    @classmethod
+    def Load(cls, path):
+        """Load a signature side file. Returns None if it's missing or no good."""
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        try:
+            magic, version, blocksize, size, mtime_ns, ino = _header.unpack_from(data)
+        except struct.error:
+            return None
+
+        if magic != SIG_MAGIC or version != SIG_VERSION or blocksize != BLOCK_SIZE:
+            return None
+
+        if len(data) != _header.size + _block.size * ((size + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            return None
+
+        return cls(size, mtime_ns, ino, list(_block.iter_unpack(data[_header.size:])))
+
+    def Save(self, path):
+        """Write the signature side file (temp file and rename)"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_header.pack(SIG_MAGIC, SIG_VERSION, BLOCK_SIZE, self.size, self.mtime_ns, self.ino))
+            f.write(b''.join(_block.pack(*b) for b in self.blocks))
+
+        os.replace(tmp, path)
+
+def DeltaCommitFile(srcpath, dstpath, sigpath, throttle=None):
+    """Bring the band at dstpath up to date with srcpath by writing only the blocks
+    that differ (see the module docstring). sigpath is the signature side file for
+    dstpath. The destination must already exist. throttle is passed along to the
+    copy code, and called before each changed block is written (see ev.scheduler).
+
+    Returns: (written, total) - bytes actually written, and the size of the band"""
+
+    from ev.bandsync import TempPath, CopyFileData
+
+    srcst = os.stat(srcpath)
+    dstst = os.stat(dstpath)
+
+    signature = C_BandSignature.Load(sigpath)
+    if signature is None or not signature.Matches(dstst):
+        signature = C_BandSignature.FromFile(dstpath)
+
+    old = signature.blocks
+    blocks = []
+    changed = []
+
+    with open(srcpath, 'rb') as f:
+        offset = 0
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+
+            index = offset // BLOCK_SIZE
+
+            # The new signature needs the strong hash of every block anyway
+            sig = BlockSignature(block)
+
+            if index >= len(old) or old[index] != sig:
+                changed.append((offset, block))
+
+            blocks.append(sig)
+            offset += len(block)
+
+    tmppath = TempPath(dstpath)
+
+    written = 0
+
+    try:
+        with open(dstpath, 'rb') as fold, open(tmppath, 'wb') as fnew:
+            CopyFileData(fold, fnew, min(dstst.st_size, srcst.st_size), throttle)
+            fnew.truncate(srcst.st_size)
+
+            for offset, block in changed:
+                if throttle is not None:
+                    throttle(len(block))
+                os.pwrite(fnew.fileno(), block, offset)
+                written += len(block)
+
+            fnew.flush()
+            os.fsync(fnew.fileno())
+
+        os.chmod(tmppath, srcst.st_mode & 0o7777)
+        os.utime(tmppath, ns=(srcst.st_atime_ns, srcst.st_mtime_ns))
+        os.replace(tmppath, dstpath)
+    except BaseException:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        raise
+
+    newst = os.stat(dstpath)
+    try:
+        C_BandSignature(newst.st_size, newst.st_mtime_ns, newst.st_ino, blocks).Save(sigpath)
+    except OSError:
+        pass    # only a cache, we'll rebuild it next time
+
+    return written, srcst.st_size
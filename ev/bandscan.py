@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+This module scans the bands directory of a sparsebundle. It walks the directory
+once using os.scandir(), so the file type comes from the directory entry itself
+and the only other system call per band is the single stat() needed to get the
+size and modify time. There is also a helper that scans several band directories
+at the same time on a small thread pool, which is how the LOCAL and REMOTE stores
+are scanned, since the Dropbox side is usually the slow one.
+"""
+
+import os
+from collections import namedtuple
+
+# One of these is returned for every band file in the bands directory
+BandEntry = namedtuple('BandEntry', ['name', 'size', 'mtime_ns', 'ino'])
+
+def ScanBands(bands):
+    """Scan the bands directory and return a list of BandEntry tuples, one for each
+    regular file found.
+
+    Returns:
+        None - If the bands directory doesn't exist
+        []   - List of BandEntry(name, size, mtime_ns, ino)"""
+
+    if not os.path.isdir(bands):
+        return None
+
+    entries = []
+
+    with os.scandir(bands) as it:
+        for entry in it:
+            # is_file() is answered from the directory entry on most file systems,
+            # so it doesn't cost a system call. Don't follow links, bands are never links.
+            if not entry.is_file(follow_symlinks=False):
+                continue
+
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # Band vanished between readdir and stat (Dropbox can do this)
+                continue
+
+            entries.append(BandEntry(entry.name, st.st_size, st.st_mtime_ns, st.st_ino))
+
+    return entries
+
+def ScanConcurrently(scanners, workers=None):
+    """Run several scans at the same time. Each scanner is a callable that takes no
+    arguments, e.g. a bound load_bundle_bands() method or a lambda around ScanBands().
+    The scans are I/O bound, so threads are plenty. Results are returned in the same
+    order as scanners.
+
+    Returns: List of the scanner results, one for each scanner."""
+
+    scanners = list(scanners)
+
+    if len(scanners) < 2:
+        return [scanner() for scanner in scanners]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=workers or len(scanners)) as pool:
+        futures = [pool.submit(scanner) for scanner in scanners]
+        return [future.result() for future in futures]
+
+if __name__ == "__main__":
+    import sys
+
+    for entry in ScanBands(sys.argv[1] if len(sys.argv) > 1 else '.') or []:
+        print(entry)
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+"""
+This module is the band-level sync engine that backup() and restore() use in place
+of running rsync over the whole vault. The band diff already tells us exactly which
+bands differ, so there's no reason to re-stat and re-checksum everything else.
+
+A sync goes like this:
+
+1. Every band that is new or different on the source is copied, in parallel, to a
+   temp file in the destination bands directory. Only the allocated ranges of the
+   band are moved (holes stay holes), with copy_file_range() (or sendfile(), or
+   plain read/write as a last resort), the source mtime is put on it, it's
+   fsync'ed, and then renamed over the band.
+2. Bands that only exist on the destination are deleted.
+3. The bands directory is fsync'ed, so all of the above is on disk before...
+4. ...the bundle metadata (Info.plist, Info.bckup, token, etc.) and the other files
+   in the vault directory are copied the same way. Those are last on purpose: the
+   destination stays mountable at every step, since hdiutil trusts Info.plist.
+"""
+
+import os
+import sys
+import threading
+
+# Prefix used for the temp files in the destination. The leading dot keeps them out
+# of the way of anything that looks at band names.
+TEMP_PREFIX = '.ev-tmp-'
+
+# Bytes per copy_file_range()/sendfile() call
+COPY_CHUNK = 8 * 1024 * 1024
+
+def DefaultMessageHandler(msg):
+    """Eats messages, same as the one in ev.cryptvault"""
+    pass
+
+def DataExtents(fd, size):
+    """Generator that returns (start, end) for each allocated range of the open file
+    fd, using SEEK_DATA/SEEK_HOLE. Sparsebundle bands are often only partly allocated,
+    and there's no reason to read (or write) the holes. If the platform or the file
+    system doesn't support it, the whole file is returned as one range."""
+
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            import errno
+            if e.errno == errno.ENXIO:
+                return              # nothing but hole from here to the end
+            if offset == 0:
+                yield 0, size       # SEEK_DATA isn't supported here
+                return
+            raise
+
+        if start >= size:
+            return
+
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+
+        yield start, end
+        offset = end
+
+def _copy_range(src, dst, offset, length, throttle=None):
+    """Copy length bytes at offset in src to the same offset in dst, in the kernel
+    when possible. If throttle is given, it's called with the size of each chunk
+    before it's copied (see ev.scheduler). Returns the number of bytes copied."""
+
+    copied = 0
+
+    # copy_file_range() is Linux only (and can do reflinks/server-side copies)
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                if throttle is not None:
+                    throttle(min(COPY_CHUNK, length - copied))
+                n = os.copy_file_range(src, dst, min(COPY_CHUNK, length - copied),
+                                       offset + copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError:
+            pass    # e.g. EXDEV on older kernels, or a file system that can't do it
+
+    # sendfile() can copy between regular files on Linux, but not on macOS
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        try:
+            while copied < length:
+                if throttle is not None:
+                    throttle(min(COPY_CHUNK, length - copied))
+                os.lseek(dst, offset + copied, os.SEEK_SET)
+                n = os.sendfile(dst, src, offset + copied, min(COPY_CHUNK, length - copied))
+                if n == 0:
+                    break
+                copied += n
+            return copied
+        except OSError:
+            pass
+
+    while copied < length:
+        if throttle is not None:
+            throttle(min(COPY_CHUNK, length - copied))
+        buf = os.pread(src, min(COPY_CHUNK, length - copied), offset + copied)
+        if not buf:
+            break
+        os.pwrite(dst, buf, offset + copied)
+        copied += len(buf)
+
+    return copied
+
+def CopyFileData(fsrc, fdst, size, throttle=None):
+    """Copy the first size bytes of the open file fsrc to the open file fdst. Only
+    the allocated ranges are copied (see DataExtents()), and fdst is truncated to
+    size, so holes in the source stay holes in the destination. Returns the number
+    of bytes actually copied."""
+
+    src = fsrc.fileno()
+    dst = fdst.fileno()
+
+    copied = 0
+
+    for start, end in DataExtents(src, size):
+        copied += _copy_range(src, dst, start, end - start, throttle)
+
+    os.ftruncate(dst, size)
+
+    return copied
+
+def FsyncDirectory(path):
+    """fsync a directory, so renames and unlinks in it are on disk"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass    # some file systems don't support fsync on a directory
+    finally:
+        os.close(fd)
+
+def TempPath(dstpath):
+    """Returns the temp file used while writing dstpath"""
+    return os.path.join(os.path.dirname(dstpath), TEMP_PREFIX + os.path.basename(dstpath))
+
+def CommitFile(srcpath, dstpath, throttle=None):
+    """Copy srcpath to dstpath by way of a temp file next to dstpath, carrying over
+    the mode and times, and fsync it before the rename. Returns the bytes copied."""
+
+    st = os.stat(srcpath)
+
+    tmppath = TempPath(dstpath)
+
+    try:
+        with open(srcpath, 'rb') as fsrc, open(tmppath, 'wb') as fdst:
+            copied = CopyFileData(fsrc, fdst, st.st_size, throttle)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+
+        os.chmod(tmppath, st.st_mode & 0o7777)
+        os.utime(tmppath, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmppath, dstpath)
+    except BaseException:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        raise
+
+    return copied
+
+def SyncLists(diff):
+    """Given the C_BandTableDiff of source (as 'local') against destination (as
+    'remote'), return (copy, delete): (band name, size) tuples for the bands to copy
+    from the source, and the names of the bands to delete from the destination. It's a mirror, so
+    anything that isn't the same is copied, no matter which side is newer."""
+
+    from ev.bandtable import DIFF_LOCAL_ONLY, DIFF_NEWER, DIFF_OLDER, DIFF_SIZE_CHANGED, DIFF_REMOTE_ONLY
+
+    copy = []
+    delete = []
+
+    for record in diff.Records([DIFF_LOCAL_ONLY, DIFF_NEWER, DIFF_OLDER, DIFF_SIZE_CHANGED]):
+        copy.append((record.band, record.local_size))
+
+    for record in diff.Records([DIFF_REMOTE_ONLY]):
+        delete.append(record.band)
+
+    return copy, delete
+
+class C_BandSync:
+    """This object syncs the sparsebundle in one C_VaultStore (the source) to another
+    (the destination), band by band.
+
+    src, dst - C_VaultStore objects
+    message - A function that is called with a string to print status messages
+    workers - How many bands to copy at the same time, unless a scheduler is given
+    delta - If the band already exists on the destination, only write the blocks
+            that changed (see ev.banddelta)
+    journal - A C_TransferJournal that has been begun (or resumed) for this sync,
+              which gets a record as each band is finished (see ev.journal)
+    scheduler - A C_TransferScheduler, which decides the number of workers, the order
+                the bands are copied in, and throttles the copies (see ev.scheduler)
+    """
+    def __init__(self, src, dst, message=DefaultMessageHandler, workers=4, delta=False,
+                 journal=None, scheduler=None):
+        from ev.scheduler import C_TransferScheduler, C_TransferPolicy
+
+        self.src = src
+        self.dst = dst
+        self.msgout = message
+        self.delta = delta
+        self.journal = journal
+        self.scheduler = scheduler or C_TransferScheduler(C_TransferPolicy(workers=workers))
+        self.workers = self.scheduler.policy.workers
+        self.throttle = self.scheduler.Throttle if self.scheduler.Throttled() else None
+        self.lock = threading.Lock()
+
+        self.stats = {'copied': 0, 'deleted': 0, 'bytes': 0, 'apparent': 0, 'metadata': 0,
+                      'seconds': 0.0, 'deltas': 0, 'saved': 0}
+
+    def copy_band(self, name):
+        """Copy one band from the source to the destination. Returns the number of
+        bytes written to the destination."""
+        srcpath = os.path.join(self.src.getBands(), name)
+        dstpath = os.path.join(self.dst.getBands(), name)
+
+        if self.journal is not None:
+            self.journal.TempFile(TempPath(dstpath))
+
+        # Before the copy, so if the band changes while we read it, the journal has
+        # the old mtime and a resume copies it again
+        st = os.stat(srcpath)
+
+        if self.delta and os.path.isfile(dstpath):
+            from ev.banddelta import DeltaCommitFile
+
+            written, total = DeltaCommitFile(srcpath, dstpath,
+                                             os.path.join(self.dst.getCacheFile('sigs'), name),
+                                             self.throttle)
+            with self.lock:
+                self.stats['deltas'] += 1
+                self.stats['saved'] += total - written
+        else:
+            written = CommitFile(srcpath, dstpath, self.throttle)
+
+        if self.journal is not None:
+            self.journal.Done(name, st.st_size, st.st_mtime_ns)
+
+        return written
+
+    def delete_band(self, name):
+        """Delete one band from the destination (and its delta signature, if any)"""
+        for path in (os.path.join(self.dst.getBands(), name),
+                     os.path.join(self.dst.getCacheFile('sigs'), name)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def sync_metadata(self):
+        """Copy everything other than the bands: the files in the sparsebundle itself,
+        and the files in the vault directory next to it. These are small, so they are
+        done one at a time, and only if the size or mtime is different (in seconds,
+        since that's all Dropbox keeps). Files that are only on the destination are
+        deleted, same as rsync --delete did."""
+
+        pairs = [(self.src.getBundlePath(), self.dst.getBundlePath()),
+                 (self.src.getPath(), self.dst.getPath())]
+
+        for srcdir, dstdir in pairs:
+            names = set()
+
+            with os.scandir(srcdir) as it:
+                for entry in it:
+                    if not entry.is_file(follow_symlinks=False):
+                        if entry.path not in (self.src.getBundlePath(), self.src.getBands()):
+                            self.msgout("skipping %s, I only know how to sync files" % entry.path)
+                        continue
+
+                    names.add(entry.name)
+
+                    dstpath = os.path.join(dstdir, entry.name)
+                    st = entry.stat(follow_symlinks=False)
+
+                    try:
+                        dst = os.stat(dstpath)
+                        if (dst.st_size == st.st_size and
+                            dst.st_mtime_ns // 1000000000 == st.st_mtime_ns // 1000000000):
+                            continue
+                    except FileNotFoundError:
+                        pass
+
+                    self.stats['bytes'] += CommitFile(entry.path, dstpath, self.throttle)
+                    self.stats['metadata'] += 1
+
+            # Directories (the bands, the bundle) are left alone, only stale files go
+            with os.scandir(dstdir) as it:
+                stale = [entry for entry in it if entry.is_file(follow_symlinks=False) and entry.name not in names]
+
+            for entry in stale:
+                self.msgout("removing %s, it isn't in %s" % (entry.path, srcdir))
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+            FsyncDirectory(dstdir)
+
+    def Run(self, copy, delete):
+        """Do the sync. copy is a list of (band name, size) tuples to copy from the
+        source, and delete is a list of band names to delete from the destination
+        (see SyncLists()). Returns the stats dictionary. Raises OSError if anything
+        goes wrong, in which case the destination bundle metadata hasn't been touched."""
+
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        started = time.time()
+
+        os.makedirs(self.dst.getBands(), exist_ok=True)
+
+        if copy:
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    initializer=self.scheduler.WorkerInitializer()) as pool:
+                for copied in pool.map(self.copy_band, [c[0] for c in self.scheduler.Order(copy)]):
+                    self.stats['copied'] += 1
+                    self.stats['bytes'] += copied
+
+            # What a dumb copy would have had to move, holes and all
+            self.stats['apparent'] += sum(c[1] for c in copy)
+
+        for name in delete:
+            self.delete_band(name)
+            self.stats['deleted'] += 1
+            if self.journal is not None:
+                self.journal.Deleted(name)
+
+        # The bands have to be on disk before the metadata that describes them
+        FsyncDirectory(self.dst.getBands())
+
+        self.sync_metadata()
+
+        if self.journal is not None:
+            self.journal.Commit()
+
+        self.stats['seconds'] = time.time() - started
+
+        return self.stats
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+"""
+This module implements a compact table of the bands in a vault store. Instead of a
+dictionary of band name -> mtime, which costs well over 100 bytes a band, the table
+keeps sorted parallel arrays of band number, size, mtime (in nanoseconds) and inode,
+at 8 bytes per column per band. Sparsebundle band names are hex numbers, so sorting
+by number is the same order hdiutil uses.
+
+If NumPy is available, the columns are NumPy arrays, and the LOCAL/REMOTE comparison
+is a vectorized sorted merge-join. Otherwise the columns are array module arrays, and
+the merge-join runs as a tight loop over the two sorted columns.
+
+Files in the bands directory whose names aren't canonical band numbers (Dropbox
+conflict copies, for instance) can't live in the arrays, so they are kept to one side
+in the 'extras' dictionary, name -> (size, mtime_ns, ino), and compared by name.
+"""
+
+import sys
+from array import array
+from collections import namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The manifest and the table agree on this: number, size, mtime_ns, ino
+COLUMNS = 4
+
+NS_PER_SEC = 1000000000
+
+# The kinds of BandDiff records, in the order Records() returns them
+DIFF_LOCAL_ONLY = 'local-only'
+DIFF_REMOTE_ONLY = 'remote-only'
+DIFF_NEWER = 'newer'
+DIFF_OLDER = 'older'
+DIFF_SIZE_CHANGED = 'size-changed'
+DIFF_SAME = 'same'
+
+DIFF_KINDS = (DIFF_LOCAL_ONLY, DIFF_REMOTE_ONLY, DIFF_NEWER, DIFF_OLDER, DIFF_SIZE_CHANGED, DIFF_SAME)
+
+# One of these describes how a single band differs between LOCAL and REMOTE. The
+# local_*/remote_* fields are None for a band that is missing on that side.
+BandDiff = namedtuple('BandDiff', ['kind', 'band', 'local_size', 'local_mtime_ns',
+                                   'remote_size', 'remote_mtime_ns'])
+
+def _column(typecode, values=()):
+    """Returns a column of the given type (see the array module typecodes)."""
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.uint64 if typecode == 'Q' else numpy.int64)
+
+    return array(typecode, values)
+
+def _take(column, indexes):
+    """Returns the values in column at each of indexes."""
+    if numpy is not None:
+        return column[indexes]
+
+    return array(column.typecode, [column[i] for i in indexes])
+
+class C_BandTable:
+    """Sorted, array-backed table of the bands in one store. Use one of the From*()
+    constructors to build one."""
+
+    def __init__(self, numbers, sizes, mtimes, inodes, extras=None):
+        self.numbers = numbers
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.inodes = inodes
+        self.extras = extras or {}
+
+    @classmethod
+    def FromEntries(cls, entries):
+        """Build a table from an iterable of BandEntry tuples (see ev.bandscan)."""
+        from ev.manifest import BandNumber
+
+        rows = []
+        extras = {}
+
+        for entry in entries:
+            number = BandNumber(entry.name)
+            if number is None:
+                extras[entry.name] = (entry.size, entry.mtime_ns, entry.ino)
+            else:
+                rows.append((number, entry.size, entry.mtime_ns, entry.ino))
+
+        rows.sort()
+
+        return cls(_column('Q', [r[0] for r in rows]),
+                   _column('q', [r[1] for r in rows]),
+                   _column('q', [r[2] for r in rows]),
+                   _column('Q', [r[3] for r in rows]),
+                   extras)
+
+    @classmethod
+    def FromRecordBytes(cls, buf):
+        """Build a table from the little-endian interleaved records of a manifest
+        (number, size, mtime_ns, ino), which must already be sorted by number. Either
+        way, it's one bulk copy per column, so buf can go away afterwards."""
+
+        if numpy is not None:
+            rows = numpy.frombuffer(buf, dtype='<u8').reshape(-1, COLUMNS)
+            return cls(rows[:, 0].astype(numpy.uint64),
+                       rows[:, 1].astype(numpy.int64),
+                       rows[:, 2].astype(numpy.int64),
+                       rows[:, 3].astype(numpy.uint64))
+
+        rows = array('Q')
+        rows.frombytes(buf)
+        if sys.byteorder != 'little':
+            rows.byteswap()
+
+        return cls(rows[0::COLUMNS],
+                   array('q', rows[1::COLUMNS].tobytes()),
+                   array('q', rows[2::COLUMNS].tobytes()),
+                   rows[3::COLUMNS])
+
+    def ToRecordBytes(self):
+        """Returns the table as little-endian interleaved manifest records. The
+        extras can't be represented, so the caller has to check for them first."""
+
+        if numpy is not None:
+            rows = numpy.empty((self.BandCount(), COLUMNS), dtype='<u8')
+            rows[:, 0] = self.numbers
+            rows[:, 1] = self.sizes.view(numpy.uint64)
+            rows[:, 2] = self.mtimes.view(numpy.uint64)
+            rows[:, 3] = self.inodes
+            return rows.tobytes()
+
+        rows = array('Q', bytes(8 * COLUMNS * self.BandCount()))
+        rows[0::COLUMNS] = self.numbers
+        rows[1::COLUMNS] = array('Q', self.sizes.tobytes())
+        rows[2::COLUMNS] = array('Q', self.mtimes.tobytes())
+        rows[3::COLUMNS] = self.inodes
+        if sys.byteorder != 'little':
+            rows.byteswap()
+
+        return rows.tobytes()
+
+    def __len__(self):
+        return len(self.numbers) + len(self.extras)
+
+    def BandCount(self):
+        """Returns the number of canonically named bands (i.e. not counting extras)"""
+        return len(self.numbers)
+
+    def Find(self, number):
+        """Returns the row index of band number, or -1 if it isn't in the table."""
+        from bisect import bisect_left
+
+        if numpy is not None:
+            i = int(numpy.searchsorted(self.numbers, number))
+        else:
+            i = bisect_left(self.numbers, number)
+
+        if i < len(self.numbers) and int(self.numbers[i]) == number:
+            return i
+
+        return -1
+
+    def FindAll(self, numbers):
+        """Returns the row index of each of numbers (a list), -1 for the ones that
+        aren't in the table. It's Find() for a batch, in one pass with NumPy."""
+        if numpy is None or not len(numbers):
+            return [self.Find(number) for number in numbers]
+
+        wanted = numpy.array(numbers, dtype=numpy.uint64)
+        rows = numpy.searchsorted(self.numbers, wanted)
+        found = rows < len(self.numbers)
+        found[found] = self.numbers[rows[found]] == wanted[found]
+
+        return numpy.where(found, rows, -1).tolist()
+
+    def Range(self, first, last):
+        """Returns (start, stop), the slice of rows whose band numbers are from first
+        to last, inclusive."""
+        from bisect import bisect_left, bisect_right
+
+        if numpy is not None:
+            return (int(numpy.searchsorted(self.numbers, first, 'left')),
+                    int(numpy.searchsorted(self.numbers, last, 'right')))
+
+        return bisect_left(self.numbers, first), bisect_right(self.numbers, last)
+
+    def Seconds(self):
+        """Returns the mtime column truncated to whole seconds. Dropbox truncates the
+        modify time to seconds, so this is what LOCAL and REMOTE are compared on."""
+        if numpy is not None:
+            return self.mtimes // NS_PER_SEC
+
+        return array('q', [m // NS_PER_SEC for m in self.mtimes])
+
+    def Entries(self):
+        """Generator that returns a BandEntry for every band, in band order, followed
+        by the extras."""
+        from ev.bandscan import BandEntry
+        from ev.manifest import BandName
+
+        for number, size, mtime_ns, ino in zip(self.numbers, self.sizes, self.mtimes, self.inodes):
+            yield BandEntry(BandName(int(number)), int(size), int(mtime_ns), int(ino))
+
+        for name, (size, mtime_ns, ino) in sorted(self.extras.items()):
+            yield BandEntry(name, size, mtime_ns, ino)
+
+    def TotalSize(self):
+        """Returns the sum of the band sizes, in bytes."""
+        if numpy is not None:
+            total = int(self.sizes.sum())
+        else:
+            total = sum(self.sizes)
+
+        return total + sum(e[0] for e in self.extras.values())
+
+class C_BandTableDiff:
+    """The result of comparing two band tables (see DiffBandTables()). Each attribute
+    is a column of row indexes:
+
+    localonly           - rows of local that aren't in remote
+    remoteonly          - rows of remote that aren't in local
+    common_local,
+    common_remote       - rows of the bands in both, paired up in band order
+    newer, older, same  - positions in the common_* columns where the local mtime
+                          (in seconds) is newer, older or the same as the remote one
+    sizechanged         - positions in the common_* columns where the mtimes are the
+                          same, but the sizes aren't (so they're not in 'same')
+
+    The extras are compared by name, and land in the *_extras lists.
+    """
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+
+    def Counts(self):
+        """Returns the size of each set as a dictionary."""
+        return {
+            'localonly': len(self.localonly) + len(self.localonly_extras),
+            'remoteonly': len(self.remoteonly) + len(self.remoteonly_extras),
+            'newer': len(self.newer) + len(self.newer_extras),
+            'older': len(self.older) + len(self.older_extras),
+            'same': len(self.same) + len(self.same_extras),
+            'sizechanged': len(self.sizechanged) + len(self.sizechanged_extras),
+        }
+
+    def Records(self, kinds=None):
+        """Generator that returns a BandDiff record for each band, a kind at a time
+        (see DIFF_KINDS), in band order within each kind. Records are only built as
+        they are asked for, so looking at the first few of a big diff is cheap.
+
+        kinds - Only return records of these kinds. Defaults to everything."""
+
+        from ev.manifest import BandName
+
+        local = self.local
+        remote = self.remote
+
+        def lrow(i):
+            return int(local.sizes[i]), int(local.mtimes[i])
+
+        def rrow(i):
+            return int(remote.sizes[i]), int(remote.mtimes[i])
+
+        for kind in DIFF_KINDS:
+            if kinds is not None and kind not in kinds:
+                continue
+
+            if kind == DIFF_LOCAL_ONLY:
+                for i in self.localonly:
+                    yield BandDiff(kind, BandName(int(local.numbers[i])), *lrow(i), None, None)
+                for name in self.localonly_extras:
+                    yield BandDiff(kind, name, *local.extras[name][:2], None, None)
+
+            elif kind == DIFF_REMOTE_ONLY:
+                for i in self.remoteonly:
+                    yield BandDiff(kind, BandName(int(remote.numbers[i])), None, None, *rrow(i))
+                for name in self.remoteonly_extras:
+                    yield BandDiff(kind, name, None, None, *remote.extras[name][:2])
+
+            else:
+                positions, extras = {
+                    DIFF_NEWER: (self.newer, self.newer_extras),
+                    DIFF_OLDER: (self.older, self.older_extras),
+                    DIFF_SAME: (self.same, self.same_extras),
+                    DIFF_SIZE_CHANGED: (self.sizechanged, self.sizechanged_extras),
+                }[kind]
+
+                for k in positions:
+                    li = self.common_local[k]
+                    ri = self.common_remote[k]
+                    yield BandDiff(kind, BandName(int(local.numbers[li])), *lrow(li), *rrow(ri))
+                for name in extras:
+                    yield BandDiff(kind, name, *local.extras[name][:2], *remote.extras[name][:2])
+
+def _merge_join(lnumbers, rnumbers):
+    """Sorted merge-join of two band number columns, for when NumPy isn't around.
+    Returns (localonly, remoteonly, common_local, common_remote) index arrays."""
+
+    localonly = array('Q')
+    remoteonly = array('Q')
+    common_local = array('Q')
+    common_remote = array('Q')
+
+    i = j = 0
+    nl = len(lnumbers)
+    nr = len(rnumbers)
+
+    while i < nl and j < nr:
+        a = lnumbers[i]
+        b = rnumbers[j]
+        if a == b:
+            common_local.append(i)
+            common_remote.append(j)
+            i += 1
+            j += 1
+        elif a < b:
+            localonly.append(i)
+            i += 1
+        else:
+            remoteonly.append(j)
+            j += 1
+
+    localonly.extend(range(i, nl))
+    remoteonly.extend(range(j, nr))
+
+    return localonly, remoteonly, common_local, common_remote
+
+def DiffBandTables(local, remote):
+    """Compare the LOCAL and REMOTE band tables, and return a C_BandTableDiff."""
+
+    diff = C_BandTableDiff(local, remote)
+
+    if numpy is not None:
+        common, diff.common_local, diff.common_remote = numpy.intersect1d(
+            local.numbers, remote.numbers, assume_unique=True, return_indices=True)
+        diff.localonly = numpy.flatnonzero(~numpy.isin(local.numbers, common, assume_unique=True))
+        diff.remoteonly = numpy.flatnonzero(~numpy.isin(remote.numbers, common, assume_unique=True))
+
+        lsec = local.Seconds()[diff.common_local]
+        rsec = remote.Seconds()[diff.common_remote]
+
+        samesize = local.sizes[diff.common_local] == remote.sizes[diff.common_remote]
+
+        diff.newer = numpy.flatnonzero(lsec > rsec)
+        diff.older = numpy.flatnonzero(lsec < rsec)
+        diff.same = numpy.flatnonzero((lsec == rsec) & samesize)
+        diff.sizechanged = numpy.flatnonzero((lsec == rsec) & ~samesize)
+    else:
+        (diff.localonly, diff.remoteonly,
+         diff.common_local, diff.common_remote) = _merge_join(local.numbers, remote.numbers)
+
+        lsec = _take(local.mtimes, diff.common_local)
+        rsec = _take(remote.mtimes, diff.common_remote)
+        lsize = _take(local.sizes, diff.common_local)
+        rsize = _take(remote.sizes, diff.common_remote)
+
+        diff.newer = array('Q')
+        diff.older = array('Q')
+        diff.same = array('Q')
+        diff.sizechanged = array('Q')
+
+        for k, (lm, rm) in enumerate(zip(lsec, rsec)):
+            lm //= NS_PER_SEC
+            rm //= NS_PER_SEC
+            if lm > rm:
+                diff.newer.append(k)
+            elif lm < rm:
+                diff.older.append(k)
+            elif lsize[k] != rsize[k]:
+                diff.sizechanged.append(k)
+            else:
+                diff.same.append(k)
+
+    # The oddly named files, if there are any, are compared the slow way
+    diff.localonly_extras = sorted(set(local.extras) - set(remote.extras))
+    diff.remoteonly_extras = sorted(set(remote.extras) - set(local.extras))
+    diff.newer_extras = []
+    diff.older_extras = []
+    diff.same_extras = []
+    diff.sizechanged_extras = []
+
+    for name in sorted(set(local.extras) & set(remote.extras)):
+        lm = local.extras[name][1] // NS_PER_SEC
+        rm = remote.extras[name][1] // NS_PER_SEC
+        if lm > rm:
+            diff.newer_extras.append(name)
+        elif lm < rm:
+            diff.older_extras.append(name)
+        elif local.extras[name][0] != remote.extras[name][0]:
+            diff.sizechanged_extras.append(name)
+        else:
+            diff.same_extras.append(name)
+
+    return diff
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+"""
+This module runs one verb across several vaults at the same time, e.g. a nightly
+backup of every vault, so it takes about as long as the slowest vault instead of
+the sum of all of them. Each vault runs in its own thread (in the daemon, if there
+is one, see ev.daemon), its messages are prefixed with its name, and at the end
+there's a summary table with the return code and time of each vault.
+
+Whether each vault is mounted is looked up for the whole batch at the start, with
+one hdiutil info (see ev.cryptvault.LocalVolumes()), instead of once per vault. In
+the daemon, the vaults share its cached hdiutil info (see ev.hdiinfo2) instead.
+
+Verbs that want a password (mount, attach) don't make sense in a batch, so they
+aren't allowed.
+"""
+
+import os
+import time
+import threading
+
+from ev.verbs import PasswordVerbs, Lookup
+
+BATCH_EXCLUDED_VERBS = PasswordVerbs()
+
+def DiscoverVaults(root):
+    """Returns the sorted names of the vaults under root, i.e. every NAME that has a
+    NAME/NAME.sparsebundle in it"""
+    names = []
+
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_dir():
+                    continue
+                if os.path.isdir(os.path.join(entry.path, entry.name + '.sparsebundle')):
+                    names.append(entry.name)
+    except FileNotFoundError:
+        pass
+
+    return sorted(names)
+
+class C_BatchResult:
+    """What happened to one vault in a batch"""
+
+    def __init__(self, vault):
+        self.vault = vault
+        self.rc = None
+        self.error = None
+        self.seconds = 0.0
+
+    def ToDict(self):
+        return {'kind': 'batch', 'vault': self.vault, 'rc': self.rc,
+                'error': self.error, 'seconds': self.seconds}
+
+class C_BatchRun:
+    """Runs verb on each of vaults.
+
+    message - A function that is called with a string to print status messages
+    records - Optional function that is called with a dictionary for each record
+    workers - How many vaults run at the same time
+    """
+    def __init__(self, vaults, verb, args=(), message=print, records=None, workers=4):
+        self.vaults = vaults
+        self.verb = verb.lower()
+        self.args = list(args)
+        self.msgout = message
+        self.recordout = records
+        self.workers = max(1, int(workers))
+        self.lock = threading.Lock()
+        self.volumes = None
+
+    def prefixed(self, vault):
+        """Returns a message handler that tags each message with the vault name"""
+        def message(msg):
+            with self.lock:
+                self.msgout('[%s] %s' % (vault, msg))
+        return message
+
+    def serialized_records(self):
+        if self.recordout is None:
+            return None
+
+        def records(record):
+            with self.lock:
+                self.recordout(record)
+        return records
+
+    def run_one(self, vault):
+        from ev.cryptvault import C_EncryptedVault, VaultError
+        from ev.daemon import Request, Running
+
+        result = C_BatchResult(vault)
+        message = self.prefixed(vault)
+        records = self.serialized_records()
+
+        started = time.time()
+        try:
+            if Running():
+                result.rc = Request(vault, self.verb, self.args, message, records)
+            else:
+                encvlt = C_EncryptedVault(vault, message, records, needs=Lookup(self.verb).needs,
+                                          volumes=self.volumes)
+                if not encvlt.valid:
+                    result.error = "the vault isn't valid"
+                else:
+                    result.rc = encvlt.lookup(self.verb)(*self.args)
+        except VaultError as ve:
+            result.error = "exception %d: %s" % (ve.errno, ve.errmsg)
+        except Exception as e:
+            result.error = "%s: %s" % (type(e).__name__, e)
+
+        result.seconds = time.time() - started
+
+        return result
+
+    def Run(self):
+        """Run the batch. Returns the list of C_BatchResult, in the order of vaults."""
+        from concurrent.futures import ThreadPoolExecutor
+        from ev.cryptvault import LocalVolumes
+        from ev.daemon import Running
+
+        spec = Lookup(self.verb)
+        if spec is None:
+            raise ValueError("there's no verb named '%s'" % self.verb)
+        if self.verb in BATCH_EXCLUDED_VERBS:
+            raise ValueError("'%s' needs a password, so it can't be run in a batch" % self.verb)
+        problem = spec.CheckArgs(self.args)
+        if problem is not None:
+            raise ValueError(problem)
+
+        if not Running():
+            self.volumes = LocalVolumes(self.vaults)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(self.run_one, self.vaults))
+
+    def Summary(self, results, elapsed):
+        """Send the summary table to the message handler (and the records handler)"""
+        width = max([len(r.vault) for r in results] + [5])
+
+        self.msgout("%-*s  %4s  %9s  %s" % (width, 'vault', 'rc', 'seconds', 'error'))
+        for r in results:
+            self.msgout("%-*s  %4s  %9.2f  %s" % (width, r.vault, '-' if r.rc is None else r.rc,
+                                                  r.seconds, r.error or ''))
+            if self.recordout is not None:
+                self.recordout(r.ToDict())
+
+        failed = sum(1 for r in results if r.rc != 0)
+        self.msgout("%s on %d vault(s): %d failed, %.2f seconds in all (%.2f added up)" %
+                    (self.verb, len(results), failed, elapsed, sum(r.seconds for r in results)))
+
+        return 1 if failed else 0
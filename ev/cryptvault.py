@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import os
-import kenl380.pylib as pylib
 
 """
 The EncryptedVault class is configured to (hard-coded for now), to use things like:
@@ -79,18 +78,106 @@ class VaultError(Error):
         self.errno = errno
         self.errmsg = errmsg
         
+# Verbs that don't update the metrics file when they're done (see C_EncryptedVault.lookup())
+NO_METRICS_VERBS = {'metrics', 'lookup', 'export_metrics'}
+
 class C_EVDefaults:
-    """This class abstracts the LOCAL and REMOTE locations on this computer"""
+    """This class abstracts the LOCAL and REMOTE locations on this computer. Anything
+    set here can be overridden by a key of the same name in ~/vaults/.evdefaults.plist
+    (e.g. RemotePath, ReplicaPaths, TransferPolicy)."""
     def __init__(self):
         self.LocalPath = os.path.expanduser("~/vaults")
         self.RemotePath = os.path.expanduser("~/Dropbox/system/vaults")
         
+        # Extra places to back up to, besides RemotePath, e.g. a NAS or an external disk.
+        # RemotePath is still the one restore() uses and the one other computers see.
+        # Either one can be an object store URL instead of a directory, e.g.
+        # s3://bucket/vaults (see ev.objectstore).
+        self.ReplicaPaths = []
+        
+        # How to talk to object stores: page_size (objects per listing page), connections
+        # (the pool size), and for S3, endpoint_url and region. latency is for objdir://
+        # stores only, to make them act like they're across a network.
+        self.ObjectStore = {'page_size': 1000, 'connections': 8, 'endpoint_url': '', 'region': '', 'latency': 0.0}
+        self.CachePath = os.path.join(self.LocalPath, ".evcache")
+        
+        # 'native' for the band-level sync engine (see ev.bandsync), or 'rsync'
+        self.SyncEngine = "native"
+        
+        # When a band exists on both sides, only write the blocks that changed (see ev.banddelta)
+        self.DeltaTransfer = True
+        
+        # Snapshots of the LOCAL vaults (see ev.snapshot). This has to be on the same
+        # file system as LocalPath, since the bands are cloned, not copied.
+        self.SnapshotPath = os.path.join(self.LocalPath, ".evsnapshots")
+        self.SnapshotBeforeRestore = True
+        self.SnapshotKeep = 5       # automatic snapshots to keep, per vault
+        
+        # How hard backup/restore push the disks (see ev.scheduler). Each vault can
+        # override these in its plist with the 'policy' verb.
+        self.TransferPolicy = {'workers': 4, 'bytes_per_sec': 0, 'iops': 0, 'idle': False}
+        
+        # 'mirror' keeps a copy of the sparsebundle at RemotePath. 'versioned' keeps a
+        # deduplicated history of backups there instead (see ev.versionstore).
+        self.RemoteLayout = "mirror"
+        self.VersionKeep = 0        # versions the 'gc' verb keeps per vault, 0 for all of them
+        
+        # Watch the bands while a vault is mounted RW, so backup() knows which ones
+        # changed without a scan (see ev.watcher). WatchInterval is for polling.
+        self.WatchBands = False
+        self.WatchInterval = 5
+        
+        # Seconds hdiutil or rsync get before they're stopped (see ev.runner), 0 for no limit
+        self.CommandTimeout = 0
+        
+        # Where each vault's Prometheus textfile goes after every verb (see ev.metrics),
+        # e.g. the node-exporter textfile collector directory. Empty to turn it off.
+        self.MetricsPath = os.path.join(self.LocalPath, ".evmetrics")
+        
+        self.load_overrides(os.path.join(self.LocalPath, ".evdefaults.plist"))
+        
+    def load_overrides(self, path):
+        """Apply the settings in the plist at path, if there is one. Only keys that
+        match an existing setting are used, and paths get ~ expanded."""
+        if not os.path.isfile(path):
+            return
+            
+        from plistlib import load
+        
+        with open(path, 'rb') as f:
+            overrides = load(f)
+            
+        for key, value in overrides.items():
+            if key == 'LocalPath' or not hasattr(self, key):
+                continue    # LocalPath is where this file lives, so it can't move
+            if key.endswith('Path'):
+                value = os.path.expanduser(value)
+            elif key == 'ReplicaPaths':
+                value = [os.path.expanduser(v) for v in value]
+            setattr(self, key, value)
+        
     def LocalStorePath(self):
         return self.LocalPath
         
     def RemoteStorePath(self):
         return self.RemotePath
         
+    def ReplicaStorePaths(self):
+        """Returns every place a backup goes, RemotePath first"""
+        return [self.RemotePath] + [p for p in self.ReplicaPaths if p != self.RemotePath]
+        
+    def SnapshotStorePath(self):
+        return self.SnapshotPath
+        
+    def Versioned(self):
+        """Returns True if backups go to the versioned store instead of a mirror"""
+        return self.RemoteLayout == 'versioned'
+        
+    def CacheStorePath(self):
+        """Where we keep things like band manifests. This is always on the LOCAL side,
+        since it holds inode numbers that only make sense on this computer."""
+        return self.CachePath
+        
 class C_EVPlist:
     """This object is used to abstract the plist that is used by the encrypted
     vault code to track state and detect certain bad things that might occur.
@@ -108,6 +195,35 @@ class C_EVPlist:
     def GetPlist(self):
         return self.plist
         
+    def JournalPath(self,replica=None):
+        """Returns the path of the transfer journal (see ev.journal), which is kept
+        right next to this plist. Replicas other than Dropbox each get their own,
+        named with the store's cache key."""
+        if replica is None:
+            return os.path.splitext(self.store)[0] + ".journal"
+        return os.path.splitext(self.store)[0] + "." + replica + ".journal"
+        
+    def DirtyPath(self):
+        """Returns the path of the dirty band journal (see ev.watcher)"""
+        return os.path.splitext(self.store)[0] + ".dirty"
+        
+    def PlanPath(self):
+        """Returns the path of the saved transfer plan (see ev.plan)"""
+        return os.path.splitext(self.store)[0] + ".plan"
+        
+    def ReplicaStatus(self):
+        """Returns the dictionary of replica root -> status dictionary (status,
+        last-backup, bytes, seconds) for the replicas this vault has been backed up to"""
+        return self.plist.get('replicas', {})
+        
+    def SetReplicaStatus(self,root,status):
+        replicas = dict(self.plist.get('replicas', {}))
+        merged = dict(replicas.get(root, {}), **status)
+        if replicas.get(root) != merged:
+            replicas[root] = merged
+            self.plist['replicas'] = replicas
+            self.dirty = True
+        
     def LoadPlist(self):
         
         # @TODO: This thing needs error handling...
@@ -130,18 +246,37 @@ class C_EVPlist:
             self.dirty = True   # if we created a new one, it's dirty... Doesn't work anyway
         else:
             from plistlib import load
+            from ev.spans import Span
             
-            f = open(self.store,"rb")
-    
-            self.plist = load(f)
-            
-            f.close()
+            with Span('plist.load'):
+                f = open(self.store,"rb")
+        
+                self.plist = load(f)
+                
+                f.close()
         
     def WritePlist(self):
         if self.dirty:
-            from plistlib import writePlist
-        
-            writePlist(self.plist,self.store)
+            from plistlib import dump
+            from ev.spans import Span
+        
+            # Other ev processes (cron, the daemon) may be reading it, so they must
+            # never see half of one: write a temp file next to it and rename it over.
+            # writePlist() went away in Python 3.9
+            tmp = '%s.%d.tmp' % (self.store, os.getpid())
+            with Span('plist.write'):
+                try:
+                    with open(tmp, 'wb') as f:
+                        dump(self.plist, f)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp, self.store)
+                except BaseException:
+                    try:
+                        os.unlink(tmp)
+                    except OSError:
+                        pass
+                    raise
             
             self.dirty = False
 
@@ -161,6 +296,15 @@ class C_EVPlist:
             self.plist['computer-name'] = name
             self.dirty = True
         
+    def TransferPolicy(self):
+        """Returns the dictionary of transfer policy overrides for this vault"""
+        return self.plist.get('transfer-policy', {})
+        
+    def SetTransferPolicy(self,policy):
+        if self.plist.get('transfer-policy', {}) != policy:
+            self.plist['transfer-policy'] = policy
+            self.dirty = True
+        
     def NeedsBackup(self):
         return self.plist['needs-backup']
         
@@ -169,6 +313,39 @@ class C_EVPlist:
             self.plist['needs-backup'] = needs_backup
             self.dirty = True
         
+    def LastSync(self):
+        """Returns the dictionary of direction -> {time, seconds, bytes} for the last
+        backup and the last restore that committed"""
+        return self.plist.get('last-sync', {})
+        
+    def SetLastSync(self,direction,seconds,nbytes):
+        import time
+        
+        last = dict(self.plist.get('last-sync', {}))
+        last[direction] = {'time': time.time(), 'seconds': seconds, 'bytes': nbytes}
+        self.plist['last-sync'] = last
+        self.dirty = True
+        
+    def Throughput(self,direction):
+        """Returns the C_ThroughputModel (see ev.plan) learned from the last few
+        transfers of this vault in direction"""
+        from ev.plan import C_ThroughputModel
+        
+        return C_ThroughputModel(self.plist.get('throughput', {}).get(direction))
+        
+    def AddThroughput(self,direction,nbytes,bands,seconds):
+        throughput = dict(self.plist.get('throughput', {}))
+        throughput[direction] = self.Throughput(direction).Add(nbytes, bands, seconds)
+        self.plist['throughput'] = throughput
+        self.dirty = True
+        
+    def MetricsState(self):
+        """Returns the C_MetricsState of this vault (see ev.metrics), which is kept
+        right next to this plist, so the plist isn't written by verbs that only look"""
+        from ev.metrics import C_MetricsState
+        
+        return C_MetricsState(os.path.splitext(self.store)[0] + ".metrics", self)
+        
 
 class C_VaultStore:
     """
@@ -179,16 +356,70 @@ class C_VaultStore:
     @TODO: Add the ability to create a new vault from scratch.
     @TODO: Add the ability to mount vaults READ-ONLY
     """
-    def __init__(self,path,vaultname):
+    objectstore = False     # see C_ObjectVaultStore
+    
+    def __init__(self,path,vaultname,inplace=False):
+        """inplace - The bands can be rewritten in place, by whoever attaches the
+                     image, which is true of LOCAL (see ev.manifest)"""
         self.path = os.path.join(os.path.expanduser(path),vaultname)
+        self.inplace = inplace
         self.bundlepath = os.path.join(self.path,vaultname + '.sparsebundle')
         self.plist = os.path.join(self.bundlepath, 'Info.plist')
         self.bands = os.path.join(self.bundlepath, 'bands')
+        self.bandtable = None
+        self.bandlist = None
+        
+        # The manifest is keyed by the bands path, so the LOCAL and REMOTE stores
+        # (or any other store for that matter) never share one.
+        from hashlib import sha1
+        from ev.manifest import C_BandManifest
+        
+        self.cachekey = '%s-%s' % (vaultname, sha1(self.bands.encode('utf-8')).hexdigest()[:16])
+        self.manifest = C_BandManifest(self.bands, self.getCacheFile('manifest'), self.inplace)
         
     def getPath(self):
         """Returns the vault path as a string"""
         return self.path
         
+    def getRoot(self):
+        """Returns where all the vaults of this store are, e.g. the Dropbox vaults folder"""
+        return os.path.dirname(self.path)
+        
+    def Online(self):
+        """Returns True if the store is there (i.e. the NAS or disk is mounted)"""
+        return os.path.isdir(self.getRoot())
+        
+    def HasBands(self):
+        return os.path.isdir(self.bands)
+        
+    def BandsState(self):
+        """Returns something that changes whenever the bands do, or None if it
+        can't be told. For a store whose bands are only replaced by renaming, that's
+        [dev, ino, mtime_ns] of the bands directory, unless it changed too recently
+        for the mtime to be trusted (see ev.manifest.RACY_WINDOW_NS). With inplace,
+        the directory proves nothing, so it's a hash of the name, size, mtime and
+        inode of every band, from a scan (see ev.manifest)."""
+        from time import time_ns
+        from ev.manifest import RACY_WINDOW_NS
+        
+        if self.inplace:
+            from hashlib import blake2b
+            
+            table = self.manifest.Refresh()
+            if table is None or table.extras:
+                return None
+            return blake2b(table.ToRecordBytes(), digest_size=16).hexdigest()
+            
+        try:
+            st = os.stat(self.bands)
+        except FileNotFoundError:
+            return None
+            
+        if time_ns() - st.st_mtime_ns < RACY_WINDOW_NS:
+            return None
+            
+        return [st.st_dev, st.st_ino, st.st_mtime_ns]
+        
     def getBundlePath(self):
         """Returns the sparsebundle path as a string"""
         return self.bundlepath
@@ -205,37 +436,228 @@ class C_VaultStore:
         """Returns a dictionary containing all the individual band filenames as the
         key, and the current last modified time in seconds since epoch as the value.
         
-        @TODO: This should be better thought out. A list of objects perhaps?"""
+        This is only here for callers that want the old interface. It's built from
+        the band table on demand, and costs a lot more memory (see getBandTable())."""
+        if self.bandlist is None:
+            self.bandlist = {entry.name: entry.mtime_ns // 1000000000
+                             for entry in self.bandtable.Entries()}
+            
         return self.bandlist
         
-    def load_bundle_bands(self):
+    def getBandTable(self):
+        """Returns the C_BandTable holding the bands found by load_bundle_bands()"""
+        return self.bandtable
+        
+    def getDiskUsage(self):
+        """Returns (apparent, allocated): the total size of the bands, and how much
+        disk space they really use. Bands are sparse, so the second one is usually a
+        lot smaller. This stats every band, so it isn't cheap on a big vault."""
+        apparent = allocated = 0
+        
+        with os.scandir(self.bands) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    apparent += st.st_size
+                    allocated += st.st_blocks * 512
+                    
+        return apparent, allocated
+        
+    def getAllocated(self, names):
+        """Returns how much disk space the bands called names use, i.e. roughly what
+        copying them writes, since the copy keeps the holes"""
+        allocated = 0
+        
+        for name in names:
+            try:
+                allocated += os.stat(os.path.join(self.bands, name)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+                
+        return allocated
+        
+    def getManifest(self):
+        """Returns the C_BandManifest object for this store"""
+        return self.manifest
+        
+    def getCacheFile(self, kind):
+        """Returns the path of the LOCAL cache file (or directory) of the given kind
+        for this store, e.g. 'manifest' or 'sigs' (see C_EVDefaults.CacheStorePath())"""
+        return os.path.join(C_EVDefaults().CacheStorePath(), '%s.%s' % (self.cachekey, kind))
+        
+    def load_bundle_bands(self, use_manifest=True):
         """Load the bands from the sparse bundle. This method will initialize the
-        band dictionary (see getBandDict()). It isn't normally called, since as of now,
+        band table (see getBandTable()). It isn't normally called, since as of now,
         the only time we need this is when we want to analyze to local and remote vaults
         to determine which is the most up to date. Currently returns 0, but that's kind
-        of dumb."""
+        of dumb.
+        
+        use_manifest - Refresh and use the persistent band manifest (see ev.manifest)
+                       instead of doing a full scan. Pass False if bands may have been
+                       rewritten in place, e.g. while the image is mounted."""
     
-        bandlist = {}
+        from ev.spans import Span
+        
+        if use_manifest:
+            with Span('store.manifest') as span:
+                table = self.manifest.Refresh()
+                span.add(bands=len(table) if table is not None else 0)
+            return self.set_bundle_bands(table)
+        
+        from ev.bandscan import ScanBands
+        from ev.bandtable import C_BandTable
 
-        # make sure the path exists, otherwise bail now ...
-        if not os.path.isdir('%s' % self.bands): return -1
-    
-        # go process all the directories in the versions folder
-        for f in os.listdir(self.bands):
-            curband = os.path.join(self.bands,f)
+        self.manifest.Invalidate()
         
-            # Only add files ...
-            if os.path.isfile(curband):
-                # convert to int May 2018 b/c I think Dropbox is truncating the
-                # precision of the modify time to seconds when I transfer files
-                # via rsync.
-                bandlist[f] = int(os.path.getmtime(curband))
-                
-        self.bandlist = bandlist  # remember our band list
+        with Span('store.scan') as span:
+            entries = ScanBands(self.bands)
+            table = None if entries is None else C_BandTable.FromEntries(entries)
+            span.add(bands=len(table) if table is not None else 0)
+        
+        return self.set_bundle_bands(table)
+
+    def set_bundle_bands(self, table):
+        """Initialize the band table from a C_BandTable. This lets the caller scan
+        several stores at once and then hand each store its results. Returns -1 if
+        the bands directory didn't exist (table is None)."""
+
+        # make sure the path existed, otherwise bail now ...
+        if table is None: return -1
+
+        # convert to int May 2018 b/c I think Dropbox is truncating the
+        # precision of the modify time to seconds when I transfer files
+        # via rsync. (The table keeps nanoseconds, the diff compares seconds.)
+        self.bandtable = table      # remember our band table
+        self.bandlist = None        # getBandDict() builds this if someone asks
         
-        # print("%s"%self.bands,bandlist)
+        return 0
+
+class C_ObjectVaultStore(C_VaultStore):
+    """
+    A vault store in an object store, e.g. s3://bucket/vaults (see ev.objectstore).
+    The layout is the same as in a directory, with keys in place of paths:
+    VAULT/VAULT.sparsebundle/bands/BAND and so on, plus the band index, VAULT.evindex.
+    The get*() paths are URLs, for the messages and the transfer journal; nothing
+    opens them. The sync engine for these is ev.objectsync.
+    """
+    objectstore = True
     
+    def __init__(self,url,vaultname):
+        from hashlib import sha1
+        from ev.objectstore import OpenBackend, C_BandIndex
+        
+        self.url = url.rstrip('/')
+        self.backend, prefix = OpenBackend(self.url, C_EVDefaults().ObjectStore)
+        
+        self.path = self.url + '/' + vaultname
+        self.bundlepath = self.path + '/' + vaultname + '.sparsebundle'
+        self.plist = self.bundlepath + '/Info.plist'
+        self.bands = self.bundlepath + '/bands'
+        self.bandtable = None
+        self.bandlist = None
+        
+        self.vaultkey = prefix + vaultname
+        
+        # Bands this process wrote since the last load: name -> (size, mtime_ns, etag),
+        # so the next load doesn't have to stat them to find their mtimes
+        self.written = {}
+        
+        self.cachekey = '%s-%s' % (vaultname, sha1(self.bands.encode('utf-8')).hexdigest()[:16])
+        self.manifest = C_BandIndex(self.backend, self.vaultkey + '.evindex')
+        
+    def getKey(self, path):
+        """Returns the object key for one of the get*() URLs, or something under one"""
+        return self.vaultkey + path[len(self.path):]
+        
+    def getRoot(self):
+        return self.url
+        
+    def Online(self):
+        return self.backend.Online()
+        
+    def HasBands(self):
+        return bool(self.backend.List(self.getKey(self.bands) + '/')[0])
+        
+    def Validate(self):
+        """Raise a VaultError unless the sparsebundle's Info.plist is in the store"""
+        try:
+            info = self.backend.Stat(self.getKey(self.plist))
+        except OSError as e:
+            raise VaultError(1, "I can't reach '%s': %s" % (self.url, e))
+            
+        if info is None:
+            raise VaultError(3, "This --> '%s', doesn't look like a sparsebundle to me..." % self.plist)
+            
         return 0
+        
+    def ModifyTime(self):
+        """Returns when the bands last changed, as far as the store can tell, i.e.
+        when the band index was written (or the Info.plist, if there's no index)"""
+        for key in (self.manifest.key, self.getKey(self.plist)):
+            info = self.backend.Stat(key)
+            if info is not None:
+                return info.modified_ns / 1000000000
+        return 0
+        
+    def Written(self, name, size, mtime_ns, etag):
+        """Remember a band the sync engine just wrote (see the written attribute)"""
+        self.written[name] = (size, mtime_ns, etag)
+        
+    def BandsState(self):
+        """There's nothing to stat that changes with the bands, so always None"""
+        return None
+        
+    def getAllocated(self, names):
+        """Objects aren't sparse, so this is the total size of the bands called names"""
+        sizes = {entry.name: entry.size for entry in self.bandtable.Entries()} if self.bandtable is not None else {}
+        return sum(sizes.get(name, 0) for name in names)
+        
+    def getDiskUsage(self):
+        """Objects aren't sparse, so both numbers are the total size of the bands"""
+        total = sum(info.size for page in self.backend.ListAll(self.getKey(self.bands) + '/') for info in page)
+        return total, total
+        
+    def load_bundle_bands(self, use_manifest=True):
+        """Load the bands from the object store: a paged listing, with the mtimes
+        from the band index (see ev.objectstore.ListBands()). The index is rewritten
+        if anything had to be stat'ed, so the next load doesn't have to.
+        
+        use_manifest - Use the band index. False stats every band."""
+        from ev.objectstore import ListBands
+        from ev.bandtable import C_BandTable
+        from ev.spans import Span
+        
+        with Span('store.list') as span:
+            index = self.manifest.Load() if use_manifest else None
+            written, self.written = self.written, {}
+            entries, stats = ListBands(self.backend, self.getKey(self.bands) + '/', index, written)
+            table = None if entries is None else C_BandTable.FromEntries(entries)
+            span.add(bands=len(table) if table is not None else 0, pages=stats['pages'], stated=stats['stated'])
+            
+        if table is not None and (index is None or stats['stated'] or written or stats['listed'] != len(index)):
+            self.manifest.Save(table)
+            
+        return self.set_bundle_bands(table)
+
+def OpenVaultStore(path, vaultname):
+    """Returns the C_VaultStore for vaultname at path, which can be a directory or
+    an object store URL (see C_ObjectVaultStore)"""
+    from ev.objectstore import IsObjectURL
+    
+    if IsObjectURL(path):
+        return C_ObjectVaultStore(path, vaultname)
+        
+    return C_VaultStore(path, vaultname)
+
+def LocalVolumes(vaultnames):
+    """Returns a dictionary of LOCAL sparsebundle path -> mount point (or None) for
+    each of vaultnames, from a single hdiutil info. Pass it to C_EncryptedVault as
+    volumes when running a verb on several vaults (see ev.batch)."""
+    from ev.hdiinfo2 import MountedVolumes
+    
+    path = C_EVDefaults().LocalStorePath()
+    
+    return MountedVolumes([C_VaultStore(path, vaultname).getBundlePath() for vaultname in vaultnames])
 
 
 class C_EncryptedVault:
@@ -258,32 +680,74 @@ class C_EncryptedVault:
     analysis on the two vaults to help determine which is the most current, etc. This
     implementation still needs work.
     """
-    def __init__(self,vaultname,message=DefaultMessageHandler):
+    def __init__(self,vaultname,message=DefaultMessageHandler,records=None,spans=None,needs=None,volumes=None):
         """Constructor for the C_EncryptedVault class. Initialize the
         variables that we need to have in order for the class to
         operate:
         
         vaultname - Name of the vault
         message - A function that is called with a string to print various status messages
+        records - Optional function that is called with a dictionary for each structured
+                  record (band differences, state) that a verb produces
+        spans - Optional function that is called with (name, seconds, counts) as each
+                phase of the work finishes (see ev.spans). It's installed for the
+                whole process, not just this vault.
+        needs - The stores that have to be valid, 'local' and/or 'remote' (both by
+                default). The verb registry (see ev.verbs) says what each verb needs.
+        volumes - Optional dictionary of sparsebundle path -> mount point from
+                  LocalVolumes(), so a batch of vaults asks hdiutil once instead of
+                  once per vault. Without it (or if it doesn't have this vault),
+                  mounted_volume() asks hdiutil itself.
         """
+        from ev.spans import Span, SetSpanHook
+        
+        if spans is not None:
+            SetSpanHook(spans)
         
         evdefs = C_EVDefaults()
         self.vaultname = vaultname
-        self.local = C_VaultStore(evdefs.LocalStorePath(),vaultname)
-        self.remote = C_VaultStore(evdefs.RemoteStorePath(),vaultname)
+        self.local = C_VaultStore(evdefs.LocalStorePath(),vaultname,inplace=True)
+        self.remote = OpenVaultStore(evdefs.RemoteStorePath(),vaultname)
+        
+        # Every place backup() writes to; self.remote is always the first one
+        self.replicastores = [self.remote] + [OpenVaultStore(path,vaultname)
+                                         for path in evdefs.ReplicaStorePaths()[1:]]
         
         self.msgout = message
+        self.recordout = records
+        self.volumes = volumes
         self.valid = False
         
-        if self.validate_vault_info(self.local): return
+        # Runs hdiutil and rsync (see ev.runner). C_AsyncVault swaps in one that runs
+        # them in its event loop.
+        self.runner = None
+        
+        # For the metrics (see ev.metrics): bytes the verb wrote, and the band counts,
+        # if it compared the stores
+        self.transferred = 0
+        self.throughput = None      # (bytes, bands, seconds) of the last transfer, see ev.plan
+        self.bandstate = None
         
-        if self.validate_vault_info(self.remote): return
+        # With the versioned layout, there's no REMOTE sparsebundle, just the store
+        self.versioned = evdefs.Versioned()
+        
+        if self.versioned and self.remote.objectstore:
+            raise VaultError(12, "The versioned layout needs RemotePath to be a directory, not '%s'" % self.remote.getRoot())
+        
+        with Span('vault.validate'):
+            for which in needs or ('local', 'remote'):
+                if which == 'remote' and self.versioned:
+                    continue
+                if self.validate_vault_info(getattr(self, which)): return
         
         self.valid = True
         
     def validate_vault_info(self,which):
         """Validate vault information."""
         
+        if which.objectstore:
+            return which.Validate()
+            
         # make sure the path exists, otherwise bail now ...
         if not os.path.isdir(which.getPath()):
             raise VaultError(1, "The path you supplied isn't a directory '%s'" % which.getPath())
@@ -297,13 +761,73 @@ class C_EncryptedVault:
         return 0
         
     def lookup(self,verb):
-        """This will look up a method, but it's not implemented right, because it should
-        make sure it exists first, and just be smarter about it.
+        """This will look up a method. It doesn't check that it's a verb; the callers
+        look it up in the verb registry first (see ev.verbs).
         
-        @TODO: Make this less dumb.
+        The verb that comes back updates the metrics file when it's done (see
+        export_metrics()), if it's one that changes the vault. The ones that only look
+        (about, diff, ...) don't, so polling a vault's status doesn't take the metrics
+        lock and write two files every time.
         """
-        return getattr(self, verb)
+        from ev.verbs import Lookup
+        
+        method = getattr(self, verb)
+        spec = Lookup(verb)
+        
+        if verb in NO_METRICS_VERBS or not callable(method) or spec is None or not spec.exclusive:
+            return method
+            
+        def run(*args):
+            result = 'error'
+            try:
+                rc = method(*args)
+                if rc == 0:
+                    result = 'ok'
+                return rc
+            finally:
+                self.export_metrics(verb, result)
+                
+        return run
+        
+    def export_metrics(self, verb=None, result=None):
+        """Count verb (unless it's None) and rewrite the metrics file of this vault (see
+        ev.metrics). This never fails the verb; the metrics are only a report."""
+        path = C_EVDefaults().MetricsPath
+        if not path:
+            return None
+            
+        from ev.metrics import C_VaultMetrics
+        
+        try:
+            # Only read the plist; what changes on every verb goes to the metrics state
+            vault = C_EVPlist(self.vaultname)
+            state = vault.MetricsState()
+            state.Record(verb, result, verb if verb in ('backup', 'restore') else None,
+                         self.transferred, self.bandstate)
+            
+            return C_VaultMetrics(self.vaultname, vault, state).Write(path)
+        except (OSError, ValueError) as e:
+            self.msgout("couldn't write the metrics to %s: %s" % (path, e))
+            return None
 
+    def mounted_volume(self):
+        """Returns the mount point of the LOCAL volume, or None if it isn't mounted"""
+        bundle = self.local.getBundlePath()
+        
+        if self.volumes is not None and bundle in self.volumes:
+            return self.volumes[bundle]
+            
+        from ev.hdiinfo2 import MountedVolume
+        
+        return MountedVolume(bundle)
+        
+    def forget_volumes(self):
+        """Call this after attaching or detaching the image"""
+        from ev.hdiinfo2 import Invalidate
+        
+        Invalidate()
+        self.volumes = None
+        
     def localModifyTime(self):
         """Returns the last modified time of the LOCAL vault sparsebundle DIRECTORY.
         
@@ -320,19 +844,91 @@ class C_EncryptedVault:
         """
         if not self.valid: return -1
         
+        if self.versioned:
+            import datetime
+            
+            version = self.version_store().Load(self.vaultname)
+            return datetime.datetime.fromisoformat(version['created']).timestamp() if version else 0
+            
+        if self.remote.objectstore:
+            return self.remote.ModifyTime()
+        
         return os.path.getmtime(self.remote.getBands())
         
+    def load_bands(self):
+        """Scan the LOCAL and REMOTE bands directories at the same time, and load the
+        results into each store (see C_VaultStore.load_bundle_bands())."""
+        from ev.bandscan import ScanConcurrently
+        from ev.spans import Span
+
+        # While the LOCAL image is mounted, bands are written in place, and the
+        # manifest can't see that. So do a full scan of the LOCAL store in that case.
+        local_manifest = not C_EVPlist(self.vaultname).Mounted()
+
+        with Span('vault.load_bands'):
+            if self.versioned:
+                # REMOTE is the latest version, which is just a file to read
+                versions = self.version_store()
+                ScanConcurrently([lambda: self.local.load_bundle_bands(local_manifest),
+                                  lambda: self.remote.set_bundle_bands(versions.BandTable(versions.Load(self.vaultname)))])
+                return
+                
+            ScanConcurrently([lambda: self.local.load_bundle_bands(local_manifest),
+                              self.remote.load_bundle_bands])
+
+    def diffBands(self, kinds=None):
+        """Generator that compares the bands in the two versions of the vault, and
+        returns a BandDiff record (see ev.bandtable) for each band, lazily.
+        
+        kinds - Only return these kinds of records (see ev.bandtable.DIFF_KINDS).
+                Defaults to everything, including the bands that are the same.
+        """
+        from ev.bandtable import DiffBandTables
+        
+        self.load_bands()
+        
+        self.banddiff = DiffBandTables(self.local.getBandTable(), self.remote.getBandTable())
+        
+        yield from self.banddiff.Records(kinds)
+        
+    def summaries(self):
+        """Returns the (LOCAL, REMOTE) Merkle summaries (see ev.merkle), or None if
+        either one isn't there or can't be trusted right now."""
+        if self.versioned or C_EVPlist(self.vaultname).Mounted():
+            return None
+            
+        local = self.local.getManifest().Summary()
+        remote = self.remote.getManifest().Summary() if local is not None else None
+        
+        return (local, remote) if remote is not None else None
+        
     def analyzeBands(self):
         """This performs an analysis on the bands in the two versions of the vault.
-        
-        @TODO: I need to make this much smarter, and probably use objects or some other
-        type that makes more sense for this application.
+        It's a cheap consumer of the band diff (see diffBands()); it only counts the
+        records, it doesn't build them.
         """
-        self.local.load_bundle_bands()
-        self.remote.load_bundle_bands()
+        from ev.spans import Span
         
-        localbands = self.local.getBandDict()
-        remotebands = self.remote.getBandDict()
+        with Span('vault.merkle'):
+            summaries = self.summaries()
+            insync = summaries is not None and not summaries[0].Compare(summaries[1])
+            
+        if insync:
+            # Same Merkle root, so every band is the same, and there's no need to
+            # look at a single one of them
+            count = summaries[0].count
+            self.bandstate = {'localcount': count, 'remotecount': count, 'samecount': True,
+                              'olderbands': 0, 'newerbands': 0, 'samebands': count,
+                              'remoteonlybands': 0, 'sizechangedbands': 0}
+            return self.bandstate
+        
+        # Only now, the fast path doesn't need it (or numpy)
+        from ev.bandtable import DiffBandTables
+        
+        self.load_bands()
+        
+        localbands = self.local.getBandTable()
+        remotebands = self.remote.getBandTable()
         
         bandstate = {}
         
@@ -340,34 +936,531 @@ class C_EncryptedVault:
         bandstate['remotecount'] = len(remotebands)
         bandstate['samecount'] = len(localbands) == len(remotebands)
 
-        olderbands = newerbands = samebands = 0
+        with Span('vault.diff', bands=len(localbands) + len(remotebands)):
+            self.banddiff = DiffBandTables(localbands, remotebands)
+            counts = self.banddiff.Counts()
         
-        import time
+        # A band that only exists locally counts as newer, same as it always has
+        bandstate['olderbands'] = counts['older']
+        bandstate['newerbands'] = counts['newer'] + counts['localonly']
+        bandstate['samebands'] = counts['same']
+        bandstate['remoteonlybands'] = counts['remoteonly']
+        bandstate['sizechangedbands'] = counts['sizechanged']
         
-        # print("%5s-%s" % (justname,time.strftime("%c",time.gmtime(bandlist[f]))))
-                
-        keylist = list(localbands.keys())
-        keylist.sort()
-        for item in keylist:
-            if not item in remotebands:
-                newerbands += 1
-            elif localbands[item] == remotebands[item]:
-                samebands += 1
-            elif localbands[item] < remotebands[item]:
-                olderbands += 1
-                print("local[%s:%f] < remote[%s:%f]" % (item,localbands[item],item,remotebands[item]))
-            elif localbands[item] > remotebands[item]:
-                print("local[%s:%f] > remote[%s:%f]" % (item,localbands[item],item,remotebands[item]))
-                newerbands += 1
-                
-        bandstate['olderbands'] = olderbands
-        bandstate['newerbands'] = newerbands
-        bandstate['samebands'] = samebands
+        self.bandstate = bandstate
         
         return bandstate
         
+    def usage(self):
+        """Report the apparent size and the allocated (on disk) size of the bands in
+        both versions of the vault."""
+        if not self.valid:
+            self.msgout("Not to be a negative nancy, but I see no reason to continue...")
+            return 1
+            
+        for label, store in (('LOCAL', self.local), ('Dropbox', self.remote)):
+            if self.versioned and store is self.remote:
+                blobs, allocated = self.version_store().Usage()
+                self.msgout("Dropbox version store has %d blob(s) for all vaults, using %d bytes on disk" % (blobs, allocated))
+                if self.recordout is not None:
+                    self.recordout({'kind': 'usage', 'vault': self.vaultname, 'store': label,
+                                    'blobs': blobs, 'allocated': allocated})
+                continue
+                
+            apparent, allocated = store.getDiskUsage()
+            
+            self.msgout("%s bands are %d bytes, using %d bytes on disk (%.1f%%)" %
+                        (label, apparent, allocated, 100.0 * allocated / apparent if apparent else 0.0))
+            
+            if self.recordout is not None:
+                self.recordout({'kind': 'usage', 'vault': self.vaultname, 'store': label,
+                                'apparent': apparent, 'allocated': allocated})
+                
+        return 0
+        
+    def diff(self):
+        """Report every band that differs between LOCAL and Dropbox. If the object was
+        given a record handler, each difference goes to it as a dictionary (that's how
+        the JSON-lines output mode works), otherwise it's sent to the message handler."""
+        if not self.valid:
+            self.msgout("Not to be a negative nancy, but I see no reason to continue...")
+            return 1
+            
+        from ev.bandtable import DIFF_KINDS, DIFF_SAME
+        
+        differences = 0
+        
+        for record in self.diffBands([kind for kind in DIFF_KINDS if kind != DIFF_SAME]):
+            differences += 1
+            
+            if self.recordout is not None:
+                self.recordout(dict(record._asdict(), vault=self.vaultname))
+            else:
+                self.msgout("%-12s %8s local[%s:%s] remote[%s:%s]" % (record.kind, record.band,
+                            record.local_size, record.local_mtime_ns,
+                            record.remote_size, record.remote_mtime_ns))
+                
+        self.msgout("%d band(s) differ" % differences)
+        
+        return 0
+        
+    def plan(self):
+        """Work out exactly what a backup and a restore would do right now (the bands
+        and other files each would copy and delete, and how many bytes), and about how
+        long each would take, going by the past transfers of this vault (see ev.plan).
+        The plan is saved, and a backup or restore that runs before anything changes
+        does just that, without scanning Dropbox or diffing again (LOCAL is always
+        rescanned, to tell if it changed, see ev.manifest)."""
+        if not self.valid:
+            self.msgout("Not to be a negative nancy, but I see no reason to continue...")
+            return 1
+            
+        if self.versioned:
+            self.msgout("A backup to the versioned store always writes a new version, so there's nothing to plan")
+            return 1
+            
+        from ev.bandsync import SyncLists
+        from ev.bandtable import C_BandTable, DiffBandTables
+        from ev.objectsync import MetadataChanges
+        from ev.plan import C_TransferPlan, FormatDuration
+        
+        vault = C_EVPlist(self.vaultname)
+        
+        # Take the state first, so a change while we scan makes the plan stale, not wrong
+        state = {'local': None if vault.Mounted() else self.local.BandsState(),
+                 'remote': self.remote.BandsState()}
+        
+        self.load_bands()
+        
+        empty = C_BandTable.FromEntries([])
+        policy = self.transfer_scheduler().policy
+        plan = {'vault': self.vaultname, 'state': state}
+        
+        for direction, src, dst in (('backup', self.local, self.remote), ('restore', self.remote, self.local)):
+            if src.getBandTable() is None:
+                self.msgout("%s: there are no bands in %s, so there's nothing to %s" % (direction, src.getBands(), direction))
+                continue
+                
+            copy, delete = SyncLists(DiffBandTables(src.getBandTable(), dst.getBandTable() or empty))
+            metadata, stale = MetadataChanges(src, dst)
+            
+            nbytes = sum(size for name, size in copy)
+            allocated = src.getAllocated([name for name, size in copy])
+            written = allocated + sum(size for srcpath, dstpath, size in metadata)
+            
+            model = vault.Throughput(direction)
+            seconds = model.Estimate(written, len(copy) + len(delete))
+            if policy.bytes_per_sec and seconds is not None:
+                seconds = max(seconds, written / policy.bytes_per_sec)
+                
+            plan[direction] = {'src': src.getPath(), 'dst': dst.getPath(),
+                               'copy': [list(c) for c in copy], 'delete': delete,
+                               'bytes': nbytes, 'allocated': allocated,
+                               'metadata': [[dstpath, size] for srcpath, dstpath, size in metadata],
+                               'stale': stale, 'seconds': seconds}
+            
+            if seconds is None:
+                eta = "no past %s to estimate the time from" % direction
+            else:
+                eta = "about %s (going by %d past %s(s))" % (FormatDuration(seconds), len(model.samples), direction)
+                
+            self.msgout("%s: copy %d band(s), %d bytes (%d on disk), and %d other file(s), delete %d band(s) and %d other file(s); %s" %
+                        (direction, len(copy), nbytes, allocated, len(metadata), len(delete), len(stale), eta))
+            
+            if self.recordout is not None:
+                self.recordout({'kind': 'plan', 'vault': self.vaultname, 'direction': direction,
+                                'copy': len(copy), 'bytes': nbytes, 'allocated': allocated,
+                                'metadata': len(metadata), 'delete': len(delete), 'stale': len(stale),
+                                'seconds': seconds})
+                
+        saved = C_TransferPlan(vault.PlanPath())
+        saved.Save(plan)
+        
+        if None in state.values():
+            self.msgout("saved the plan to %s, but a backup or restore will scan anyway, since there's no telling if %s changes "
+                        "before then (it's mounted, in an object store, or was changed in the last few seconds)" %
+                        (saved.path, 'LOCAL' if state['local'] is None else 'Dropbox'))
+        else:
+            self.msgout("saved the plan to %s, a backup or restore will use it if nothing changes before then" % saved.path)
+            
+        return 0
+        
+    def verify(self, workers=None):
+        """Compare the contents of the bands that are on both sides, not just their
+        times and sizes (see ev.verify). Hashes are cached, so only the bands that
+        changed since the last verify get read. With the versioned layout, LOCAL is
+        checked against the hashes in the latest version."""
+        if not self.valid:
+            self.msgout("Not to be a negative nancy, but I see no reason to continue...")
+            return 1
+            
+        from ev.verify import HashStore
+        
+        if self.remote.objectstore:
+            self.msgout("verify reads the bands on both sides, and I can't do that with %s yet" % self.remote.getRoot())
+            return 1
+            
+        self.load_bands()
+        
+        if self.local.getBandTable() is None:
+            self.msgout("There are no bands in %s, I'm not going to verify that!" % self.local.getBands())
+            return 1
+            
+        localnames = {e.name for e in self.local.getBandTable().Entries()}
+        remotenames = {e.name for e in self.remote.getBandTable().Entries()}
+        common = localnames & remotenames
+        
+        workers = int(workers) if workers is not None else None
+        
+        if self.versioned:
+            version = self.version_store().Load(self.vaultname)
+            (localhashes,), stats = HashStore([self.local], common, workers)
+            remotehashes = {name: version['bands'][name][0] for name in common}
+        else:
+            (localhashes, remotehashes), stats = HashStore([self.local, self.remote], common, workers)
+            
+        # A band that's newer or older on one side is supposed to be different. It's
+        # the ones the diff calls the same that had better match.
+        from ev.bandtable import DiffBandTables, DIFF_SAME
+        
+        same = {r.band for r in DiffBandTables(self.local.getBandTable(), self.remote.getBandTable()).Records([DIFF_SAME])}
+        
+        mismatches = changed = missing = 0
+        for name in sorted(common, key=lambda n: (len(n), n)):
+            if name not in localhashes or name not in remotehashes:
+                # A sync deleted or replaced it while we were looking (see ev.verify)
+                missing += 1
+                self.msgout("MISSING  %8s went away from %s while I was verifying it" %
+                            (name, 'LOCAL' if name not in localhashes else 'Dropbox'))
+                if self.recordout is not None:
+                    self.recordout({'kind': 'missing', 'vault': self.vaultname, 'band': name,
+                                    'store': 'local' if name not in localhashes else 'remote'})
+                continue
+                
+            if localhashes[name] == remotehashes[name]:
+                continue
+                
+            if name not in same:
+                changed += 1
+                continue
+                
+            mismatches += 1
+            self.msgout("MISMATCH %8s local %s remote %s" % (name, localhashes[name], remotehashes[name]))
+            
+            if self.recordout is not None:
+                self.recordout({'kind': 'mismatch', 'vault': self.vaultname, 'band': name,
+                                'local': localhashes[name], 'remote': remotehashes[name]})
+                
+        rate = stats['bytes'] / stats['seconds'] / (1 << 20) if stats['seconds'] else 0.0
+        
+        self.msgout("verified %d band(s): hashed %d (%d bytes, %.1f MB/s), %d from the cache, in %.2f seconds" %
+                    (len(common), stats['hashed'], stats['bytes'], rate, stats['cached'], stats['seconds']))
+        
+        if len(localnames) != len(common) or len(remotenames) != len(common):
+            self.msgout("%d band(s) are only on one side, use the 'diff' verb to see them" %
+                        (len(localnames) + len(remotenames) - 2 * len(common)))
+            
+        if changed:
+            self.msgout("%d band(s) differ because one side is newer, a backup or restore takes care of those" % changed)
+            
+        if missing:
+            self.msgout("%d band(s) went away while I was verifying, run it again when nothing is syncing" % missing)
+            
+        self.msgout("%d band(s) have the same time and size on both sides but don't match" % mismatches)
+        
+        if self.recordout is not None:
+            self.recordout(dict(stats, kind='verify', vault=self.vaultname, bands=len(common),
+                                changed=changed, mismatches=mismatches, missing=missing))
+            
+        return 1 if mismatches or missing else 0
+        
+    def transfer_journal(self, replica=None):
+        """Returns the C_TransferJournal for this vault (see ev.journal), or for the
+        backups to one of the extra replicas"""
+        from ev.journal import C_TransferJournal
+        
+        key = None if replica is None or replica is self.remote else replica.cachekey
+        
+        return C_TransferJournal(C_EVPlist(self.vaultname).JournalPath(key))
+        
+    def dirty_journal(self):
+        """Returns the C_DirtyJournal for this vault (see ev.watcher)"""
+        from ev.watcher import C_DirtyJournal
+        
+        return C_DirtyJournal(C_EVPlist(self.vaultname).DirtyPath())
+        
+    def saved_plan(self, direction, src, dst):
+        """Returns the (copy, delete) lists for a backup or restore from the plan the
+        'plan' verb saved, if neither side changed since, or None. Either way, the
+        plan is thrown away, since it won't be any good after this transfer."""
+        from ev.plan import C_TransferPlan
+        
+        if self.versioned:
+            return None
+            
+        saved = C_TransferPlan(C_EVPlist(self.vaultname).PlanPath())
+        
+        state = {'local': self.local.BandsState(), 'remote': self.remote.BandsState()}
+        steps, reason = saved.Steps(direction, src.getPath(), dst.getPath(), state)
+        
+        saved.Discard()
+        
+        if reason is not None:
+            self.msgout("can't use the saved plan, %s, so scanning everything" % reason)
+        elif steps is not None:
+            self.msgout("using the saved plan, nothing changed since it was made")
+            
+        return steps
+        
+    def dirty_plan(self):
+        """Returns the (copy, delete) lists for a backup, made from the dirty band
+        journal without scanning Dropbox or diffing, or None if the journal can't be
+        used. LOCAL's state is checked too, which is one scan of its bands."""
+        if self.versioned or self.remote.objectstore:
+            # The journal is based on the stat of the Dropbox bands directory
+            return None
+            
+        try:
+            names, reason = self.dirty_journal().State(os.stat(self.remote.getBands()), self.local.BandsState())
+        except FileNotFoundError:
+            names, reason = None, "there's no Dropbox bands directory"
+            
+        if names is None:
+            self.msgout("can't use the dirty band journal, %s, so scanning everything" % reason)
+            return None
+            
+        copy = []
+        delete = []
+        
+        for name in names:
+            try:
+                copy.append((name, os.stat(os.path.join(self.local.getBands(), name)).st_size))
+            except FileNotFoundError:
+                delete.append(name)
+                
+        self.msgout("the dirty band journal says %d band(s) were written since the last backup" % len(names))
+        
+        return copy, delete
+        
+    def transfer_scheduler(self):
+        """Returns the C_TransferScheduler for this vault's transfer policy"""
+        from ev.scheduler import C_TransferPolicy, C_TransferScheduler
+        
+        return C_TransferScheduler(C_TransferPolicy.FromDict(C_EVDefaults().TransferPolicy,
+                                                             C_EVPlist(self.vaultname).TransferPolicy()))
+        
+    def policy(self, *settings):
+        """Show or change the transfer policy of this vault (see ev.scheduler). Pass
+        settings like workers=2 bytes_per_sec=20M iops=200 idle=yes to change them,
+        or 'reset' to go back to the defaults."""
+        from ev.scheduler import C_TransferPolicy, POLICY_KEYS
+        
+        vault = C_EVPlist(self.vaultname)
+        overrides = dict(vault.TransferPolicy())
+        
+        for setting in settings:
+            if setting == 'reset':
+                overrides = {}
+                continue
+                
+            key, sep, value = setting.partition('=')
+            if not sep or key not in POLICY_KEYS:
+                self.msgout("I don't understand '%s', try one of: %s (as key=value)" % (setting, ', '.join(POLICY_KEYS)))
+                return 1
+                
+            overrides[key] = value
+            
+        # Make sure it all parses before saving it, and save it normalized
+        try:
+            policy = C_TransferPolicy.FromDict(C_EVDefaults().TransferPolicy, overrides)
+        except ValueError as e:
+            self.msgout("That isn't a valid policy: %s" % e)
+            return 1
+            
+        if settings:
+            normalized = policy.ToDict()
+            vault.SetTransferPolicy({k: normalized[k] for k in overrides})
+            vault.WritePlist()
+            
+        self.msgout("transfer policy: %s" % policy)
+        
+        return 0
+        
+    def run_command(self, argv):
+        """Run an external command (hdiutil, rsync) with the vault's C_CommandRunner,
+        which streams its output to the message handler as progress events. Returns
+        the exit code. A timeout or cancellation is raised as a VaultError."""
+        from ev.runner import C_CommandRunner, CommandCancelled, CommandTimeout
+        from ev.spans import Span
+        
+        if self.runner is None:
+            records = None
+            if self.recordout is not None:
+                records = lambda event: self.recordout(dict(event, vault=self.vaultname))
+            self.runner = C_CommandRunner(self.msgout, records, timeout=C_EVDefaults().CommandTimeout)
+            
+        try:
+            with Span('command.' + os.path.basename(argv[0])):
+                return self.runner.Run(argv)
+        except CommandTimeout as e:
+            raise VaultError(10, str(e))
+        except CommandCancelled:
+            raise VaultError(11, '%s was cancelled' % argv[0])
+        
+    def sync_stores(self, src, dst, direction, on_commit=None):
+        """Make the dst C_VaultStore a mirror of the src C_VaultStore. Normally this is
+        done by the band-level sync engine (see ev.bandsync), which only copies the bands
+        the diff says are different. If C_EVDefaults says so, rsync is used instead.
+        
+        direction - 'backup', 'restore', etc. Recorded in the transfer journal, so an
+                    interrupted transfer is only resumed by the same kind of transfer.
+        on_commit - Called once the journal shows the transfer is complete, before the
+                    journal is thrown away.
+        
+        Returns 0 if all went well."""
+        
+        # rsync can't reach an object store, so those always use the band sync engine
+        objects = src.objectstore or dst.objectstore
+        
+        if C_EVDefaults().SyncEngine == 'rsync' and not objects:
+            rc = self.run_command(['rsync', '-va', '--delete', '--progress', src.getPath() + '/', dst.getPath()])
+            if rc == 0 and on_commit is not None:
+                on_commit()
+            return rc
+        
+        from ev.bandsync import C_BandSync, SyncLists
+        from ev.bandtable import C_BandTable, DiffBandTables
+        from ev.spans import Span
+        
+        journal = self.transfer_journal()
+        pending = journal.Pending()
+        
+        if pending is not None:
+            removed = journal.Cleanup(pending)
+            if removed:
+                self.msgout("cleaned up %d half-written file(s) from the last %s" % (removed, pending['direction']))
+                
+            if (pending['direction'], pending['src'], pending['dst']) != (direction, src.getPath(), dst.getPath()):
+                self.msgout("forgetting about the unfinished %s, since this is a %s" % (pending['direction'], direction))
+                journal.Discard()
+                pending = None
+        
+        plan = None
+        if pending is None and (src, dst) in ((self.local, self.remote), (self.remote, self.local)):
+            plan = self.saved_plan(direction, src, dst)
+            
+        if plan is None and pending is None and direction == 'backup' and (src, dst) == (self.local, self.remote):
+            plan = self.dirty_plan()
+            
+        if plan is not None:
+            copy, delete = plan
+            
+            self.msgout("syncing %d band(s), deleting %d band(s)" % (len(copy), len(delete)))
+            
+            journal.Begin(direction, src.getPath(), dst.getPath(), copy, delete)
+        else:
+            if (src, dst) in ((self.local, self.remote), (self.remote, self.local)):
+                self.load_bands()
+            else:
+                # Something other than our two stores, e.g. a snapshot, so the manifests
+                # can't be trusted for either side.
+                src.load_bundle_bands(False)
+                dst.load_bundle_bands(False)
+            
+            if src.getBandTable() is None:
+                self.msgout("There are no bands in %s, I'm not going to sync that!" % src.getBands())
+                return 1
+            
+            dsttable = dst.getBandTable()
+            if dsttable is None:
+                dsttable = C_BandTable.FromEntries([])
+            
+            with Span('sync.plan', bands=len(src.getBandTable()) + len(dsttable)):
+                copy, delete = SyncLists(DiffBandTables(src.getBandTable(), dsttable))
+            
+            if pending is not None:
+                # Either side may have changed since the transfer was interrupted, so
+                # that's a fresh diff, and the journal only tells us which bands we
+                # don't need to copy again: the ones it copied, if both sides still
+                # have the size and mtime it copied (see ev.journal)
+                done = pending['done']
+                srcnow = {e.name: (e.size, e.mtime_ns) for e in src.getBandTable().Entries() if e.name in done}
+                dstnow = {e.name: (e.size, e.mtime_ns) for e in dsttable.Entries() if e.name in done}
+                copy = [c for c in copy
+                        if c[0] not in done or not (srcnow.get(c[0]) == dstnow.get(c[0]) == tuple(done[c[0]]))]
+                self.msgout("resuming the unfinished %s: %d band(s) were already copied, %d left to copy, %d to delete" %
+                            (direction, len(pending['done']), len(copy), len(delete)))
+            else:
+                self.msgout("syncing %d band(s), deleting %d band(s)" % (len(copy), len(delete)))
+            
+            journal.Begin(direction, src.getPath(), dst.getPath(), copy, delete)
+        
+        scheduler = self.transfer_scheduler()
+        
+        try:
+            with Span('sync.transfer') as span:
+                if objects:
+                    from ev.objectsync import C_ObjectSync
+                    engine = C_ObjectSync(src, dst, self.msgout, journal=journal, scheduler=scheduler)
+                else:
+                    engine = C_BandSync(src, dst, self.msgout, delta=C_EVDefaults().DeltaTransfer,
+                                        journal=journal, scheduler=scheduler)
+                stats = engine.Run(copy, delete)
+                span.add(bands=stats['copied'] + stats['deleted'], bytes=stats['bytes'])
+            self.transferred += stats['bytes']
+            self.throughput = (stats['bytes'], stats['copied'] + stats['deleted'], stats['seconds'])
+        except OSError as e:
+            self.msgout("sync failed: %s (run it again to pick up where it left off)" % e)
+            return 1
+        finally:
+            journal.Close()
+        
+        self.msgout("copied %d band(s) and %d other file(s), %d bytes (%d apparent), deleted %d band(s) in %.2f seconds" %
+                    (stats['copied'], stats['metadata'], stats['bytes'], stats['apparent'],
+                     stats['deleted'], stats['seconds']))
+        
+        if stats['deltas']:
+            self.msgout("%d band(s) were sent as deltas, which saved writing %d bytes" %
+                        (stats['deltas'], stats['saved']))
+        
+        if not journal.Committed():
+            self.msgout("the transfer journal doesn't show a commit, so I'm not calling this done")
+            return 1
+        
+        if on_commit is not None:
+            on_commit()
+            
+        journal.Discard()
+        
+        # Bring the manifest and Merkle summary of dst up to date, while only the
+        # bands we just wrote need looking at
+        if dst in (self.local, self.remote):
+            dst.load_bundle_bands()
+            
+        self.rebase_dirty_journal(direction, src, dst)
+        
+        return 0
+        
+    def rebase_dirty_journal(self, direction, src, dst):
+        """After a transfer commits: if LOCAL and Dropbox are now the same, start the
+        dirty band journal over from here. If LOCAL was changed any other way (a
+        rollback, say), the journal is no good anymore."""
+        if (not self.versioned and not self.remote.objectstore and direction in ('backup', 'restore')
+            and {src, dst} == {self.local, self.remote}):
+            self.dirty_journal().Base(os.stat(self.remote.getBands()), self.local.BandsState())
+        elif dst is self.local:
+            self.dirty_journal().Discard()
+            
     def mount(self,ReadOnly=False):
-        """Ok, let's go mount the vault."""
+        """Ok, let's go mount the vault. ReadOnly comes from the command line as a
+        string, so it's parsed (see ev.verbs.ParseFlag()), not just tested."""
+        import kenl380.pylib as pylib
+        from ev.verbs import ParseFlag
+        
+        try:
+            ReadOnly = ParseFlag(ReadOnly)
+        except ValueError as e:
+            raise VaultError(13, "mount takes READONLY as yes or no: %s" % e)
         
         if not self.valid:
             raise VaultError(4,'The mount() method was invoked while object was in an invalid state.')
@@ -377,12 +1470,51 @@ class C_EncryptedVault:
         if( vault.Mounted() ):
             raise VaultError(5,'The vault is already mounted by %s' % vault.ComputerName())
         
-        command = 'hdiutil attach %s' % self.local.getBundlePath()
+        journal = self.transfer_journal()
+        pending = journal.Pending()
+        if pending is not None and pending['direction'] != 'backup':
+            raise VaultError(8,'The last %s of this vault never finished, run it again before mounting' % pending['direction'])
+        
+        command = ['hdiutil', 'attach', self.local.getBundlePath()]
         
-        if( ReadOnly ): command += " -readonly"
+        watching = False
+        
+        if( ReadOnly ): command.append("-readonly")
+        else:
+            # Bands are about to be written in place, so an unfinished backup's plan is no good,
+            # and neither is a saved one (see ev.plan)
+            journal.Discard()
+            
+            from ev.plan import C_TransferPlan
+            C_TransferPlan(vault.PlanPath()).Discard()
+            
+            # Start watching the bands before anything can write them
+            watching = self.start_watcher()
             
-        self.msgout('mounting encrypted vault: %s' % command)
-        rc = os.system(command)
+            # Hardlink snapshots share their bands with the vault, and hdiutil writes in place
+            stale = self.snapshots_object().MarkStale()
+            if stale:
+                self.msgout("%d hardlink snapshot(s) will no longer be usable after this mount" % stale)
+            
+        self.msgout('mounting encrypted vault: %s' % ' '.join(command))
+        try:
+            rc = self.run_command(command)
+        except VaultError:
+            # It may or may not have attached before it was stopped
+            self.forget_volumes()
+            self.local.getManifest().Invalidate()
+            if watching:
+                self.stop_watcher()
+            raise
+        
+        self.forget_volumes()
+        
+        # Bands are about to be written in place. The LOCAL manifest rescans every time
+        # anyway (see ev.manifest), but there's no point keeping one that's about to be wrong
+        self.local.getManifest().Invalidate()
+        
+        if rc != 0 and watching:
+            self.stop_watcher()
 
         if rc == 0:
             # Denote the object state.
@@ -400,6 +1532,45 @@ class C_EncryptedVault:
     def attach(self):
         return self.mount(True)     # Need a better way to do Read Only
         
+    def start_watcher(self):
+        """Start the dirty band watcher (see ev.watcher), if C_EVDefaults says to.
+        If not, or it won't start, the journal is thrown away, because nobody is
+        going to see the writes. Returns True if it's watching."""
+        from ev.watcher import StartWatcher
+        
+        evdefs = C_EVDefaults()
+        dirty = self.dirty_journal()
+        
+        if evdefs.WatchBands and dirty.Watcher() is None:
+            # What LOCAL looks like before this mount, so a change by anybody else
+            # since the base or the last watched mount shows (see ev.watcher)
+            dirty.Local(self.local.BandsState())
+            
+            pid = StartWatcher(self.local.getBands(), dirty, evdefs.WatchInterval)
+            if pid is not None:
+                self.msgout("watching the bands for changes (pid %d)" % pid)
+                return True
+                
+            self.msgout("the band watcher didn't start, so the next backup will scan everything")
+            
+        dirty.Discard()
+        return False
+        
+    def stop_watcher(self):
+        """Stop the dirty band watcher, if there is one"""
+        from ev.watcher import StopWatcher
+        
+        dirty = self.dirty_journal()
+        if dirty.Watcher() is None:
+            return
+            
+        if not StopWatcher(dirty):
+            self.msgout("the band watcher didn't stop cleanly, so the next backup will scan everything")
+            return
+            
+        # What LOCAL looks like with this mount's writes in it
+        dirty.Local(self.local.BandsState())
+        
     def backup(self):
         vault = C_EVPlist(self.vaultname)
         if vault.Mounted():
@@ -409,39 +1580,408 @@ class C_EncryptedVault:
         if not vault.NeedsBackup():
             self.msgout("According to my records, this vault doesn't need to be backed up...")
         
+        import kenl380.pylib as pylib
+        
         if vault.ComputerName() != pylib.COMPUTER:
             self.msgout("I don't think you should backup your copy since you didn't have it mounted RW")
             return 2
             
-        self.msgout("Backing up LOCAL (%s) to Dropbox (%s)..." % (self.local.getPath(),self.remote.getPath()))
-        rc = os.system("rsync -va --delete \"%s/\" \"%s\"" % (self.local.getPath(), self.remote.getPath()))
+        online = []
+        for replica in self.replicastores:
+            # The replica's root has to be there (i.e. the NAS or disk is mounted)
+            if replica.Online():
+                online.append(replica)
+            else:
+                self.msgout("replica %s is offline, skipping it" % replica.getPath())
+                vault.SetReplicaStatus(replica.getRoot(), {'status': 'offline'})
+        
+        import time
         
-        vault.SetNeedsBackup(False)
+        started = time.time()
+        
+        def committed():
+            # Only once the journal says every band made it
+            vault.SetNeedsBackup(False)
+            vault.SetLastSync('backup', time.time() - started, self.transferred)
+            if self.throughput is not None:
+                vault.AddThroughput('backup', *self.throughput)
+            vault.WritePlist()
+            
+        if self.versioned:
+            return self.versioned_backup(vault, committed)
+            
+        if online == [self.remote]:
+            self.msgout("Backing up LOCAL (%s) to Dropbox (%s)..." % (self.local.getPath(),self.remote.getPath()))
+            
+            rc = self.sync_stores(self.local, self.remote, 'backup', committed)
+            
+            self.record_replica(vault, self.remote, rc == 0, time.time() - started, self.transferred)
+            vault.WritePlist()
+            
+            return rc
+            
+        if not online:
+            self.msgout("None of the replicas are online, there's nowhere to back up to!")
+            vault.WritePlist()
+            return 1
+            
+        return self.fanout_backup(vault, online, committed)
+        
+    def version_store(self):
+        """Returns the C_VersionStore at RemotePath (see ev.versionstore)"""
+        from ev.versionstore import C_VersionStore
+        
+        return C_VersionStore(C_EVDefaults().RemoteStorePath(), self.msgout, self.transfer_scheduler())
+        
+    def versioned_backup(self, vault, on_commit):
+        """Add a new version of LOCAL to the versioned store"""
+        import kenl380.pylib as pylib
+        
+        versions = self.version_store()
+        
+        self.msgout("Backing up LOCAL (%s) as a new version in %s..." % (self.local.getPath(), versions.getPath()))
+        
+        if len(self.replicastores) > 1:
+            self.msgout("FYI, the extra replicas only get mirror backups, so they're skipped")
+        
+        self.local.load_bundle_bands()
+        if self.local.getBandTable() is None:
+            self.msgout("There are no bands in %s, I'm not going to back that up!" % self.local.getBands())
+            return 1
+            
+        try:
+            version, stats = versions.Backup(self.local, self.vaultname, computer=pylib.COMPUTER)
+        except OSError as e:
+            self.msgout("backup failed: %s (the blobs that made it will be reused next time)" % e)
+            return 1
+            
+        self.msgout("version %s: %d band(s), %d hashed, %d new blob(s), %d bytes written in %.2f seconds" %
+                    (version['name'], stats['bands'], stats['hashed'], stats['blobs'], stats['bytes'], stats['seconds']))
+        
+        self.transferred += stats['bytes']
+        on_commit()
+        
+        return 0
+        
+    def versions(self):
+        """List the backup versions of this vault in the versioned store"""
+        versions = self.version_store()
+        names = versions.Versions(self.vaultname)
+        
+        for name in names:
+            version = versions.Load(self.vaultname, name)
+            if version is None:
+                self.msgout("%s  (can't be read)" % name)
+                continue
+                
+            total = sum(size for digest, size, mtime_ns in version['bands'].values())
+            self.msgout("%s  %6d band(s) %14d bytes  from %s" % (name, len(version['bands']), total, version['computer']))
+            
+            if self.recordout is not None:
+                self.recordout({'kind': 'version', 'vault': self.vaultname, 'name': name,
+                                'created': version['created'], 'computer': version['computer'],
+                                'bands': len(version['bands']), 'bytes': total})
+                
+        self.msgout("%d version(s)" % len(names))
+        
+        return 0
+        
+    def gc(self, keep=None):
+        """Delete all but the newest 'keep' versions of this vault (C_EVDefaults.VersionKeep
+        if not given, 0 keeps them all), then delete the blobs no version of any vault
+        in the store needs anymore."""
+        keep = C_EVDefaults().VersionKeep if keep is None else int(keep)
+        versions = self.version_store()
+        
+        if keep > 0:
+            for name in versions.Prune(self.vaultname, keep):
+                self.msgout("deleted version %s" % name)
+                
+        try:
+            deleted, freed, kept = versions.Collect()
+        except OSError as e:
+            self.msgout("garbage collection failed: %s" % e)
+            return 1
+            
+        self.msgout("deleted %d unreferenced blob(s), freeing %d bytes; %d blob(s) kept" % (deleted, freed, kept))
+        
+        return 0
+        
+    def record_replica(self, vault, replica, ok, seconds, nbytes=None, error=None):
+        """Remember how the last backup to replica went, in the vault plist"""
+        import datetime
+        
+        status = {'status': 'ok' if ok else 'failed: %s' % (error or 'see log'), 'seconds': seconds}
+        if ok:
+            status['last-backup'] = datetime.datetime.now()
+        if nbytes is not None:
+            status['bytes'] = nbytes
+            
+        vault.SetReplicaStatus(replica.getRoot(), status)
+        
+    def fanout_backup(self, vault, replicas, on_commit):
+        """Back up LOCAL to several replicas at once, reading each band only once
+        (see ev.fanout). on_commit is called if the Dropbox replica committed."""
+        from ev.bandscan import ScanConcurrently
+        from ev.bandsync import SyncLists
+        from ev.bandtable import C_BandTable, DiffBandTables
+        from ev.fanout import C_FanoutSync, C_ReplicaTarget
+        
+        self.msgout("Backing up LOCAL (%s) to %d replicas: %s" % (self.local.getPath(), len(replicas),
+                    ', '.join(r.getPath() for r in replicas)))
+        
+        ScanConcurrently([self.local.load_bundle_bands] + [r.load_bundle_bands for r in replicas])
+        
+        if self.local.getBandTable() is None:
+            self.msgout("There are no bands in %s, I'm not going to sync that!" % self.local.getBands())
+            return 1
+            
+        targets = []
+        for replica in replicas:
+            journal = self.transfer_journal(replica)
+            pending = journal.Pending()
+            if pending is not None and journal.Cleanup(pending):
+                self.msgout("cleaned up half-written file(s) from the last %s to %s" %
+                            (pending['direction'], replica.getPath()))
+            
+            table = replica.getBandTable()
+            if table is None:
+                table = C_BandTable.FromEntries([])
+                
+            # A rescan is cheap (see ev.manifest), and it already knows which bands
+            # an interrupted run got done, so each replica just gets a fresh plan.
+            copy, delete = SyncLists(DiffBandTables(self.local.getBandTable(), table))
+            self.msgout("%s: %d band(s) to copy, %d to delete" % (replica.getPath(), len(copy), len(delete)))
+            
+            journal.Begin('backup', self.local.getPath(), replica.getPath(), copy, delete)
+            targets.append(C_ReplicaTarget(replica, copy, delete, journal))
+            
+        fanout = C_FanoutSync(self.local, targets, self.msgout, self.transfer_scheduler())
+        try:
+            fanout.Run()
+        except OSError as e:
+            self.msgout("backup failed reading LOCAL: %s (run it again to pick up where it left off)" % e)
+            return 1
+        finally:
+            for target in targets:
+                target.journal.Close()
+                
+        self.msgout("read %d band(s), %d bytes, once for all replicas" % (fanout.stats['bands'], fanout.stats['read']))
+        
+        self.transferred += sum(target.stats['bytes'] for target in targets)
+        
+        rc = 0
+        for target in targets:
+            ok = target.journal.Committed()
+            self.msgout("%s: %s, copied %d band(s) and %d other file(s), %d bytes, deleted %d band(s)" %
+                        (target.store.getPath(), target.status, target.stats['copied'],
+                         target.stats['metadata'], target.stats['bytes'], target.stats['deleted']))
+            self.record_replica(vault, target.store, ok, target.stats['seconds'], target.stats['bytes'], target.error)
+            
+            if ok:
+                if target.store is self.remote:
+                    self.throughput = (target.stats['bytes'], target.stats['copied'] + target.stats['deleted'],
+                                       target.stats['seconds'])
+                    on_commit()
+                target.journal.Discard()
+                target.store.load_bundle_bands()
+                if target.store is self.remote:
+                    self.rebase_dirty_journal('backup', self.local, self.remote)
+            else:
+                rc = 1
+                
         vault.WritePlist()
         
         return rc
         
-    def restore(self):
+    def replica_lag(self):
+        """Returns a list with a dictionary for each replica: root, status, last-backup,
+        lag (seconds since the last good backup, or None) and differing (how many bands
+        differ from LOCAL, or None if the replica is offline)."""
+        import datetime
+        from ev.bandscan import ScanConcurrently
+        from ev.bandtable import DiffBandTables, DIFF_SAME
+        
+        status = C_EVPlist(self.vaultname).ReplicaStatus()
+        
+        online = [r for r in self.replicastores if r.HasBands()]
+        local_manifest = not C_EVPlist(self.vaultname).Mounted()
+        ScanConcurrently([lambda: self.local.load_bundle_bands(local_manifest)] +
+                         [r.load_bundle_bands for r in online])
+        
+        lags = []
+        for replica in self.replicastores:
+            root = replica.getRoot()
+            info = status.get(root, {})
+            last = info.get('last-backup')
+            
+            differing = None
+            if replica in online and self.local.getBandTable() is not None:
+                counts = DiffBandTables(self.local.getBandTable(), replica.getBandTable()).Counts()
+                differing = sum(counts.values()) - counts['same']
+                
+            lags.append({'root': root, 'status': info.get('status', 'never backed up'),
+                         'last-backup': last,
+                         'lag': (datetime.datetime.now() - last).total_seconds() if last else None,
+                         'differing': differing})
+            
+        return lags
+        
+    def replicas(self):
+        """Show how far behind LOCAL each replica is"""
+        for lag in self.replica_lag():
+            self.msgout("%s: %s, last backup %s, %s" % (
+                lag['root'], lag['status'],
+                '%s (%d seconds ago)' % (lag['last-backup'].strftime('%c'), lag['lag']) if lag['last-backup'] else 'never',
+                '%d band(s) differ from LOCAL' % lag['differing'] if lag['differing'] is not None else "can't tell how many bands differ"))
+            
+            if self.recordout is not None:
+                record = dict(lag, kind='replica', vault=self.vaultname)
+                if record['last-backup'] is not None:
+                    record['last-backup'] = record['last-backup'].isoformat()
+                self.recordout(record)
+                
+        return 0
+        
+    def restore(self, version=None):
+        """Make the REMOTE version the new LOCAL version. With the versioned layout,
+        version picks which backup to restore (see the 'versions' verb); the latest
+        one by default."""
+        import time
+        
         vault = C_EVPlist(self.vaultname)
+        started = time.time()
+        
+        # Find out if there is such a version before taking any snapshots
+        if self.versioned and self.version_store().Load(self.vaultname, version) is None:
+            raise VaultError(9, "There is no version '%s' of %s" % (version or 'latest', self.vaultname))
+            
         if vault.Mounted():
             #@TODO: hdiutil mounted is the one that matters, but let's print this status for now ...
             self.msgout("FYI, doing restore of volume while it is mounted by %s" % vault.ComputerName())
 
         # Check to see if the volume on that sparse bundle is actually mounted here
-        from ev.hdiinfo2 import MountedVolume
-        
-        volume = MountedVolume(self.local.getBundlePath())
+        volume = self.mounted_volume()
         
         rc = 1
         if volume != None:
             self.msgout("Sorry, can't restore the volume while it's mounted locally ...")
         else:
-            self.msgout("Restoring LOCAL (%s) from Dropbox (%s)..." % (self.local.getPath(),self.remote.getPath()))
-            rc = os.system("rsync -va --delete \"%s/\" \"%s\"" % (self.remote.getPath(), self.local.getPath()))
+            pending = self.transfer_journal().Pending()
+            resuming = pending is not None and pending['direction'] == 'restore'
+            
+            # Don't snapshot a half restored vault, the snapshot from the first try is better
+            if C_EVDefaults().SnapshotBeforeRestore and os.path.isdir(self.local.getBands()) and not resuming:
+                info = self.snapshots_object().Create(self.local, 'pre-restore')
+                self.msgout("took a %s snapshot of LOCAL first: %s" % (info['method'], info['name']))
+                self.snapshots_object().Prune(C_EVDefaults().SnapshotKeep, 'pre-restore')
+                
+            if self.versioned:
+                rc = self.versioned_restore(version)
+            elif version is not None:
+                self.msgout("Dropbox is a mirror, so there's only one version to restore")
+            else:
+                self.msgout("Restoring LOCAL (%s) from Dropbox (%s)..." % (self.local.getPath(),self.remote.getPath()))
+                rc = self.sync_stores(self.remote, self.local, 'restore')
+                
+            if rc == 0:
+                # Load the plist again, the transfer may have written to it
+                vault = C_EVPlist(self.vaultname)
+                vault.SetLastSync('restore', time.time() - started, self.transferred)
+                if self.throughput is not None:
+                    vault.AddThroughput('restore', *self.throughput)
+                vault.WritePlist()
             
         return rc
         
+    def versioned_restore(self, name=None):
+        """Restore LOCAL from version name (the latest if None) of the versioned store"""
+        versions = self.version_store()
+        
+        version = versions.Load(self.vaultname, name)
+        if version is None:
+            raise VaultError(9, "There is no version '%s' of %s" % (name or 'latest', self.vaultname))
+            
+        self.msgout("Restoring LOCAL (%s) from version %s..." % (self.local.getPath(), version['name']))
+        
+        try:
+            stats = versions.Restore(version, self.local)
+        except OSError as e:
+            self.msgout("restore failed: %s (run it again to pick up where it left off)" % e)
+            return 1
+            
+        self.msgout("copied %d band(s) and %d other file(s), %d bytes, deleted %d band(s) in %.2f seconds" %
+                    (stats['copied'], stats['metadata'], stats['bytes'], stats['deleted'], stats['seconds']))
+        
+        self.transferred += stats['bytes']
+        
+        return 0
+        
+    def snapshots_object(self):
+        """Returns the C_Snapshots object for this vault"""
+        from ev.snapshot import C_Snapshots
+        
+        return C_Snapshots(C_EVDefaults().SnapshotStorePath(), self.vaultname)
+        
+    def snapshot(self, label='manual'):
+        """Take a snapshot of the LOCAL vault (see ev.snapshot). It's only a clone of
+        the bands, so it takes next to no time or space."""
+        if self.mounted_volume() != None:
+            self.msgout("Sorry, can't take a snapshot while the volume is mounted locally ...")
+            return 1
+            
+        info = self.snapshots_object().Create(self.local, label)
+        self.msgout("created %s snapshot %s" % (info['method'], info['name']))
+        
+        return 0
+        
+    def snapshots(self):
+        """List the snapshots of the LOCAL vault"""
+        snapshots = self.snapshots_object().List()
+        
+        for info in snapshots:
+            self.msgout("%s  %-8s %s" % (info['name'], info['method'],
+                                         "STALE (vault was mounted RW since)" if info['stale'] else ""))
+            if self.recordout is not None:
+                self.recordout(dict(info, kind='snapshot', vault=self.vaultname,
+                                    created=info['created'].isoformat()))
+                
+        self.msgout("%d snapshot(s)" % len(snapshots))
+        
+        return 0
+        
+    def prune(self, keep=None, label=None):
+        """Delete all but the newest 'keep' snapshots (C_EVDefaults.SnapshotKeep if not
+        given). If label is given, only snapshots with that label are pruned."""
+        keep = C_EVDefaults().SnapshotKeep if keep is None else int(keep)
+        
+        for name in self.snapshots_object().Prune(keep, label):
+            self.msgout("deleted snapshot %s" % name)
+            
+        return 0
+        
+    def rollback(self, name):
+        """Put the LOCAL vault back the way it was when the snapshot name was taken."""
+        info = self.snapshots_object().Info(name)
+        if info is None:
+            raise VaultError(6, "There is no snapshot named '%s'" % name)
+            
+        if info['stale']:
+            raise VaultError(7, "Snapshot '%s' shares files with the vault, and it's been mounted RW since" % name)
+            
+        if self.mounted_volume() != None:
+            self.msgout("Sorry, can't roll back the volume while it's mounted locally ...")
+            return 1
+            
+        snap = C_VaultStore(self.snapshots_object().SnapshotPath(name), self.vaultname)
+        
+        self.msgout("Rolling LOCAL (%s) back to snapshot %s..." % (self.local.getPath(), name))
+        
+        return self.sync_stores(snap, self.local, 'rollback')
+        
     def dismount(self):
+        import kenl380.pylib as pylib
+        
         self.msgout("Dismounting %s..." % self.vaultname)
         
         if not self.valid:
@@ -457,17 +1997,28 @@ class C_EncryptedVault:
             #raise VaultError(5,'The vault is already mounted by %s' % vault.computer_name())
         
         # Check to see if the volume on that sparse bundle is actually mounted here
-        from ev.hdiinfo2 import MountedVolume
+        volume = self.mounted_volume()
         
-        volume = MountedVolume(self.local.getBundlePath())
+        if volume != None and self.volumes is not None:
+            # That came from a batch's lookup (see LocalVolumes()), which can be minutes
+            # old by now, so make sure it's still our image before detaching anything
+            from ev.hdiinfo2 import ImagePath
+            
+            image = ImagePath(volume)
+            if image is None or os.path.realpath(image) != os.path.realpath(self.local.getBundlePath()):
+                self.msgout("%s isn't mounted from %s anymore, so I'm leaving it alone" % (volume, self.local.getBundlePath()))
+                volume = None
         
         rc = 0
         if volume != None:
             # hdiutil reports the volume is currently mounted, so let's eject it
-            command = 'hdiutil detach %s' % volume
-            self.msgout('ejecting encrypted vault: %s' % command)
-            rc = os.system(command)
-            
+            command = ['hdiutil', 'detach', volume]
+            self.msgout('ejecting encrypted vault: %s' % ' '.join(command))
+            try:
+                rc = self.run_command(command)
+            finally:
+                self.forget_volumes()
+
         else:
         	self.msgout('no volume is currently mounted from %s' % self.local.getBundlePath())
 
@@ -478,6 +2029,12 @@ class C_EncryptedVault:
             # Denote the object state.
             self.mounted = False        # This seems dumb. Who looks at this?
             
+            # The bands may have been written in place while it was mounted
+            self.local.getManifest().Invalidate()
+            
+            # Only now that it's detached, so the last writes get recorded
+            self.stop_watcher()
+            
             #@TODO: What about needs-backup? Here or above? or both?
             
             # Okay, it was mounted, so now we need to clean up the plist file
@@ -500,6 +2057,24 @@ class C_EncryptedVault:
     eject = dismount
     detach = dismount
     
+    def metrics(self):
+        """Compare the stores (which is cheap, see analyzeBands()), write the metrics
+        file, and show what's in it"""
+        from ev.metrics import C_VaultMetrics
+        
+        self.analyzeBands()
+        
+        path = self.export_metrics('metrics', 'ok')
+        if path is not None:
+            self.msgout("wrote %s" % path)
+            
+        vault = C_EVPlist(self.vaultname)
+        
+        for line in C_VaultMetrics(self.vaultname, vault, vault.MetricsState()).Text().splitlines():
+            self.msgout(line)
+            
+        return 0
+        
     def about(self):
         if not self.valid:
             self.msgout("Not to be a negative nancy, but I see no reason to continue...")
@@ -529,13 +2104,30 @@ class C_EncryptedVault:
         if( state['olderbands'] != 0 and state['newerbands'] != 0 ):
             self.msgout("The LOCAL vault has some older bands and some newer bands. This is BAD!")
         
+        if( state['remoteonlybands'] != 0 ):
+            self.msgout("Dropbox has %d band(s) that LOCAL doesn't have." % state['remoteonlybands'])
+        
+        if( state['sizechangedbands'] != 0 ):
+            self.msgout("%d band(s) have the same time but a different size. That's odd..." % state['sizechangedbands'])
+        
+        if( state['samebands'] != state['localcount'] or state['remoteonlybands'] != 0 ):
+            self.msgout("Use the 'diff' verb to see which bands differ.")
+        
+        if len(self.replicastores) > 1:
+            self.msgout("Here is how far behind each replica is:")
+            self.replicas()
+        
         self.msgout("Hopefully, I haven't said anything contradictory or wrong!")
     
-        import pprint
-    
-        self.msgout("Here is the full dictionary called 'state' in the code:")
-        pp = pprint.PrettyPrinter(indent=4)
-        pp.pprint(state)
+        if self.recordout is not None:
+            self.recordout(dict(state, kind='state', vault=self.vaultname))
+        else:
+            import pprint
+        
+            self.msgout("Here is the full dictionary called 'state' in the code:")
+            pp = pprint.PrettyPrinter(indent=4)
+            self.msgout(pp.pformat(state))
+            
         self.msgout("Go ahead, don't be scared ... make a decision.")
         
         return 0
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+This module implements the ev daemon, a long-running process that serves the vault
+verbs over a Unix socket, so a status check from a script or menu bar app doesn't
+pay for starting Python, importing everything, and scanning the bands every time.
+It stays warm: the band manifests keep their tables in memory (see ev.manifest), and
+the Merkle summaries make an in-sync check a couple of stats on the Dropbox side.
+LOCAL's bands are still listed and stat'ed every time, since they can be rewritten
+in place without the directory changing.
+
+The protocol is one JSON object per line. The client sends a single request:
+
+    {"vault": "cv", "verb": "about", "args": [], "records": false}
+
+and the daemon answers with any number of these, ending with an rc or an error:
+
+    {"message": "..."}          a status message (what the message handler gets)
+    {"record": {...}}           a structured record (only if records was true)
+    {"rc": 0}                   the verb returned
+    {"error": [errno, "..."]}   the verb raised a VaultError (or something else, -1)
+
+Verbs that change a vault (dismount, backup, restore, ...) hold that vault's lock,
+so they run one at a time; verbs that only look run whenever they're asked. Verbs
+that ask for the vault password (mount, attach) are refused: hdiutil would prompt on
+the daemon's terminal, not the client's, and hold the vault's lock while it waited.
+The ev command runs those itself.
+
+Start it with 'ev --daemon'. From then on, the ev command is just a thin client of
+it, unless it's given --no-daemon.
+"""
+
+import os
+import json
+import threading
+
+from ev.verbs import ExclusiveVerbs, Lookup
+
+# Verbs that change the vault or its state, and so have to take turns (see ev.verbs)
+EXCLUSIVE_VERBS = ExclusiveVerbs()
+
+def SocketPath():
+    """Returns the path of the daemon socket"""
+    from ev.cryptvault import C_EVDefaults
+
+    return os.path.join(C_EVDefaults().LocalStorePath(), '.evd.sock')
+
+def Running(path=None):
+    """Returns True if a daemon is answering on the socket"""
+    import socket
+
+    path = path or SocketPath()
+    if not os.path.exists(path):
+        return False
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+
+    return True
+
+class C_VaultLocks:
+    """One lock per vault, made the first time someone asks for it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    def Get(self, vault):
+        with self.lock:
+            return self.locks.setdefault(vault, threading.Lock())
+
+class C_EVDaemon:
+    """The daemon itself.
+
+    path - The socket to listen on (see SocketPath())
+    message - A function that is called with a string to log what the daemon does
+    """
+    def __init__(self, path=None, message=print):
+        self.path = path or SocketPath()
+        self.msgout = message
+        self.locks = C_VaultLocks()
+        self.server = None
+
+    def handle(self, rfile, wfile):
+        """Serve one request on a connection"""
+        from ev.cryptvault import C_EncryptedVault, VaultError
+
+        lock = threading.Lock()
+
+        def send(obj):
+            with lock:
+                wfile.write((json.dumps(obj, sort_keys=True, default=str) + '\n').encode('utf-8'))
+                wfile.flush()
+
+        line = rfile.readline()
+        if not line.strip():
+            return      # somebody just checking that we're here (see Running())
+
+        try:
+            request = json.loads(line)
+            vault = request['vault']
+            verb = request['verb'].lower()
+            args = [str(a) for a in request.get('args', [])]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            send({'error': [-1, "that isn't a request I understand"]})
+            return
+
+        message = lambda msg: send({'message': msg})
+        records = (lambda record: send({'record': record})) if request.get('records') else None
+
+        try:
+            spec = Lookup(verb)
+            if spec is None:
+                send({'error': [-1, "Could be me, but I don't see any object methods named '%s'" % verb]})
+                return
+            if spec.password:
+                send({'error': [-1, "'%s' asks for the vault password, so it can't run in the daemon" % verb]})
+                return
+            problem = spec.CheckArgs(args)
+            if problem is not None:
+                send({'error': [-1, problem]})
+                return
+
+            vaultlock = self.locks.Get(vault) if verb in EXCLUSIVE_VERBS else None
+
+            if vaultlock is not None and not vaultlock.acquire(blocking=False):
+                message("waiting for another operation on %s to finish..." % vault)
+                vaultlock.acquire()
+
+            try:
+                encvlt = C_EncryptedVault(vault, message, records, needs=spec.needs)
+                if not encvlt.valid:
+                    send({'error': [-1, "Not to be a negative nancy, but I see no reason to continue..."]})
+                    return
+
+                rc = encvlt.lookup(verb)(*args)
+            finally:
+                if vaultlock is not None:
+                    vaultlock.release()
+
+            send({'rc': rc})
+            self.msgout("%s %s %s returned %s" % (vault, verb, ' '.join(args), rc))
+
+        except VaultError as ve:
+            send({'error': [ve.errno, ve.errmsg]})
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # the client went away; whatever the verb did is done
+        except Exception as e:
+            # Don't let one bad request take the daemon down
+            self.msgout("%s %s failed: %r" % (vault, verb, e))
+            try:
+                send({'error': [-1, '%s: %s' % (type(e).__name__, e)]})
+            except OSError:
+                pass
+
+    def Serve(self):
+        """Listen until interrupted. Returns 1 if another daemon is already running."""
+        import socketserver
+
+        if Running(self.path):
+            self.msgout("there's already a daemon listening on %s" % self.path)
+            return 1
+
+        try:
+            os.unlink(self.path)     # left over from one that didn't shut down
+        except FileNotFoundError:
+            pass
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon.handle(self.rfile, self.wfile)
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        old = os.umask(0o077)   # only this user gets to talk to it
+        try:
+            self.server = Server(self.path, Handler)
+        finally:
+            os.umask(old)
+
+        # Clean up the socket on a plain kill, too
+        import signal
+        import sys
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        self.msgout("listening on %s" % self.path)
+
+        try:
+            self.server.serve_forever()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.server.server_close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+        return 0
+
+    def Shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+def Request(vault, verb, args, message, records=None, path=None):
+    """Run a verb in the daemon. message and records are called with what comes
+    back, same as the C_EncryptedVault handlers. Returns the verb's rc. Raises
+    VaultError if the verb did, and OSError if the daemon can't be reached."""
+    import socket
+    from ev.cryptvault import VaultError
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path or SocketPath())
+
+        request = {'vault': vault, 'verb': verb, 'args': list(args), 'records': records is not None}
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+        with sock.makefile('rb') as f:
+            for line in f:
+                reply = json.loads(line)
+                if 'message' in reply:
+                    message(reply['message'])
+                elif 'record' in reply:
+                    records(reply['record'])
+                elif 'rc' in reply:
+                    return reply['rc']
+                elif 'error' in reply:
+                    raise VaultError(*reply['error'])
+
+    raise ConnectionResetError("the daemon hung up before the verb finished")
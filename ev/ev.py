@@ -2,12 +2,10 @@
 
 import os
 import sys
-import string
-
-import kenl380.pylib as pylib
 
 def context(varfile=None):
     """returns the context object for this script."""
+    import kenl380.pylib as pylib
 
     try:
         myself = __file__
@@ -16,28 +14,191 @@ def context(varfile=None):
 
     return pylib.context(myself,varfile)
 
-me = context('ev')
+# This used to be context('ev'), made at import time, but the alias and the version
+# string are all we ever used it for, and pylib (and platform) cost more to import
+# than the rest of the command line put together.
+ALIAS = 'ev'
+
+msgfile = sys.stdout
 
-def message(msgstr): print ('%s: %s' % (me.alias(),msgstr))
+def message(msgstr): print ('%s: %s' % (ALIAS,msgstr), file=msgfile)
 
-from ev.cryptvault import C_EncryptedVault, VaultError
+def pyVersionStr():
+    """Same as pylib's context.pyVersionStr()"""
+    return "Python Interpreter Version: {}.{}.{}".format(*sys.version_info[:3])
+
+def jsonl_record(record):
+    """Record handler for the --jsonl output mode. Writes each record as one line of
+    JSON on stdout (messages go to stderr in this mode, so stdout stays parseable)."""
+    import json
+    
+    sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+
+def split_options(args):
+    """Split the command line into options (anything that starts with --) and the
+    positional arguments. Returns (options, positional), where options is a dictionary
+    of name -> value, with True as the value for options like --jsonl that have none."""
+    options = {}
+    positional = []
+    
+    for arg in args:
+        if arg.startswith('--') and len(arg) > 2:
+            name, sep, value = arg[2:].partition('=')
+            options[name.lower()] = value if sep else True
+        else:
+            positional.append(arg)
+            
+    return options, positional
 
 def usage():
 	message("invalid usage")
 	sys.exit(1)
 
+def daemon_entry(args, records):
+    """Run the verb in the daemon, if there is one (see ev.daemon). Returns None if
+    there isn't, so the caller does it itself."""
+    from ev.daemon import Request, Running
+    
+    if not Running():
+        return None
+        
+    from ev.cryptvault import VaultError
+    
+    verb = args[1].lower()
+    
+    try:
+        message('%s returned %d' % (verb, Request(args[0], verb, args[2:], message, records)))
+    except VaultError as ve:
+        message("Vault class threw exception %d:%s" % (ve.errno, ve.errmsg))
+        return(1)
+    except OSError as e:
+        message("lost the daemon in the middle of '%s': %s" % (verb, e))
+        return(1)
+        
+    return(1)
+
+def batch_entry(vaults, args, options, records):
+    """Run the verb in args[0] on each of vaults at the same time (see ev.batch)"""
+    import time
+    from ev.batch import C_BatchRun
+    from ev.verbs import ParsePositive
+    
+    jobs = 4
+    if 'jobs' in options:
+        try:
+            # A bare --jobs comes through as True
+            jobs = ParsePositive('' if options['jobs'] is True else options['jobs'])
+        except ValueError as e:
+            message("--jobs takes how many vaults to run at the same time, like --jobs=4: %s" % e)
+            usage()
+    
+    if not vaults:
+        message("There aren't any vaults to do that to")
+        return(1)
+        
+    batch = C_BatchRun(vaults, args[0], args[1:], message, records, jobs)
+    
+    started = time.time()
+    try:
+        results = batch.Run()
+    except ValueError as e:
+        message(str(e))
+        return(1)
+        
+    return batch.Summary(results, time.time() - started)
+
+def profile_entry(options, run, records):
+    """Call run() with the spans turned on (see ev.spans), then print where the time
+    went. --profile=FILE also writes a cProfile dump to FILE, for pstats and friends."""
+    from ev.spans import C_SpanProfile, SetSpanHook
+    
+    profile = C_SpanProfile()
+    SetSpanHook(profile)
+    
+    cprofile = None
+    if options['profile'] is not True:
+        import cProfile
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+        
+    try:
+        return run()
+    finally:
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(options['profile'])
+            message("wrote the cProfile dump to %s" % options['profile'])
+            
+        SetSpanHook(None)
+        profile.Report(message, records)
+
 def ev_entry():
+    global msgfile
     from sys import argv
 
-    message(me.pyVersionStr())
     # assume we have no arguments, but if we do, pass them along
-    args = []
-    if len(sys.argv) > 1: args = sys.argv[1:]
+    options, args = split_options(sys.argv[1:])
+    
+    records = None
+    if options.get('jsonl'):
+        msgfile = sys.stderr
+        records = jsonl_record
+
+    message(pyVersionStr())
     
-    if len(args) < 1: usage()
+    if options.get('profile'):
+        # The spans of a verb that runs in the daemon are in the daemon, so run it here
+        options['no-daemon'] = True
+        return profile_entry(options, lambda: verb_entry(options, args, records), records)
+        
+    return verb_entry(options, args, records)
+    
+def verb_entry(options, args, records):
+    """Run the verb on the command line, in the daemon, in a batch or right here"""
+    if options.get('daemon'):
+        from ev.daemon import C_EVDaemon
+        return C_EVDaemon(message=message).Serve()
+    
+    if options.get('all'):
+        # No vault name on the command line, it's every vault there is
+        from ev.batch import DiscoverVaults
+        from ev.cryptvault import C_EVDefaults
+        
+        if len(args) < 1: usage()
+        
+        return batch_entry(DiscoverVaults(C_EVDefaults().LocalStorePath()), args, options, records)
+    
+    if len(args) < 2: usage()
 
+    if ',' in args[0]:
+        return batch_entry([v for v in args[0].split(',') if v], args[1:], options, records)
+        
+    # Find the verb and check its arguments before building anything (see ev.verbs)
+    from ev.verbs import Lookup
+    
+    verb = args[1].lower()
+    spec = Lookup(verb)
+    
+    if spec is None:
+        message("Could be me, but I don't see any object methods named '%s' on the encvlt variable" % verb)
+        return(1)
+        
+    problem = spec.CheckArgs(args[2:])
+    if problem is not None:
+        message(problem)
+        return(1)
+        
+    # The daemon won't run a verb that asks for the password (see ev.daemon)
+    if not options.get('no-daemon') and not spec.password:
+        rc = daemon_entry(args, records)
+        if rc is not None:
+            return rc
+            
+    from ev.cryptvault import C_EncryptedVault, VaultError
+    from ev.spans import Span
+    
     try:
-        encvlt = C_EncryptedVault(args[0],message)
+        encvlt = C_EncryptedVault(args[0],message,records,needs=spec.needs)
     except VaultError as ve:
         message("Vault class threw exception %d:%s" % (ve.errno, ve.errmsg))
         return(1)
@@ -45,15 +206,12 @@ def ev_entry():
     if not encvlt.valid:
         message("Not to be a negative nancy, but I see no reason to continue...")
         return(1)
-
-    verb = args[1].lower()
     
-    if not hasattr(encvlt,verb):
-        message("Could be me, but I don't see any object methods named '%s' on the encvlt variable" % verb)
-        return(1)
-        
     try:
-        message('%s returned %d' % (verb, encvlt.lookup(verb)()))
+        # anything after the verb is passed along to it
+        with Span('verb.' + verb):
+            rc = encvlt.lookup(verb)(*args[2:])
+        message('%s returned %d' % (verb, rc))
     except VaultError as ve:
         message("Vault class threw exception %d:%s" % (ve.errno, ve.errmsg))
         return(1)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+This module backs up one vault store to several replicas at once (Dropbox, a NAS
+mount, an external disk, ...) while reading each changed band only once. Running
+the sync engine once per replica would read the source once per replica.
+
+Each replica has its own plan (the bands it needs, the bands it has to delete), its
+own transfer journal, and its own status. A band that any replica needs is read
+into memory once, allocated ranges only, and written to every replica that needs
+it, the same way the sync engine does it: temp file, fsync, rename. If a replica
+fails (disk full, NAS went away), it's marked failed and the others carry on.
+
+A replica can also be an object store (see ev.objectstore). Those get the band as
+one Write, and their deletes and metadata go through ev.objectsync.
+"""
+
+import os
+import time
+import threading
+
+from ev.bandsync import (C_BandSync, DataExtents, FsyncDirectory, TempPath,
+                         COPY_CHUNK, DefaultMessageHandler)
+
+class C_ReplicaTarget:
+    """One replica of a fan-out backup.
+
+    store - The replica's C_VaultStore
+    copy, delete - Its plan (see ev.bandsync.SyncLists())
+    journal - Its C_TransferJournal, already begun, or None
+    """
+    def __init__(self, store, copy, delete, journal=None):
+        self.store = store
+        self.copy = copy
+        self.delete = delete
+        self.journal = journal
+
+        self.status = 'pending'
+        self.error = None
+        self.stats = {'copied': 0, 'deleted': 0, 'bytes': 0, 'metadata': 0, 'seconds': 0.0}
+
+    def Failed(self):
+        return self.error is not None
+
+class C_FanoutSync:
+    """Syncs the source C_VaultStore to every C_ReplicaTarget in targets.
+
+    message - A function that is called with a string to print status messages
+    scheduler - A C_TransferScheduler (see ev.scheduler)
+    """
+    def __init__(self, src, targets, message=DefaultMessageHandler, scheduler=None):
+        from ev.scheduler import C_TransferScheduler
+
+        self.src = src
+        self.targets = targets
+        self.msgout = message
+        self.scheduler = scheduler or C_TransferScheduler()
+        self.throttle = self.scheduler.Throttle if self.scheduler.Throttled() else None
+        self.lock = threading.Lock()
+
+        self.stats = {'read': 0, 'bands': 0}
+
+    def fail(self, target, error):
+        with self.lock:
+            if target.error is None:
+                target.error = error
+                target.status = 'failed: %s' % error
+                self.msgout("replica %s failed: %s" % (target.store.getPath(), error))
+
+    def read_band(self, name):
+        """Read the allocated ranges of a source band. Returns (stat, extents), where
+        extents is a list of (offset, data)."""
+        path = os.path.join(self.src.getBands(), name)
+
+        extents = []
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            for start, end in DataExtents(f.fileno(), st.st_size):
+                offset = start
+                while offset < end:
+                    length = min(COPY_CHUNK, end - offset)
+                    if self.throttle is not None:
+                        self.throttle(length)
+                    data = os.pread(f.fileno(), length, offset)
+                    if not data:
+                        break
+                    extents.append((offset, data))
+                    offset += len(data)
+
+        return st, extents
+
+    def put_band(self, target, name, st, extents):
+        """Write a band that was read by read_band() to an object store replica"""
+        from ev.objectsync import C_ObjectSync
+
+        data = bytearray(st.st_size)
+        for offset, chunk in extents:
+            data[offset:offset + len(chunk)] = chunk
+
+        return C_ObjectSync(self.src, target.store, self.msgout, scheduler=self.scheduler).write_file(
+            target.store, target.store.getBands() + '/' + name, bytes(data), st.st_mtime_ns,
+            st.st_mode & 0o7777, band=name)
+
+    def write_band(self, target, name, st, extents):
+        """Write a band that was read by read_band() to one replica"""
+        if target.store.objectstore:
+            written = self.put_band(target, name, st, extents)
+            if target.journal is not None:
+                target.journal.Done(name, st.st_size, st.st_mtime_ns)
+            with self.lock:
+                target.stats['copied'] += 1
+                target.stats['bytes'] += written
+            return
+
+        dstpath = os.path.join(target.store.getBands(), name)
+        tmppath = TempPath(dstpath)
+
+        if target.journal is not None:
+            target.journal.TempFile(tmppath)
+
+        written = 0
+        try:
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                for offset, data in extents:
+                    if self.throttle is not None:
+                        self.throttle(len(data))
+                    os.pwrite(fd, data, offset)
+                    written += len(data)
+                os.ftruncate(fd, st.st_size)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            os.chmod(tmppath, st.st_mode & 0o7777)
+            os.utime(tmppath, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.replace(tmppath, dstpath)
+        except BaseException:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+
+        if target.journal is not None:
+            target.journal.Done(name, st.st_size, st.st_mtime_ns)
+
+        with self.lock:
+            target.stats['copied'] += 1
+            target.stats['bytes'] += written
+
+    def fan_band(self, name, targets):
+        """Read one band and write it to each of targets"""
+        targets = [t for t in targets if not t.Failed()]
+        if not targets:
+            return
+
+        st, extents = self.read_band(name)
+
+        with self.lock:
+            self.stats['read'] += sum(len(data) for offset, data in extents)
+            self.stats['bands'] += 1
+
+        for target in targets:
+            if target.Failed():
+                continue
+            try:
+                self.write_band(target, name, st, extents)
+            except OSError as e:
+                self.fail(target, e)
+
+    def Run(self):
+        """Do the fan-out. Returns the list of targets, each with its status and stats.
+        Raises OSError only if the source can't be read."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        started = time.time()
+
+        # Which targets need each band, and how big it is
+        needs = {}
+        for target in self.targets:
+            try:
+                if not target.store.objectstore:
+                    os.makedirs(target.store.getBands(), exist_ok=True)
+            except OSError as e:
+                self.fail(target, e)
+                continue
+
+            for name, size in target.copy:
+                needs.setdefault(name, [size, []])[1].append(target)
+
+        order = self.scheduler.Order([(name, need[0]) for name, need in needs.items()])
+
+        with ThreadPoolExecutor(max_workers=self.scheduler.policy.workers,
+                                initializer=self.scheduler.WorkerInitializer()) as pool:
+            list(pool.map(lambda c: self.fan_band(c[0], needs[c[0]][1]), order))
+
+        for target in self.targets:
+            if target.Failed():
+                continue
+
+            try:
+                if target.store.objectstore:
+                    from ev.objectsync import C_ObjectSync
+
+                    meta = C_ObjectSync(self.src, target.store, self.msgout, journal=target.journal,
+                                        scheduler=self.scheduler)
+                    meta.delete_bands(list(target.delete))
+                    target.stats['deleted'] += meta.stats['deleted']
+                    meta.sync_metadata()
+                    target.stats['metadata'] = meta.stats['metadata']
+                    target.stats['bytes'] += meta.stats['bytes']
+
+                    if target.journal is not None:
+                        target.journal.Commit()
+
+                    target.status = 'ok'
+                    continue
+
+                for name in target.delete:
+                    try:
+                        os.unlink(os.path.join(target.store.getBands(), name))
+                    except FileNotFoundError:
+                        pass
+                    target.stats['deleted'] += 1
+                    if target.journal is not None:
+                        target.journal.Deleted(name)
+
+                # Bands before metadata, same as the sync engine
+                FsyncDirectory(target.store.getBands())
+
+                meta = C_BandSync(self.src, target.store, self.msgout, scheduler=self.scheduler)
+                meta.sync_metadata()
+                target.stats['metadata'] = meta.stats['metadata']
+                target.stats['bytes'] += meta.stats['bytes']
+
+                if target.journal is not None:
+                    target.journal.Commit()
+
+                target.status = 'ok'
+            except OSError as e:
+                self.fail(target, e)
+
+        for target in self.targets:
+            target.stats['seconds'] = time.time() - started
+
+        return self.targets
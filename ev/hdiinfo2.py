@@ -5,10 +5,23 @@ This module uses HDIUTIL to get info on mounted disk images. It will return the
 PList of the hdiutil info verb so it can be parsed, and there is also a method
 that looks up and returns the mount point of an Apple_HFS volume for the specified
 sparse image bundle.
+
+hdiutil info is slow, especially with a lot of images attached, so the parsed info
+is cached for INFO_TTL seconds and indexed by image path and mount point. Anything
+that attaches or detaches an image should call Invalidate() right after. Threads
+that ask while the info is being fetched wait for that fetch instead of starting
+their own.
 """
 
 import os
 import sys
+import time
+import threading
+
+INFO_TTL = 2.0
+
+_lock = threading.Lock()
+_cache = None       # (time.monotonic() when fetched, C_HDIIndex)
 
 def GetHDIInfo():
     """Returns the output from HDI INFO as a PList Dictionary
@@ -20,17 +33,90 @@ def GetHDIInfo():
     list = []
 
     from subprocess import getoutput
+    from ev.spans import Span
 
     listCommand = 'hdiutil info -plist'
     
-    out = getoutput(listCommand)
-    from plistlib import loads
-    
-    plist = loads(bytes(out,encoding='UTF-8'))
+    with Span('hdiutil.info'):
+        out = getoutput(listCommand)
+        from plistlib import loads
+        
+        plist = loads(bytes(out,encoding='UTF-8'))
 
     return plist
     
-def MountedVolume(bundle):
+class C_HDIIndex:
+    """The images in one hdiutil info plist, indexed by image path and mount point.
+
+    plist - The dictionary returned by GetHDIInfo()
+    """
+    def __init__(self, plist):
+        self.plist = plist
+        self.images = {}        # image-path -> image dictionary
+        self.volumes = {}       # image-path -> mount point of its Apple_HFS volume
+        self.mounts = {}        # mount point -> image-path
+
+        # plist['images'] will be empty if no disk images are mounted
+        for image in plist.get('images', []):
+        
+            # Haven't tested enough to know if 'image-path' is always there
+            if 'image-path' not in image:
+                continue
+                
+            path = image['image-path']
+            self.images[path] = image
+            
+            for entity in image.get('system-entities', []):
+                if 'mount-point' not in entity:
+                    continue
+                    
+                self.mounts[entity['mount-point']] = path
+                
+                # Each image can have multiple file systems and mounts. In the case
+                # of our Encrypted Images, we are looking only for Apple_HFS file systems.
+                # Haven't tested enough to know if there can be multiple file systems
+                # in a single bundle, but I don't think so...
+                if path not in self.volumes and entity.get('content-hint') == "Apple_HFS":
+                    self.volumes[path] = entity['mount-point']
+
+    def find(self, table, bundle):
+        if bundle in table:
+            return table[bundle]
+
+        # hdiutil reports the real path, which might not be how we spelled it
+        return table.get(os.path.realpath(bundle))
+
+    def Image(self, bundle):
+        """Returns the image dictionary of the bundle, or None if it isn't attached"""
+        return self.find(self.images, bundle)
+
+    def MountedVolume(self, bundle):
+        """Returns the mount point of the bundle's Apple_HFS volume, or None"""
+        return self.find(self.volumes, bundle)
+
+    def ImagePath(self, mountpoint):
+        """Returns the image path of whatever is mounted at mountpoint, or None"""
+        return self.mounts.get(mountpoint)
+
+def HDIIndex(max_age=INFO_TTL):
+    """Returns a C_HDIIndex of the attached images, from the cache if it's no older
+    than max_age seconds"""
+    global _cache
+
+    with _lock:
+        if _cache is None or time.monotonic() - _cache[0] > max_age:
+            _cache = (time.monotonic(), C_HDIIndex(GetHDIInfo()))
+
+        return _cache[1]
+
+def Invalidate():
+    """Forget the cached info. Call this after attaching or detaching an image."""
+    global _cache
+
+    with _lock:
+        _cache = None
+
+def MountedVolume(bundle, max_age=INFO_TTL):
     """
     Look to see if the specified bundle has an attached Apple_HFS volume. If so,
     return the mount-point, so it can be ejected (or printed, if that's what you
@@ -40,30 +126,21 @@ def MountedVolume(bundle):
              None - Doesn't look like the volume is mounted.
     """
 
-    plist = GetHDIInfo()
-    
-    # plist['images'] will be empty if no disk images are mounted
-    for image in plist['images']:
-    
-        # Haven't tested enough to know if 'image-path' is always there
-        if 'image-path' not in image:
-            continue
-            
-        # Look to see if the image is the one we are looking for
-        if image['image-path'] != bundle:
-            continue
+    return HDIIndex(max_age).MountedVolume(bundle)
 
-        # Each image can have multiple file systems and mounts. In the case
-        # of our Encrypted Images, we are looking only for Apple_HFS file systems.
-        
-        for entity in image['system-entities']:
-            if entity['content-hint'] in "Apple_HFS":
-                # Return the mount point of the image so it can be ejected/unmounted
-                # Haven't tested enough to know if there can be multiple file systems
-                # in a single bundle, but I don't think so...
-                return entity['mount-point']
+def ImagePath(mountpoint, max_age=INFO_TTL):
+    """Returns the path of the image that's mounted at mountpoint, or None if there
+    isn't one. hdiutil reports the real path of the image."""
+
+    return HDIIndex(max_age).ImagePath(mountpoint)
+
+def MountedVolumes(bundles, max_age=INFO_TTL):
+    """Batch version of MountedVolume(): returns a dictionary of bundle -> mount
+    point (or None) for each of bundles, from a single hdiutil info."""
+
+    index = HDIIndex(max_age)
 
-    return None                
+    return {bundle: index.MountedVolume(bundle) for bundle in bundles}
 
 if __name__ == "__main__":
     plist = GetHDIInfo()
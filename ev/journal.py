@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+This module implements the checkpoint journal for backup/restore, so an interrupted
+transfer (laptop went to sleep, Ctrl-C, disk filled up) picks up where it left off
+instead of starting over. The journal lives next to the vault's C_EVPlist state, and
+is an append-only file with one JSON record per line:
+
+    {"op": "begin", "direction": "backup", "src": "...", "dst": "..."}
+    {"op": "plan", "copy": [["1a", 8388608], ...], "delete": ["2f", ...]}
+    {"op": "tmp", "path": "..."}         about to write this temp file
+    {"op": "done", "band": "1a", "size": 8388608, "mtime_ns": ...}
+                                         band renamed into place on the destination,
+                                         with the size and mtime the source had
+    {"op": "deleted", "band": "2f"}      band deleted from the destination
+    {"op": "commit"}                     metadata written, the transfer is complete
+
+A journal without a commit record is a transfer that didn't finish. Any temp files
+it mentions are half-written and get cleaned up. Its plan isn't replayed, though:
+either store may have changed since (Dropbox synced more bands, LOCAL was written),
+so the stores are diffed again, and a band the journal says is done is only skipped
+if the source still has the size and mtime it had when it was copied. A 'done'
+record that didn't make it to disk just means that band gets copied again, which is
+harmless.
+"""
+
+import os
+import json
+import threading
+
+class C_TransferJournal:
+    """This object abstracts the transfer journal of one vault.
+
+    path - The journal file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def Records(self):
+        """Returns the list of records in the journal. A torn last line (we were
+        killed in the middle of writing it) is ignored."""
+        records = []
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+
+        return records
+
+    def Pending(self):
+        """Returns a dictionary describing the unfinished transfer in the journal, or
+        None if there isn't one:
+
+            direction, src, dst - from the begin record
+            copy, delete        - what was left of the plan, for reporting only; a
+                                  resume diffs again (see the module docstring)
+            done                - band -> (size, mtime_ns) of the source, for the
+                                  bands that are done (see the module docstring)
+            tmp                 - temp files that may have been left behind
+        """
+        records = self.Records()
+
+        if not records or records[0].get('op') != 'begin' or records[-1].get('op') == 'commit':
+            return None
+
+        pending = {'direction': records[0]['direction'], 'src': records[0]['src'],
+                   'dst': records[0]['dst'], 'copy': None, 'delete': None, 'done': {}, 'tmp': []}
+
+        done = set()
+        deleted = set()
+
+        for record in records[1:]:
+            op = record.get('op')
+            if op == 'plan':
+                pending['copy'] = [tuple(c) for c in record['copy']]
+                pending['delete'] = list(record['delete'])
+            elif op == 'tmp':
+                pending['tmp'].append(record['path'])
+            elif op == 'done':
+                done.add(record['band'])
+                if 'size' in record and 'mtime_ns' in record:
+                    pending['done'][record['band']] = (record['size'], record['mtime_ns'])
+            elif op == 'deleted':
+                deleted.add(record['band'])
+
+        if pending['copy'] is None:
+            return None     # never got as far as a plan, so there's nothing to resume
+
+        pending['copy'] = [c for c in pending['copy'] if c[0] not in done]
+        pending['delete'] = [d for d in pending['delete'] if d not in deleted]
+
+        return pending
+
+    def Cleanup(self, pending):
+        """Remove the temp files an unfinished transfer may have left behind. Returns
+        the number that were actually there."""
+        removed = 0
+
+        for path in pending['tmp']:
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+
+        return removed
+
+    def write(self, record, sync=False):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    def Begin(self, direction, src, dst, copy, delete):
+        """Start a new journal for a transfer of direction from src to dst with the
+        given plan (see ev.bandsync.SyncLists()). Any old journal is thrown away."""
+        self.Close()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'w', encoding='utf-8')
+
+        self.write({'op': 'begin', 'direction': direction, 'src': src, 'dst': dst})
+        self.write({'op': 'plan', 'copy': [list(c) for c in copy], 'delete': list(delete)}, sync=True)
+
+    def Resume(self):
+        """Reopen the journal to append to it, when resuming an unfinished transfer"""
+        self.Close()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def TempFile(self, path):
+        self.write({'op': 'tmp', 'path': path})
+
+    def Done(self, band, size=None, mtime_ns=None):
+        """band is on the destination now. size and mtime_ns are what the source had
+        when it was read, so a resume can tell if it changed since."""
+        record = {'op': 'done', 'band': band}
+        if size is not None and mtime_ns is not None:
+            record.update(size=size, mtime_ns=mtime_ns)
+        self.write(record)
+
+    def Deleted(self, band):
+        self.write({'op': 'deleted', 'band': band})
+
+    def Commit(self):
+        self.write({'op': 'commit'}, sync=True)
+
+    def Committed(self):
+        """Returns True if the last transfer in the journal ran to completion"""
+        records = self.Records()
+        return bool(records) and records[-1].get('op') == 'commit'
+
+    def Close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def Discard(self):
+        """Forget the journal (after a commit, or when the plan can't be trusted)"""
+        self.Close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+"""
+This module keeps a persistent band manifest for a vault store, so that we don't
+have to list and stat every band each time someone asks about a vault. The manifest
+is a small binary file that is memory-mapped when it's loaded:
+
+    header  - magic, version, crc32 of the records, st_dev, st_ino and st_mtime_ns
+              of the bands directory, and the record count
+    records - one per band, sorted by band number: number, size, mtime_ns, inode
+
+Sparsebundle band names are lower case hex numbers, which is why a band is stored
+as a number and not as a string. If a store has a band that isn't named that way,
+we can't describe it in the manifest, so we just don't write one for that store.
+
+Refreshing works like this:
+
+1. If the bands directory has the same device, inode and mtime as when the manifest
+   was written, no band was added, removed or renamed, so the manifest is used as-is.
+2. Otherwise, the directory is listed once, and only entries whose inode changed or
+   that weren't in the manifest are stat'ed. Dropbox and rsync both replace files by
+   renaming a temp file over the band, which always gives it a new inode.
+3. If the manifest is missing, from another directory, or fails any of the sanity
+   checks, we fall back to a full scan.
+
+Bands that are rewritten in place (i.e. while the image is attached) don't change the
+directory or their inode. That never happens to a Dropbox or replica store, but it
+does to LOCAL, and not only through 'ev mount': Finder or a plain 'hdiutil attach'
+writes the bands just the same, and nobody tells us. So a manifest made with
+inplace=True (LOCAL's) doesn't trust any of the above, and every Refresh() is a full
+scan. The manifest and summary are only rewritten when the scan comes out different,
+which keeps Summary() honest for LOCAL without rehashing anything most of the time.
+
+That does cost something: refreshing LOCAL is a listing and a stat per band (about
+1.3 times a bare ScanBands()), not the couple of stats of step 1, and everything
+built on the manifest (the Merkle in-sync check, the dirty band journal, the saved
+plan) pays it for LOCAL. A cheaper signal, like a mount counter in the vault plist,
+would only know about the attaches ev did itself, and those aren't the problem.
+
+The last table each manifest handed out is also remembered in memory, by manifest
+file, so a long-running process (see ev.daemon) doesn't even read the file again
+while the directory is unchanged.
+
+Every time the manifest is written, the Merkle summary of the bands (see ev.merkle)
+is written next to it, rehashing only the leaves that the refresh saw change.
+"""
+
+import os
+import struct
+
+from ev.bandscan import BandEntry, ScanBands
+
+MANIFEST_MAGIC = b'EVBM'
+MANIFEST_VERSION = 1
+
+_header = struct.Struct('<4sIIQQqQ')
+_record = struct.Struct('<QqqQ')    # see ev.bandtable, which reads these in bulk
+
+# If the bands directory was modified this close to the time we wrote the manifest,
+# another change could land within the same timestamp tick and we'd never notice. So
+# don't trust the directory mtime next time (same idea as git's "racy" index entries).
+RACY_WINDOW_NS = 2 * 1000000000
+
+# Manifest file -> ((dev, ino, mtime_ns) of the bands directory, C_BandTable)
+_memo = {}
+
+def BandNumber(name):
+    """Returns the band number for a band file name, or None if the name isn't the
+    canonical lower case hex that hdiutil uses."""
+    try:
+        number = int(name, 16)
+    except ValueError:
+        return None
+
+    return number if '%x' % number == name else None
+
+def BandName(number):
+    """Returns the band file name for a band number."""
+    return '%x' % number
+
+class C_BandManifest:
+    """This object abstracts the on-disk band manifest for one bands directory.
+
+    bands - The bands directory of the sparsebundle
+    store - The manifest file to use
+    inplace - Bands may be rewritten in place without the directory changing, so
+              don't trust it (see the module docstring)
+    """
+    def __init__(self, bands, store, inplace=False):
+        self.bands = bands
+        self.store = store
+        self.inplace = inplace
+        self.summary = os.path.splitext(store)[0] + '.merkle'
+
+    def Invalidate(self):
+        """Throw away the manifest, so the next Refresh() does a full scan."""
+        _memo.pop(self.store, None)
+
+        for path in (self.store, self.summary):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def Summary(self):
+        """Returns the C_MerkleSummary of the bands, if the bands directory hasn't
+        changed since it was written, otherwise None. This is one stat and a small
+        read; it doesn't load the manifest.
+
+        With inplace, the directory stat proves nothing, so this is a Refresh()
+        first, and then the summary it left."""
+        from ev.merkle import C_MerkleSummary
+
+        if self.inplace:
+            if self.Refresh() is None:
+                return None
+            return C_MerkleSummary.Load(self.summary)
+
+        try:
+            dirstat = os.stat(self.bands)
+        except FileNotFoundError:
+            return None
+
+        summary = C_MerkleSummary.Load(self.summary)
+        if summary is None or summary.dirstat != (dirstat.st_dev, dirstat.st_ino, dirstat.st_mtime_ns):
+            return None
+
+        return summary
+
+    def Load(self):
+        """Load the manifest from disk.
+
+        Returns:
+            None - If there is no usable manifest
+            (header, table) - header is the dir (dev, ino, mtime_ns) tuple, and table
+                              is a C_BandTable of the bands"""
+
+        import mmap
+        from zlib import crc32
+        from ev.bandtable import C_BandTable
+
+        try:
+            with open(self.store, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < _header.size:
+                    return None
+
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    magic, version, crc, dev, ino, mtime_ns, count = _header.unpack_from(mm)
+
+                    if magic != MANIFEST_MAGIC or version != MANIFEST_VERSION:
+                        return None
+
+                    if size != _header.size + count * _record.size:
+                        return None
+
+                    body = memoryview(mm)[_header.size:]
+                    try:
+                        if crc32(body) != crc:
+                            return None
+
+                        table = C_BandTable.FromRecordBytes(body)
+                    finally:
+                        body.release()
+
+        except (OSError, ValueError, struct.error):
+            return None
+
+        return (dev, ino, mtime_ns), table
+
+    def Save(self, dirstat, table, changed=None):
+        """Write the manifest for the bands directory described by dirstat. The file
+        is written to a temp file first and renamed, so readers never see half of it.
+
+        changed - The band numbers that were added, removed or modified since the
+                  last Save(), so the summary only rehashes those. None means all."""
+
+        from zlib import crc32
+
+        body = table.ToRecordBytes()
+
+        mtime_ns = dirstat.st_mtime_ns
+
+        from time import time_ns
+        if time_ns() - mtime_ns < RACY_WINDOW_NS:
+            mtime_ns = 0    # never matches, so the next refresh lists the directory
+
+        header = _header.pack(MANIFEST_MAGIC, MANIFEST_VERSION, crc32(body),
+                              dirstat.st_dev, dirstat.st_ino, mtime_ns, table.BandCount())
+
+        os.makedirs(os.path.dirname(self.store), exist_ok=True)
+
+        tmp = self.store + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(header)
+            f.write(body)
+
+        os.replace(tmp, self.store)
+
+        self.save_summary((dirstat.st_dev, dirstat.st_ino, mtime_ns), table, changed)
+
+    def save_summary(self, dirstat, table, changed):
+        from ev.merkle import C_MerkleSummary
+
+        summary = C_MerkleSummary.Load(self.summary) if changed is not None else None
+
+        if summary is None:
+            summary = C_MerkleSummary.FromTable(table, dirstat)
+        else:
+            summary = summary.Update(table, changed, dirstat)
+
+        summary.Save(self.summary)
+
+    def Refresh(self):
+        """Bring the manifest up to date with the bands directory, doing as little
+        work as possible, and return the current bands.
+
+        Returns:
+            None - If the bands directory doesn't exist
+            C_BandTable - The bands, sorted by band number"""
+
+        from time import time_ns
+        from ev.bandtable import C_BandTable
+
+        try:
+            dirstat = os.stat(self.bands)
+        except FileNotFoundError:
+            return None
+
+        if self.inplace:
+            return self.refresh_inplace(dirstat)
+
+        key = (dirstat.st_dev, dirstat.st_ino, dirstat.st_mtime_ns)
+
+        memo = _memo.get(self.store)
+        if memo is not None and memo[0] == key:
+            return memo[1]
+
+        cached = self.Load()
+
+        if cached is not None:
+            (dev, ino, mtime_ns), table = cached
+
+            if (dev, ino) != (dirstat.st_dev, dirstat.st_ino):
+                cached = None       # someone replaced the directory, start over
+
+            elif mtime_ns == dirstat.st_mtime_ns:
+                # Nothing was added, removed or renamed since we wrote the manifest
+                _memo[self.store] = (key, table)
+                return table
+
+        known = {}
+        if cached is not None:
+            table = cached[1]
+            known = dict(zip(table.numbers.tolist(), table.Entries()))
+
+        entries = []
+        changed = set() if cached is not None else None
+        manifestable = True
+
+        with os.scandir(self.bands) as it:
+            for entry in it:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+
+                number = BandNumber(entry.name)
+                if number is None:
+                    manifestable = False
+                    break
+
+                band = known.get(number)
+
+                # entry.inode() comes from readdir, so this costs nothing
+                if band is None or band.ino != entry.inode():
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+
+                    band = BandEntry(entry.name, st.st_size, st.st_mtime_ns, st.st_ino)
+
+                    if changed is not None:
+                        changed.add(number)
+
+                entries.append(band)
+
+        if not manifestable:
+            # Something in there we can't describe, so just hand back a full scan
+            self.Invalidate()
+            return C_BandTable.FromEntries(ScanBands(self.bands))
+
+        table = C_BandTable.FromEntries(entries)
+
+        if changed is not None:
+            # ... and the ones that went away
+            changed.update(set(known) - {BandNumber(e.name) for e in entries})
+
+        try:
+            self.Save(dirstat, table, changed)
+        except OSError:
+            pass    # the manifest is only a cache, so don't fail the scan over it
+        else:
+            if time_ns() - dirstat.st_mtime_ns >= RACY_WINDOW_NS:
+                _memo[self.store] = (key, table)
+
+        return table
+
+    def refresh_inplace(self, dirstat):
+        """Refresh() for bands that can be rewritten in place: a full scan, compared
+        with the manifest on disk, which is only rewritten if it's different."""
+        from ev.bandtable import C_BandTable
+
+        entries = ScanBands(self.bands)
+        if entries is None:
+            return None
+
+        table = C_BandTable.FromEntries(entries)
+
+        if table.extras:
+            self.Invalidate()
+            return table
+
+        body = table.ToRecordBytes()
+
+        try:
+            with open(self.store, 'rb') as f:
+                same = f.read()[_header.size:] == body
+        except OSError:
+            same = False
+
+        if same and os.path.exists(self.summary):
+            return table
+
+        try:
+            self.Save(dirstat, table)
+        except OSError:
+            pass    # the manifest is only a cache, so don't fail the scan over it
+
+        return table
+
+if __name__ == "__main__":
+    import sys
+
+    table = C_BandManifest(sys.argv[1], sys.argv[2]).Refresh()
+
+    for entry in table.Entries() if table is not None else []:
+        print(entry)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""
+This module keeps a Merkle summary of the bands in a store, so telling whether two
+stores are in sync doesn't mean comparing every band. Bands are grouped by number
+into ranges of LEAF_SPAN, and each range that has any bands gets a leaf hash over
+the (number, size, mtime in seconds) of its bands; that's exactly what the band
+diff compares, so two stores the diff calls the same have the same leaves. Leaves
+are hashed together FANOUT at a time, level by level, up to a single root.
+
+Two stores are in sync if their roots match. If they don't, Compare() walks down
+from the root, only into the subtrees whose hashes differ, and returns the band
+number ranges that are different.
+
+The band manifest (see ev.manifest) writes the summary next to itself, and only
+rehashes the leaves whose ranges had bands added, removed or changed. It's trusted
+under the same rule as the manifest: the bands directory has to have the same
+device, inode and mtime as when it was written. Checking that is one stat, so an
+in-sync check costs about the same no matter how many bands there are. For LOCAL,
+whose bands can be rewritten in place, the manifest rescans the bands first (see
+ev.manifest), so there it saves the diff but not the stats.
+"""
+
+import os
+import json
+import struct
+from hashlib import blake2b
+
+LEAF_BITS = 8
+LEAF_SPAN = 1 << LEAF_BITS      # bands per leaf
+FANOUT = 16
+
+# Enough levels above the leaves to cover every 64-bit band number
+DEPTH = (64 - LEAF_BITS + 3) // 4
+
+HASH_SIZE = 16
+
+_key = struct.Struct('<Qqq')    # number, size, mtime in seconds
+
+def _hash(data):
+    return blake2b(data, digest_size=HASH_SIZE).digest()
+
+def LeafHash(table, leaf):
+    """Returns the hash of leaf (a range of LEAF_SPAN band numbers) of the
+    C_BandTable table, or None if there are no bands in that range"""
+    from ev.bandtable import NS_PER_SEC
+
+    start, stop = table.Range(leaf << LEAF_BITS, ((leaf + 1) << LEAF_BITS) - 1)
+    if start == stop:
+        return None
+
+    return _hash(b''.join(_key.pack(int(table.numbers[i]), int(table.sizes[i]), int(table.mtimes[i]) // NS_PER_SEC)
+                          for i in range(start, stop)))
+
+def LeafHashes(table):
+    """Returns a dictionary of leaf index -> leaf hash for the bands in the
+    C_BandTable table. The extras can't be summarized, so check for them first."""
+    leaves = {}
+
+    for leaf in sorted({int(n) >> LEAF_BITS for n in table.numbers}):
+        leaves[leaf] = LeafHash(table, leaf)
+
+    return leaves
+
+class C_MerkleSummary:
+    """The Merkle summary of one store.
+
+    leaves - Dictionary of leaf index -> leaf hash (see LeafHashes())
+    count - Number of bands summarized
+    dirstat - The (dev, ino, mtime_ns) of the bands directory it describes
+    """
+    def __init__(self, leaves, count, dirstat=None):
+        self.leaves = leaves
+        self.count = count
+        self.dirstat = dirstat
+        self.levels = None
+
+    @classmethod
+    def FromTable(cls, table, dirstat=None):
+        return cls(LeafHashes(table), table.BandCount(), dirstat)
+
+    def Update(self, table, changed, dirstat=None):
+        """Returns a new summary for table, which is this summary's table with the
+        band numbers in changed added, removed or modified. Only the leaves those
+        bands fall in are rehashed."""
+        leaves = dict(self.leaves)
+
+        for leaf in {number >> LEAF_BITS for number in changed}:
+            digest = LeafHash(table, leaf)
+            if digest is None:
+                leaves.pop(leaf, None)
+            else:
+                leaves[leaf] = digest
+
+        return C_MerkleSummary(leaves, table.BandCount(), dirstat)
+
+    def Levels(self):
+        """Returns the list of levels, leaves first, root last. Each level is a
+        dictionary of node index -> hash. The depth is fixed (see DEPTH), so two
+        trees always have the same shape, however many bands they have."""
+        if self.levels is None:
+            levels = [self.leaves]
+            for _ in range(DEPTH):
+                children = {}
+                for index in sorted(levels[-1]):
+                    children.setdefault(index // FANOUT, []).append(index.to_bytes(8, 'little') + levels[-1][index])
+                levels.append({index: _hash(b''.join(parts)) for index, parts in children.items()})
+            self.levels = levels
+
+        return self.levels
+
+    def Root(self):
+        """Returns the root hash as hex. An empty store has a root too."""
+        return self.Levels()[-1].get(0, _hash(b'')).hex()
+
+    def Compare(self, other):
+        """Returns the list of (first, last) band number ranges where this summary
+        and other differ, or [] if they're the same."""
+        mine = self.Levels()
+        theirs = other.Levels()
+
+        differing = []
+
+        def descend(level, index):
+            if mine[level].get(index) == theirs[level].get(index):
+                return
+            if level == 0:
+                differing.append((index << LEAF_BITS, ((index + 1) << LEAF_BITS) - 1))
+                return
+            for child in range(index * FANOUT, (index + 1) * FANOUT):
+                if child in mine[level - 1] or child in theirs[level - 1]:
+                    descend(level - 1, child)
+
+        descend(DEPTH, 0)
+
+        return differing
+
+    @classmethod
+    def Load(cls, path):
+        """Load a summary file. Returns None if it's missing or no good."""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+
+            return cls({int(k): bytes.fromhex(v) for k, v in data['leaves'].items()},
+                       data['count'], tuple(data['dirstat']))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def Save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'dirstat': list(self.dirstat), 'count': self.count,
+                       'leaves': {str(k): v.hex() for k, v in self.leaves.items()}}, f)
+
+        os.replace(tmp, path)
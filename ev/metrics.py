@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+This module writes the state of a vault as a Prometheus node-exporter textfile, so
+a fleet of computers can be watched for vaults that are drifting (bands piling up
+on one side) or stuck (no backup for days) without anybody scanning them. Point
+MetricsPath (see C_EVDefaults) at the textfile collector directory; each vault gets
+its own ev_VAULT.prom there, rewritten after every verb that changes the vault (see
+C_EncryptedVault.lookup()), and by the 'metrics' verb.
+
+Everything comes from the vault plist (see C_EVPlist) and the vault's metrics state
+(see C_MetricsState), so writing the file doesn't scan anything. The band counts are
+from the last time a verb compared the stores (ev_vault_bands_checked_timestamp_seconds
+says when).
+
+All the metrics have a vault label:
+
+    ev_vault_bands{store}                         bands in the LOCAL and Dropbox stores
+    ev_vault_newer_bands                          LOCAL bands newer than Dropbox (or only in LOCAL)
+    ev_vault_older_bands                          LOCAL bands older than Dropbox
+    ev_vault_remote_only_bands                    bands only Dropbox has
+    ev_vault_size_changed_bands                   same time, different size
+    ev_vault_bands_checked_timestamp_seconds      when those were counted
+    ev_vault_needs_backup                         1 if it was mounted RW since the last backup
+    ev_vault_mounted                              1 if the plist says it's mounted
+    ev_vault_last_sync_duration_seconds{direction}
+    ev_vault_last_sync_bytes{direction}
+    ev_vault_last_sync_timestamp_seconds{direction}
+    ev_vault_seconds_since_last_sync              since the last backup or restore, as of the write
+    ev_vault_operations_total{verb, result}       verbs run that change the vault, result is ok or error
+    ev_vault_transferred_bytes_total{direction}   bytes written by backups and restores
+
+Alert on time() - ev_vault_last_sync_timestamp_seconds rather than on
+ev_vault_seconds_since_last_sync, since the file only changes when ev runs.
+"""
+
+import os
+import time
+
+# name -> (type, help)
+METRICS = {
+    'ev_vault_bands': ('gauge', 'Bands in each store of the vault'),
+    'ev_vault_newer_bands': ('gauge', 'LOCAL bands that are newer than Dropbox, or only in LOCAL'),
+    'ev_vault_older_bands': ('gauge', 'LOCAL bands that are older than Dropbox'),
+    'ev_vault_remote_only_bands': ('gauge', 'Bands that only Dropbox has'),
+    'ev_vault_size_changed_bands': ('gauge', 'Bands with the same time but a different size'),
+    'ev_vault_bands_checked_timestamp_seconds': ('gauge', 'When the band counts were taken'),
+    'ev_vault_needs_backup': ('gauge', '1 if the vault was mounted read/write since its last backup'),
+    'ev_vault_mounted': ('gauge', '1 if the vault is mounted'),
+    'ev_vault_last_sync_duration_seconds': ('gauge', 'How long the last backup or restore took'),
+    'ev_vault_last_sync_bytes': ('gauge', 'Bytes written by the last backup or restore'),
+    'ev_vault_last_sync_timestamp_seconds': ('gauge', 'When the last backup or restore committed'),
+    'ev_vault_seconds_since_last_sync': ('gauge', 'Seconds since the last backup or restore, when this was written'),
+    'ev_vault_operations_total': ('counter', 'Verbs that change the vault run on it'),
+    'ev_vault_transferred_bytes_total': ('counter', 'Bytes written by backups and restores'),
+}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class C_MetricsState:
+    """The operation counters and the last band state of one vault. These change
+    after every verb that changes the vault, even when the plist doesn't, so they're
+    kept in a small JSON file of their own next to the vault plist:
+
+        {"operations": {verb: {result: count}}, "transferred": {direction: bytes},
+         "band-state": {... the analyzeBands() state ..., "checked": time}}
+
+    Updates are serialized with a lock file, so two ev processes don't lose each
+    other's counts, and the file is replaced atomically, so readers don't need it.
+
+    path - The state file
+    plist - The vault's C_EVPlist, which is where these used to be kept. Its old
+            values are the starting point if the state file isn't there yet.
+    """
+    def __init__(self, path, plist=None):
+        self.path = path
+        self.plist = plist
+        self.state = self.Load()
+
+    def Load(self):
+        import json
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if isinstance(state, dict):
+                return state
+        except (OSError, ValueError):
+            pass
+
+        old = self.plist.GetPlist() if self.plist is not None else {}
+        counters = old.get('counters', {})
+        return {'operations': counters.get('operations', {}), 'transferred': counters.get('transferred', {}),
+                'band-state': old.get('band-state', {})}
+
+    def Counters(self):
+        """Returns the counters: operations (verb -> result -> count) and transferred
+        (direction -> bytes)"""
+        return {'operations': self.state.get('operations', {}), 'transferred': self.state.get('transferred', {})}
+
+    def BandState(self):
+        """Returns the last analyzeBands() state, plus when it was taken (checked),
+        or {} if there hasn't been one"""
+        return self.state.get('band-state', {})
+
+    def Record(self, verb=None, result=None, direction=None, nbytes=0, bandstate=None):
+        """Count one run of verb with result ('ok' or 'error'), nbytes written in
+        direction, and remember bandstate, all in one update of the file"""
+        import json
+        import fcntl
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+            # Somebody else may have counted something since we loaded it
+            state = self.Load()
+
+            if verb is not None:
+                results = state.setdefault('operations', {}).setdefault(verb, {})
+                results[result] = results.get(result, 0) + 1
+            if direction is not None and nbytes:
+                transferred = state.setdefault('transferred', {})
+                transferred[direction] = transferred.get(direction, 0) + nbytes
+            if bandstate is not None:
+                state['band-state'] = dict(bandstate, checked=time.time())
+
+            tmp = self.path + '.%d.tmp' % os.getpid()
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(state, f, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+
+        self.state = state
+
+class C_VaultMetrics:
+    """The metrics of one vault.
+
+    vaultname - Name of the vault
+    plist - Its C_EVPlist
+    state - Its C_MetricsState
+    now - The time to compute ages from (time.time() by default)
+    """
+    def __init__(self, vaultname, plist, state, now=None):
+        self.vaultname = vaultname
+        self.plist = plist
+        self.state = state
+        self.now = time.time() if now is None else now
+
+    def Samples(self):
+        """Returns the list of (name, labels, value)"""
+        samples = []
+
+        def add(name, value, **labels):
+            samples.append((name, dict(vault=self.vaultname, **labels), value))
+
+        state = self.state.BandState()
+        if state:
+            add('ev_vault_bands', state['localcount'], store='local')
+            add('ev_vault_bands', state['remotecount'], store='remote')
+            add('ev_vault_newer_bands', state['newerbands'])
+            add('ev_vault_older_bands', state['olderbands'])
+            add('ev_vault_remote_only_bands', state['remoteonlybands'])
+            add('ev_vault_size_changed_bands', state['sizechangedbands'])
+            add('ev_vault_bands_checked_timestamp_seconds', state['checked'])
+
+        add('ev_vault_needs_backup', bool(self.plist.NeedsBackup()))
+        add('ev_vault_mounted', bool(self.plist.Mounted()))
+
+        last = self.plist.LastSync()
+        for direction, info in sorted(last.items()):
+            add('ev_vault_last_sync_duration_seconds', float(info['seconds']), direction=direction)
+            add('ev_vault_last_sync_bytes', info['bytes'], direction=direction)
+            add('ev_vault_last_sync_timestamp_seconds', float(info['time']), direction=direction)
+        if last:
+            add('ev_vault_seconds_since_last_sync', max(0.0, self.now - max(info['time'] for info in last.values())))
+
+        counters = self.state.Counters()
+        for verb, results in sorted(counters.get('operations', {}).items()):
+            for result, count in sorted(results.items()):
+                add('ev_vault_operations_total', count, verb=verb, result=result)
+        for direction, nbytes in sorted(counters.get('transferred', {}).items()):
+            add('ev_vault_transferred_bytes_total', nbytes, direction=direction)
+
+        return samples
+
+    def Text(self):
+        """Returns the samples in the Prometheus text exposition format"""
+        lines = []
+        seen = set()
+
+        for name, labels, value in sorted(self.Samples(), key=lambda s: list(METRICS).index(s[0])):
+            if name not in seen:
+                seen.add(name)
+                kind, text = METRICS[name]
+                lines.append('# HELP %s %s' % (name, text))
+                lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s{%s} %s' % (name, ','.join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items())),
+                                        _value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def Write(self, directory):
+        """Write the textfile into directory, atomically (the collector reads *.prom,
+        so it never sees a half-written one). Returns its path."""
+        os.makedirs(directory, exist_ok=True)
+
+        path = os.path.join(directory, 'ev_%s.prom' % self.vaultname)
+        tmp = path + '.%d.tmp' % os.getpid()
+
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.Text())
+
+        os.replace(tmp, path)
+
+        return path
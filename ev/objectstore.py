@@ -0,0 +1,571 @@
+#!/usr/bin/env python3
+
+"""
+This module is the storage backend for vault stores that aren't directories, i.e.
+S3-compatible object stores, so a vault can be replicated to one without going
+through a Dropbox folder. A backend only knows about keys and objects:
+
+    List        one page of the objects "in a directory" (a key prefix ending in /)
+    Stat        size, time, ETag and user metadata of one object (a HEAD)
+    ReadRange   bytes of an object, from an offset
+    Write       put a whole object, with user metadata
+    Delete      a batch of objects
+
+Every request goes through a C_ConnectionPool, so a sync running on several threads
+reuses a handful of connections instead of opening one per band.
+
+There are two backends, picked by the URL given as RemotePath or in ReplicaPaths:
+
+    s3://bucket/prefix          an S3-compatible store (needs boto3, see
+                                C_EVDefaults.ObjectStore for the endpoint, etc.)
+    objdir:///some/directory    a directory that behaves like an object store, for
+                                testing without a network (see C_DirectoryBackend)
+
+The vault store on top of a backend is C_ObjectVaultStore (see ev.cryptvault), and
+the sync engine is ev.objectsync.
+
+A band's mtime is user metadata, which listings don't return, and stat'ing every band
+would be a round trip per band. So each vault keeps a band index object next to it:
+the band table (number, size, mtime_ns and a hash of the ETag, in the manifest record
+layout, see ev.manifest) as of the last sync. Loading the bands is a paged listing
+plus one GET of the index; only bands whose ETag isn't the one in the index get a
+Stat. It's the object store version of the manifest's inode check.
+"""
+
+import os
+import time
+import struct
+import threading
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from contextlib import contextmanager
+
+# What a listing or a Stat returns. metadata is None in a listing, since object stores
+# don't return user metadata there.
+ObjectInfo = namedtuple('ObjectInfo', ['key', 'size', 'modified_ns', 'etag', 'metadata'])
+
+# The user metadata the sync engine puts on the objects it writes
+META_MTIME = 'ev-mtime-ns'
+META_MODE = 'ev-mode'
+
+PAGE_SIZE = 1000        # objects per listing page; 1000 is the most S3 hands out
+DELETE_BATCH = 1000     # keys per Delete request, same limit
+CONNECTIONS = 8
+
+# A band number no band has, for names that aren't band numbers
+NO_BAND = (1 << 64) - 1
+
+INDEX_MAGIC = b'EVBI'
+INDEX_VERSION = 1
+
+_index_header = struct.Struct('<4sIIQ')     # magic, version, crc32 of the records, count
+
+# URL -> (backend, key prefix), so every store on the same URL shares a pool
+_backends = {}
+_backends_lock = threading.Lock()
+
+class ObjectStoreError(OSError):
+    """A request to the object store failed. It's an OSError, so the sync engines
+    treat it like any other I/O error (the transfer journal has the rest)."""
+    pass
+
+def IsObjectURL(path):
+    """Returns True if path is an object store URL, not a directory"""
+    return '://' in path
+
+def ETagNumber(etag):
+    """Returns a 64-bit number for an ETag. It goes where the inode goes in a band
+    table, and says the same thing: if it changed, so did the band."""
+    from hashlib import blake2b
+
+    return int.from_bytes(blake2b(etag.encode('utf-8'), digest_size=8).digest(), 'little')
+
+class C_ConnectionPool:
+    """Hands out up to size connections, made by factory when needed, and takes them
+    back for the next request. Use it as:
+
+        with pool.Connection() as conn:
+            ...
+    """
+    def __init__(self, factory, size=CONNECTIONS):
+        self.factory = factory
+        self.size = max(1, int(size))
+        self.idle = []
+        self.created = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def Connection(self):
+        with self.cond:
+            while not self.idle and self.created >= self.size:
+                self.cond.wait()
+            if self.idle:
+                conn = self.idle.pop()
+            else:
+                conn = self.factory()
+                self.created += 1
+
+        try:
+            yield conn
+        finally:
+            with self.cond:
+                self.idle.append(conn)
+                self.cond.notify()
+
+class C_StorageBackend(ABC):
+    """What every backend does (see the module docstring). Keys are strings with /
+    in them, like paths, but there are no directories, just prefixes. A backend
+    that's missing one of the requests can't even be created, so it fails right
+    away instead of partway through a sync.
+
+    page_size - Objects per List() page
+    connections - Size of the connection pool, and so how many requests can be
+                  running at the same time
+    """
+    def __init__(self, page_size=PAGE_SIZE, connections=CONNECTIONS):
+        self.page_size = int(page_size)
+        self.connections = int(connections)
+        self.lock = threading.Lock()
+        self.requests = {}      # request kind -> count, for the spans and benchmarks
+
+    def count(self, kind, n=1):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + n
+
+    @abstractmethod
+    def Online(self):
+        """Returns True if the store can be reached"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def List(self, prefix, token=None):
+        """Returns (objects, token): a list of ObjectInfo for a page of the objects
+        whose keys start with prefix and have no / after it, in key order, and the
+        token for the next page (None if this was the last one)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def Stat(self, key):
+        """Returns the ObjectInfo of key, with its metadata, or None if there isn't one"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def ReadRange(self, key, offset, length):
+        """Returns up to length bytes of key, starting at offset"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def Write(self, key, data, metadata=None):
+        """Put data as key, with the metadata dictionary (string values). Returns its
+        ObjectInfo."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def Delete(self, keys):
+        """Delete keys, which can be more than DELETE_BATCH of them. Keys that aren't
+        there are fine. Returns the number of keys."""
+        raise NotImplementedError
+
+    def ListAll(self, prefix):
+        """Generator that returns every page of List(prefix)"""
+        token = None
+        while True:
+            objects, token = self.List(prefix, token)
+            yield objects
+            if token is None:
+                return
+
+class C_DirectoryBackend(C_StorageBackend):
+    """An object store that's a directory, for tests and benchmarks. It acts like
+    the real thing where it matters: listings are paged and don't have the user
+    metadata (that's in a side file, .evmeta/KEY, that only Stat() reads), the
+    ETag changes every time an object is written, and every request can be made to
+    take latency seconds, like a round trip would. Nothing is fsync'ed; it's only
+    for testing.
+
+    root - The directory the objects are in
+    """
+    def __init__(self, root, page_size=PAGE_SIZE, connections=CONNECTIONS, latency=0.0):
+        C_StorageBackend.__init__(self, page_size, connections)
+        self.root = root
+        self.latency = float(latency)
+        self.pool = C_ConnectionPool(lambda: object(), connections)
+
+        # Listings in progress: token -> sorted names, so each page isn't another
+        # listing of the whole directory (S3 keeps a cursor on its side, too)
+        self.listings = {}
+
+    @contextmanager
+    def request(self, kind):
+        with self.pool.Connection():
+            self.count(kind)
+            if self.latency:
+                time.sleep(self.latency)
+            yield
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def metapath(self, key):
+        return os.path.join(self.root, '.evmeta', *key.split('/'))
+
+    def etag(self, st):
+        return '%x-%x-%x' % (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def Online(self):
+        return os.path.isdir(self.root)
+
+    def List(self, prefix, token=None):
+        import itertools
+
+        with self.request('list'):
+            folder, _, start = prefix.rpartition('/')
+            directory = self.path(folder) if folder else self.root
+
+            if token is None:
+                try:
+                    with os.scandir(directory) as it:
+                        names = sorted(entry.name for entry in it
+                                       if entry.name.startswith(start) and not entry.name.startswith('.ev')
+                                       and entry.is_file(follow_symlinks=False))
+                except FileNotFoundError:
+                    names = []
+                offset = 0
+                cursor = '%x' % id(names)
+            else:
+                cursor, _, offset = token.partition(':')
+                names = self.listings.pop(cursor)
+                offset = int(offset)
+
+            objects = []
+            for name in itertools.islice(names, offset, offset + self.page_size):
+                try:
+                    st = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue    # deleted since the first page, same as S3 would do
+                key = folder + '/' + name if folder else name
+                objects.append(ObjectInfo(key, st.st_size, st.st_mtime_ns, self.etag(st), None))
+
+            if offset + self.page_size >= len(names):
+                return objects, None
+
+            self.listings[cursor] = names
+            return objects, '%s:%d' % (cursor, offset + self.page_size)
+
+    def Stat(self, key):
+        import json
+
+        with self.request('stat'):
+            try:
+                st = os.stat(self.path(key))
+            except FileNotFoundError:
+                return None
+
+            etag = self.etag(st)
+            try:
+                with open(self.metapath(key), 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, ValueError):
+                meta = {}
+
+            # The side file is written after the object, so it may describe the last one
+            metadata = meta.get('metadata', {}) if meta.get('etag') == etag else {}
+
+            return ObjectInfo(key, st.st_size, st.st_mtime_ns, etag, metadata)
+
+    def ReadRange(self, key, offset, length):
+        with self.request('get'):
+            with open(self.path(key), 'rb') as f:
+                return os.pread(f.fileno(), length, offset)
+
+    def Write(self, key, data, metadata=None):
+        import json
+
+        with self.request('put'):
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            tmp = os.path.join(os.path.dirname(path), '.ev-tmp-%s.%d' % (os.path.basename(path), threading.get_ident()))
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                f.flush()
+                st = os.fstat(f.fileno())
+            os.replace(tmp, path)
+
+            etag = self.etag(st)
+
+            metapath = self.metapath(key)
+            os.makedirs(os.path.dirname(metapath), exist_ok=True)
+            with open(metapath + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'etag': etag, 'metadata': dict(metadata or {})}, f)
+            os.replace(metapath + '.tmp', metapath)
+
+            return ObjectInfo(key, st.st_size, st.st_mtime_ns, etag, dict(metadata or {}))
+
+    def Delete(self, keys):
+        keys = list(keys)
+
+        for first in range(0, len(keys), DELETE_BATCH):
+            with self.request('delete'):
+                for key in keys[first:first + DELETE_BATCH]:
+                    for path in (self.path(key), self.metapath(key)):
+                        try:
+                            os.unlink(path)
+                        except FileNotFoundError:
+                            pass
+
+        return len(keys)
+
+class C_S3Backend(C_StorageBackend):
+    """An S3-compatible object store, through boto3. Each connection in the pool is
+    a boto3 client of its own.
+
+    bucket - The bucket
+    options - C_EVDefaults.ObjectStore (endpoint_url, region, page_size, connections)
+    """
+    def __init__(self, bucket, options):
+        C_StorageBackend.__init__(self, options.get('page_size', PAGE_SIZE), options.get('connections', CONNECTIONS))
+
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise ObjectStoreError("s3:// stores need boto3, which isn't installed (pip install boto3)")
+
+        self.bucket = bucket
+
+        session = boto3.session.Session()
+        config = Config(max_pool_connections=1, retries={'max_attempts': 5, 'mode': 'standard'})
+
+        # The pool makes the clients one at a time, so the session is never shared
+        self.pool = C_ConnectionPool(lambda: session.client('s3', endpoint_url=options.get('endpoint_url') or None,
+                                                            region_name=options.get('region') or None,
+                                                            config=config),
+                                     self.connections)
+
+    @contextmanager
+    def request(self, kind):
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        with self.pool.Connection() as client:
+            self.count(kind)
+            try:
+                yield client
+            except ClientError as e:
+                raise ObjectStoreError("%s %s failed: %s" % (kind, self.bucket, e.response.get('Error', {}).get('Message', e)))
+            except BotoCoreError as e:
+                raise ObjectStoreError("%s %s failed: %s" % (kind, self.bucket, e))
+
+    def info(self, key, size, modified, etag, metadata=None):
+        return ObjectInfo(key, size, int(modified.timestamp() * 1000000) * 1000, etag, metadata)
+
+    def Online(self):
+        try:
+            with self.request('stat') as client:
+                client.head_bucket(Bucket=self.bucket)
+            return True
+        except ObjectStoreError:
+            return False
+
+    def List(self, prefix, token=None):
+        args = {'Bucket': self.bucket, 'Prefix': prefix, 'Delimiter': '/', 'MaxKeys': self.page_size}
+        if token is not None:
+            args['ContinuationToken'] = token
+
+        with self.request('list') as client:
+            reply = client.list_objects_v2(**args)
+
+        objects = [self.info(o['Key'], o['Size'], o['LastModified'], o['ETag'])
+                   for o in reply.get('Contents', [])]
+
+        return objects, reply.get('NextContinuationToken') if reply.get('IsTruncated') else None
+
+    def Stat(self, key):
+        from botocore.exceptions import ClientError
+
+        with self.pool.Connection() as client:
+            self.count('stat')
+            try:
+                reply = client.head_object(Bucket=self.bucket, Key=key)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                    return None
+                raise ObjectStoreError("stat %s failed: %s" % (key, e))
+
+        return self.info(key, reply['ContentLength'], reply['LastModified'], reply['ETag'], reply.get('Metadata', {}))
+
+    def ReadRange(self, key, offset, length):
+        if length <= 0:
+            return b''
+
+        with self.request('get') as client:
+            reply = client.get_object(Bucket=self.bucket, Key=key, Range='bytes=%d-%d' % (offset, offset + length - 1))
+            return reply['Body'].read()
+
+    def Write(self, key, data, metadata=None):
+        metadata = {k: str(v) for k, v in (metadata or {}).items()}
+
+        with self.request('put') as client:
+            reply = client.put_object(Bucket=self.bucket, Key=key, Body=data, Metadata=metadata)
+
+        return ObjectInfo(key, len(data), time.time_ns(), reply['ETag'], metadata)
+
+    def Delete(self, keys):
+        keys = list(keys)
+
+        for first in range(0, len(keys), DELETE_BATCH):
+            batch = [{'Key': key} for key in keys[first:first + DELETE_BATCH]]
+            with self.request('delete') as client:
+                reply = client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch, 'Quiet': True})
+            if reply.get('Errors'):
+                error = reply['Errors'][0]
+                raise ObjectStoreError("couldn't delete %d object(s), e.g. %s: %s" %
+                                       (len(reply['Errors']), error.get('Key'), error.get('Message')))
+
+        return len(keys)
+
+def OpenBackend(url, options=None):
+    """Returns (backend, key prefix) for an object store URL (see the module
+    docstring). There's one backend per URL, so its connections are shared."""
+    from urllib.parse import urlsplit
+
+    options = options or {}
+
+    with _backends_lock:
+        if url in _backends:
+            return _backends[url]
+
+        parts = urlsplit(url)
+
+        if parts.scheme == 'objdir':
+            backend = C_DirectoryBackend(os.path.expanduser(parts.path), options.get('page_size', PAGE_SIZE),
+                                         options.get('connections', CONNECTIONS), options.get('latency', 0.0))
+            prefix = ''
+        elif parts.scheme == 's3':
+            backend = C_S3Backend(parts.netloc, options)
+            prefix = parts.path.strip('/') + '/' if parts.path.strip('/') else ''
+        else:
+            raise ObjectStoreError("I don't know how to talk to '%s', try s3:// or objdir://" % url)
+
+        _backends[url] = (backend, prefix)
+
+        return _backends[url]
+
+class C_BandIndex:
+    """The band index object of one vault store (see the module docstring). It
+    stands in for the band manifest (see ev.manifest), so it answers the same calls.
+
+    backend - The C_StorageBackend
+    key - The key of the index object
+    """
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+
+    def Load(self):
+        """Returns the C_BandTable in the index, or None if there's no usable one"""
+        from zlib import crc32
+        from ev.bandtable import C_BandTable, COLUMNS
+
+        info = self.backend.Stat(self.key)
+        if info is None or info.size < _index_header.size:
+            return None
+
+        buf = self.backend.ReadRange(self.key, 0, info.size)
+
+        magic, version, crc, count = _index_header.unpack_from(buf)
+        records = buf[_index_header.size:]
+
+        if (magic, version) != (INDEX_MAGIC, INDEX_VERSION) or len(records) != count * 8 * COLUMNS:
+            return None
+        if crc32(records) != crc:
+            return None
+
+        return C_BandTable.FromRecordBytes(records)
+
+    def Save(self, table):
+        """Write table as the index. A table with extras can't be written (same as
+        the manifest), so the index is dropped instead, and every load stats them."""
+        from zlib import crc32
+
+        if table.extras:
+            self.Invalidate()
+            return
+
+        records = table.ToRecordBytes()
+        self.backend.Write(self.key, _index_header.pack(INDEX_MAGIC, INDEX_VERSION, crc32(records),
+                                                        table.BandCount()) + records)
+
+    def Invalidate(self):
+        """Throw away the index, so the next load stats every band"""
+        self.backend.Delete([self.key])
+
+    def Summary(self):
+        """There's no Merkle summary of an object store (see ev.merkle), so this is
+        always None and analyzeBands() compares the tables"""
+        return None
+
+def ListBands(backend, prefix, index=None, written=None):
+    """List the bands under prefix, a page at a time, and work out the mtime of each
+    one: from the index (a C_BandTable, see C_BandIndex) if the ETag is the one in
+    it, from written (name -> (size, mtime_ns, etag), bands this process just wrote),
+    or else with a Stat, on as many threads as the backend has connections.
+
+    Returns (entries, stats): a list of BandEntry (see ev.bandscan), with the ETag
+    number as the inode, or None if there are no bands at all; and a dictionary of
+    pages, listed and stated."""
+    from ev.bandscan import BandEntry
+    from ev.manifest import BandNumber
+
+    written = written or {}
+    stats = {'pages': 0, 'listed': 0, 'stated': 0}
+
+    entries = []
+    missing = []
+
+    for page in backend.ListAll(prefix):
+        stats['pages'] += 1
+        stats['listed'] += len(page)
+
+        bands = []
+        for info in page:
+            name = info.key[len(prefix):]
+            if name.startswith('.'):
+                continue
+
+            etagnumber = ETagNumber(info.etag)
+
+            if name in written and written[name][2] == info.etag:
+                entries.append(BandEntry(name, info.size, written[name][1], etagnumber))
+            else:
+                bands.append((info, name, etagnumber, BandNumber(name)))
+
+        # The index is looked up a page at a time (see C_BandTable.FindAll())
+        rows = [-1] * len(bands)
+        if index is not None:
+            rows = index.FindAll([NO_BAND if band[3] is None else band[3] for band in bands])
+
+        for (info, name, etagnumber, number), row in zip(bands, rows):
+            if number is not None and row >= 0 and int(index.inodes[row]) == etagnumber and int(index.sizes[row]) == info.size:
+                entries.append(BandEntry(name, info.size, int(index.mtimes[row]), etagnumber))
+            else:
+                missing.append(info)
+
+    def stat(info):
+        full = backend.Stat(info.key)
+        if full is None:
+            return None     # deleted since the listing
+        mtime_ns = int(full.metadata.get(META_MTIME, full.modified_ns))
+        return BandEntry(full.key[len(prefix):], full.size, mtime_ns, ETagNumber(full.etag))
+
+    if missing:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=backend.connections) as pool:
+            entries.extend(entry for entry in pool.map(stat, missing) if entry is not None)
+        stats['stated'] = len(missing)
+
+    if not entries and not stats['listed']:
+        return None, stats
+
+    return entries, stats
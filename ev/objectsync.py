@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+"""
+This module is the sync engine for when one side of a backup or restore is an object
+store (see ev.objectstore and C_ObjectVaultStore). It does what ev.bandsync does for
+two directories, in the same order, with the same journal records, so a transfer
+that's interrupted is resumed the same way:
+
+1. Every band that is new or different on the source is copied, in parallel. Going
+   up, a band is one Write of the whole band (objects can't have holes), with its
+   mtime and mode as metadata. Coming down, it's read a range at a time into a temp
+   file, the blocks that are all zeros are skipped so the holes come back, and it's
+   fsync'ed and renamed over the band with the mtime from the metadata.
+2. Bands that only exist on the destination are deleted, a batch at a time.
+3. The bundle metadata and the other files in the vault directory are copied last,
+   so the destination is mountable at every step, same as with a directory, and the
+   ones the source doesn't have are deleted.
+
+Each band written to an object store is remembered by the store (see
+C_ObjectVaultStore.Written()), so loading its bands afterwards doesn't have to stat
+what was just written.
+"""
+
+import os
+import time
+
+from ev.bandsync import COPY_CHUNK, DefaultMessageHandler, FsyncDirectory, TempPath
+
+# Runs of zeros at least this long are left as holes when writing a band to disk
+HOLE_BLOCK = 64 * 1024
+
+_zeros = memoryview(bytes(HOLE_BLOCK))
+
+def ListFiles(store, path):
+    """Returns {name: (size, mtime_ns)} for the files right in path of store (not the
+    bands). On an object store that's a Stat each, but there are only a few."""
+    if not store.objectstore:
+        files = {}
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        files[entry.name] = (st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        return files
+
+    from ev.objectstore import META_MTIME
+
+    prefix = store.getKey(path) + '/'
+    files = {}
+    for page in store.backend.ListAll(prefix):
+        for info in page:
+            full = store.backend.Stat(info.key)
+            if full is not None:
+                files[info.key[len(prefix):]] = (full.size, int(full.metadata.get(META_MTIME, full.modified_ns)))
+    return files
+
+def MetadataChanges(src, dst):
+    """Returns (copy, delete) for everything other than the bands, i.e. the files in
+    the sparsebundle itself and the files in the vault directory next to it, for a
+    sync from src to dst. copy is the (source path, destination path, size) of the
+    files that are new or have a different size or mtime (in seconds), and delete is
+    the destination paths of the files the source doesn't have. Works for any two
+    stores, object store or not."""
+    copy = []
+    delete = []
+
+    for srcdir, dstdir in ((src.getBundlePath(), dst.getBundlePath()), (src.getPath(), dst.getPath())):
+        theirs = ListFiles(dst, dstdir)
+        ours = ListFiles(src, srcdir)
+
+        for name, (size, mtime_ns) in sorted(ours.items()):
+            if name in theirs and (theirs[name][0], theirs[name][1] // 1000000000) == (size, mtime_ns // 1000000000):
+                continue
+            copy.append((srcdir + '/' + name, dstdir + '/' + name, size))
+
+        delete.extend(dstdir + '/' + name for name in sorted(set(theirs) - set(ours)))
+
+    return copy, delete
+
+class C_ObjectSync:
+    """Syncs the sparsebundle in one store (the source) to another (the destination),
+    at least one of which is a C_ObjectVaultStore. Same arguments and Run() as
+    C_BandSync (see ev.bandsync), except there are no delta transfers.
+    """
+    def __init__(self, src, dst, message=DefaultMessageHandler, workers=4, journal=None, scheduler=None):
+        from ev.scheduler import C_TransferScheduler, C_TransferPolicy
+
+        self.src = src
+        self.dst = dst
+        self.msgout = message
+        self.journal = journal
+        self.scheduler = scheduler or C_TransferScheduler(C_TransferPolicy(workers=workers))
+        self.workers = self.scheduler.policy.workers
+        self.throttle = self.scheduler.Throttle if self.scheduler.Throttled() else None
+
+        self.stats = {'copied': 0, 'deleted': 0, 'bytes': 0, 'apparent': 0, 'metadata': 0,
+                      'seconds': 0.0, 'deltas': 0, 'saved': 0}
+
+    def read_file(self, store, path):
+        """Read a whole file of store. Returns (data, mtime_ns, mode)."""
+        if not store.objectstore:
+            chunks = []
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                while True:
+                    if self.throttle is not None:
+                        self.throttle(COPY_CHUNK)
+                    chunk = f.read(COPY_CHUNK)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            return b''.join(chunks), st.st_mtime_ns, st.st_mode & 0o7777
+
+        from ev.objectstore import META_MTIME, META_MODE
+
+        key = store.getKey(path)
+        info = store.backend.Stat(key)
+        if info is None:
+            raise FileNotFoundError("%s isn't there anymore" % path)
+
+        chunks = []
+        offset = 0
+        while offset < info.size:
+            if self.throttle is not None:
+                self.throttle(min(COPY_CHUNK, info.size - offset))
+            chunk = store.backend.ReadRange(key, offset, min(COPY_CHUNK, info.size - offset))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+
+        mode = int(info.metadata.get(META_MODE, '644'), 8)
+        return b''.join(chunks), int(info.metadata.get(META_MTIME, info.modified_ns)), mode
+
+    def write_file(self, store, path, data, mtime_ns, mode, band=None):
+        """Write data as a file of store, with the given mtime and mode. band is the
+        band name, if it's a band. Returns the bytes written."""
+        if store.objectstore:
+            from ev.objectstore import META_MTIME, META_MODE
+
+            if self.throttle is not None:
+                self.throttle(len(data))
+            info = store.backend.Write(store.getKey(path), data,
+                                       {META_MTIME: str(mtime_ns), META_MODE: '%o' % mode})
+            if band is not None:
+                store.Written(band, len(data), mtime_ns, info.etag)
+            return len(data)
+
+        tmppath = TempPath(path)
+
+        if self.journal is not None and band is not None:
+            self.journal.TempFile(tmppath)
+
+        written = 0
+        try:
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                view = memoryview(data)
+                for offset in range(0, len(data), HOLE_BLOCK):
+                    block = view[offset:offset + HOLE_BLOCK]
+                    if block == _zeros[:len(block)]:
+                        continue    # leave it a hole
+                    if self.throttle is not None:
+                        self.throttle(len(block))
+                    os.pwrite(fd, block, offset)
+                    written += len(block)
+                os.ftruncate(fd, len(data))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            os.chmod(tmppath, mode)
+            os.utime(tmppath, ns=(mtime_ns, mtime_ns))
+            os.replace(tmppath, path)
+        except BaseException:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+
+        return written
+
+    def copy_band(self, name):
+        """Copy one band from the source to the destination. Returns the number of
+        bytes written to the destination."""
+        srcpath = self.src.getBands() + '/' + name
+        dstpath = self.dst.getBands() + '/' + name
+
+        data, mtime_ns, mode = self.read_file(self.src, srcpath)
+        written = self.write_file(self.dst, dstpath, data, mtime_ns, mode, band=name)
+
+        if self.journal is not None:
+            self.journal.Done(name, len(data), mtime_ns)
+
+        return written
+
+    def delete_bands(self, names):
+        """Delete bands from the destination, a batch at a time if it's an object store"""
+        if self.dst.objectstore:
+            from ev.objectstore import DELETE_BATCH
+
+            for first in range(0, len(names), DELETE_BATCH):
+                batch = names[first:first + DELETE_BATCH]
+                self.dst.backend.Delete([self.dst.getKey(self.dst.getBands() + '/' + name) for name in batch])
+                for name in batch:
+                    self.stats['deleted'] += 1
+                    if self.journal is not None:
+                        self.journal.Deleted(name)
+            return
+
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.dst.getBands(), name))
+            except FileNotFoundError:
+                pass
+            self.stats['deleted'] += 1
+            if self.journal is not None:
+                self.journal.Deleted(name)
+
+    def sync_metadata(self):
+        """Copy everything other than the bands (see MetadataChanges())"""
+        if not self.dst.objectstore:
+            os.makedirs(self.dst.getBundlePath(), exist_ok=True)
+
+        copy, delete = MetadataChanges(self.src, self.dst)
+
+        for srcpath, dstpath, size in copy:
+            data, mtime_ns, mode = self.read_file(self.src, srcpath)
+            self.stats['bytes'] += self.write_file(self.dst, dstpath, data, mtime_ns, mode)
+            self.stats['metadata'] += 1
+
+        # Files only the destination has go, same as rsync --delete did
+        for dstpath in delete:
+            self.msgout("removing %s, it isn't in the source" % dstpath)
+            if self.dst.objectstore:
+                self.dst.backend.Delete([self.dst.getKey(dstpath)])
+            else:
+                try:
+                    os.unlink(dstpath)
+                except FileNotFoundError:
+                    pass
+
+        if not self.dst.objectstore:
+            FsyncDirectory(self.dst.getBundlePath())
+            FsyncDirectory(self.dst.getPath())
+
+    def Run(self, copy, delete):
+        """Do the sync (see C_BandSync.Run()). Returns the stats dictionary. Raises
+        OSError if anything goes wrong, in which case the destination bundle metadata
+        hasn't been touched."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        started = time.time()
+
+        if not self.dst.objectstore:
+            os.makedirs(self.dst.getBands(), exist_ok=True)
+
+        if copy:
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    initializer=self.scheduler.WorkerInitializer()) as pool:
+                for copied in pool.map(self.copy_band, [c[0] for c in self.scheduler.Order(copy)]):
+                    self.stats['copied'] += 1
+                    self.stats['bytes'] += copied
+
+            self.stats['apparent'] += sum(c[1] for c in copy)
+
+        self.delete_bands(list(delete))
+
+        # The bands have to be there before the metadata that describes them
+        if not self.dst.objectstore:
+            FsyncDirectory(self.dst.getBands())
+
+        self.sync_metadata()
+
+        if self.journal is not None:
+            self.journal.Commit()
+
+        self.stats['seconds'] = time.time() - started
+
+        return self.stats
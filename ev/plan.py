@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""
+This module is behind the 'plan' verb, which says what a backup or a restore would
+do without doing it, and how long it would probably take. There are two parts:
+
+C_ThroughputModel learns how fast transfers of a vault go, from the last few that
+committed (kept in the vault's C_EVPlist state, per direction). Each one is a sample
+of (bytes written, bands copied or deleted, seconds), and the model is a least
+squares fit of
+
+    seconds = bytes / rate + bands * per_band
+
+so a backup of a thousand small bands and one of a single big band both come out
+about right. With only one sample, or samples that can't tell the two apart, it
+falls back to the overall bytes per second.
+
+C_TransferPlan is the plan itself, a JSON file next to the vault's C_EVPlist state:
+
+    {"version": 1, "vault": "cv", "created": 1700000000.0,
+     "state": {"local": "5f0c...", "remote": [dev, ino, mtime_ns]},
+     "backup": {"src": "...", "dst": "...", "copy": [["1a", 8388608], ...],
+                "delete": ["2f", ...], "bytes": ..., "allocated": ...,
+                "metadata": [["...", 512], ...], "stale": ["..."], "seconds": 12.5},
+     "restore": {...}}
+
+state is what each side's bands looked like when the plan was made (see
+C_VaultStore.BandsState()): the stat of the Dropbox bands directory, and a hash of
+every LOCAL band's size and mtime, since LOCAL's bands are rewritten in place by
+whoever attaches the image. A backup or restore whose stores still have that state
+runs the saved plan as-is instead of scanning Dropbox and diffing, the same way the
+dirty band journal is used (see ev.watcher). The state is null for a side that can't
+be described that cheaply (an object store, a directory that was modified too
+recently to trust its mtime, or a mounted LOCAL), and then the plan is only good for
+reading.
+"""
+
+import os
+import json
+import time
+
+PLAN_VERSION = 1
+
+# How many past transfers the throughput model remembers, per direction
+SAMPLES = 16
+
+class C_ThroughputModel:
+    """How fast this vault's transfers go (see the module docstring).
+
+    samples - list of [bytes, bands, seconds], oldest first
+    """
+    def __init__(self, samples=None):
+        self.samples = [list(s) for s in (samples or [])]
+
+    def Add(self, nbytes, bands, seconds):
+        """Remember one transfer. Returns the samples to keep."""
+        self.samples.append([int(nbytes), int(bands), float(seconds)])
+        self.samples = self.samples[-SAMPLES:]
+        return self.samples
+
+    def Fit(self):
+        """Returns (bytes per second, seconds per band), or None if there's nothing
+        to go on. Either one can be 0 (bytes per second meaning 'unknown')."""
+        samples = [s for s in self.samples if s[2] > 0 and (s[0] or s[1])]
+        if not samples:
+            return None
+
+        # Normal equations for seconds = bytes * a + bands * b
+        sxx = sum(n * n for n, b, t in samples)
+        sxy = sum(n * b for n, b, t in samples)
+        syy = sum(b * b for n, b, t in samples)
+        sxt = sum(n * t for n, b, t in samples)
+        syt = sum(b * t for n, b, t in samples)
+
+        det = sxx * syy - sxy * sxy
+        if len(samples) > 1 and det > 1e-9 * sxx * syy:
+            a = (sxt * syy - syt * sxy) / det
+            b = (syt * sxx - sxt * sxy) / det
+            if a > 0 and b >= 0:
+                return 1.0 / a, b
+
+        nbytes = sum(s[0] for s in samples)
+        seconds = sum(s[2] for s in samples)
+        if nbytes:
+            return nbytes / seconds, 0.0
+
+        return 0.0, seconds / sum(s[1] for s in samples)
+
+    def Estimate(self, nbytes, bands):
+        """Returns how many seconds writing nbytes and copying or deleting bands
+        should take, or None if the model has nothing to go on"""
+        fit = self.Fit()
+        if fit is None:
+            return None
+
+        rate, per_band = fit
+        if nbytes and not rate:
+            return None     # only ever seen transfers that didn't write anything
+
+        return (nbytes / rate if nbytes else 0.0) + bands * per_band
+
+class C_TransferPlan:
+    """This object abstracts the saved plan of one vault (see the module docstring).
+
+    path - The plan file
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def Load(self):
+        """Returns the plan dictionary, or None if there isn't a usable one"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                plan = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(plan, dict) or plan.get('version') != PLAN_VERSION:
+            return None
+
+        return plan
+
+    def Save(self, plan):
+        """Write plan, through a temp file, so a reader never sees half of it"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(dict(plan, version=PLAN_VERSION, created=time.time()), f, indent=1)
+
+        os.replace(tmp, self.path)
+
+    def Discard(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def Steps(self, direction, src, dst, state):
+        """Returns ((copy, delete), None) from the saved plan for a direction transfer
+        from the src path to the dst path, if state (the current {'local': ...,
+        'remote': ...} band states) is what it was when the plan was made. Otherwise
+        (None, the reason it can't be used), or (None, None) if there's no plan."""
+        plan = self.Load()
+        if plan is None or direction not in plan:
+            return None, None
+
+        steps = plan[direction]
+
+        if (steps['src'], steps['dst']) != (src, dst):
+            return None, "it's for different stores"
+
+        saved = plan['state']
+        if None in saved.values():
+            return None, "it was only good for reading"
+
+        for side in ('local', 'remote'):
+            if state[side] is None or state[side] != saved[side]:
+                return None, "%s changed since it was made" % ('LOCAL' if side == 'local' else 'Dropbox')
+
+        return ([tuple(c) for c in steps['copy']], list(steps['delete'])), None
+
+def FormatDuration(seconds):
+    """Returns seconds as something like 12s, 3m05s or 2h07m"""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % divmod(seconds, 60)
+    return '%dh%02dm' % divmod(seconds // 60, 60)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+This module runs the external commands (hdiutil, rsync) for the vault verbs. It's
+built on asyncio subprocesses, so a command's output is read as it comes, parsed
+into progress events, and the command can be timed out or cancelled cleanly (it
+gets SIGTERM, then SIGKILL if it doesn't go).
+
+The events are dictionaries:
+
+    {"kind": "progress", "command": "rsync", "bytes": ..., "percent": ..., "rate": "...", "eta": "..."}
+    {"kind": "attached", "command": "hdiutil", "device": "/dev/disk4s1", "hint": "Apple_HFS", "mount": "/Volumes/cv"}
+    {"kind": "detached", "command": "hdiutil", "device": "disk4"}
+    {"kind": "output", "command": "...", "line": "..."}      anything else it printed
+
+Each one goes to the message handler as a line of text, and to the records handler
+as is, if there is one. Progress is sent at most once a second.
+
+C_CommandRunner is what the (synchronous) verbs use. By itself, it runs each
+command in its own event loop. Given a loop, it runs them in that loop instead,
+which is how C_AsyncVault (see ev.asyncvault) runs several vault operations at
+once from one process and cancels them.
+"""
+
+import re
+import time
+import asyncio
+
+# How long a command gets to exit after SIGTERM, before SIGKILL
+TERMINATE_GRACE = 5.0
+
+PROGRESS_INTERVAL = 1.0
+
+class CommandCancelled(Exception):
+    """The command was cancelled before it finished"""
+    pass
+
+class CommandTimeout(Exception):
+    """The command didn't finish in time"""
+    pass
+
+# rsync --info=progress2: "    1,234,567  45%   10.50MB/s    0:00:12 (xfr#3, to-chk=10/20)"
+_rsync_progress = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+(\S+)\s+(\d+:\d+:\d+)')
+
+# hdiutil attach: "/dev/disk4s1  Apple_HFS  /Volumes/cv" (the mount point is optional)
+_hdiutil_attach = re.compile(r'^(/dev/disk\S+)\s+(\S+)?\s*(/.*)?$')
+
+# hdiutil detach: '"disk4" ejected.' (or unmounted)
+_hdiutil_detach = re.compile(r'^"(disk\S+)" (ejected|unmounted)\.$')
+
+def ParseLine(command, line):
+    """Turn a line of a command's output into an event (see the module docstring)"""
+    if command == 'rsync':
+        m = _rsync_progress.match(line)
+        if m:
+            return {'kind': 'progress', 'command': command, 'bytes': int(m.group(1).replace(',', '')),
+                    'percent': int(m.group(2)), 'rate': m.group(3), 'eta': m.group(4)}
+
+    elif command == 'hdiutil':
+        m = _hdiutil_attach.match(line.strip())
+        if m:
+            return {'kind': 'attached', 'command': command, 'device': m.group(1),
+                    'hint': m.group(2), 'mount': m.group(3).strip() if m.group(3) else None}
+        m = _hdiutil_detach.match(line.strip())
+        if m:
+            return {'kind': 'detached', 'command': command, 'device': m.group(1)}
+
+    return {'kind': 'output', 'command': command, 'line': line}
+
+def FormatEvent(event):
+    """Returns the text for the message handler for an event"""
+    kind = event['kind']
+
+    if kind == 'progress':
+        return "%s: %d bytes, %d%%, %s, %s to go" % (event['command'], event['bytes'],
+                                                   event['percent'], event['rate'], event['eta'])
+    if kind == 'attached':
+        return "attached %s (%s)%s" % (event['device'], event['hint'],
+                                       ' at %s' % event['mount'] if event['mount'] else '')
+    if kind == 'detached':
+        return "detached %s" % event['device']
+
+    return event['line']
+
+async def _lines(stream):
+    """Async generator of the lines of stream, split on \\n or \\r (progress output
+    rewrites its line with \\r)"""
+    pending = b''
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            break
+        pending += chunk
+        parts = re.split(rb'[\r\n]', pending)
+        pending = parts.pop()
+        for part in parts:
+            if part:
+                yield part.decode('utf-8', 'replace')
+
+    if pending:
+        yield pending.decode('utf-8', 'replace')
+
+async def RunCommand(argv, on_event=None, timeout=None):
+    """Run argv (a list, no shell), sending each event of its output (stdout and
+    stderr) to on_event. Returns the exit code. Raises CommandTimeout if it takes
+    longer than timeout seconds, and passes cancellation along after stopping the
+    command."""
+    import os
+
+    command = os.path.basename(argv[0])
+
+    process = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT)
+
+    async def pump():
+        last = 0.0
+        held = None
+        async for line in _lines(process.stdout):
+            event = ParseLine(command, line)
+            if event['kind'] == 'progress':
+                # Don't flood the handler, but keep the latest for the end
+                if time.monotonic() - last < PROGRESS_INTERVAL:
+                    held = event
+                    continue
+                last = time.monotonic()
+                held = None
+            if on_event is not None:
+                on_event(event)
+        if held is not None and on_event is not None:
+            on_event(held)
+        return await process.wait()
+
+    async def stop():
+        if process.returncode is not None:
+            return
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), TERMINATE_GRACE)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+        except ProcessLookupError:
+            pass
+
+    try:
+        return await asyncio.wait_for(pump(), timeout or None)
+    except asyncio.TimeoutError:
+        await stop()
+        raise CommandTimeout("%s didn't finish in %s seconds" % (command, timeout))
+    except asyncio.CancelledError:
+        await asyncio.shield(stop())
+        raise
+
+class C_CommandRunner:
+    """Runs commands for the synchronous vault verbs.
+
+    message - A function that is called with a string for each event
+    records - Optional function that is called with each event dictionary
+    loop - Run commands in this (running) event loop, from another thread. None
+           means each command gets a loop of its own.
+    timeout - Default timeout in seconds, 0 or None for none
+    """
+    def __init__(self, message, records=None, loop=None, timeout=None):
+        import threading
+
+        self.msgout = message
+        self.recordout = records
+        self.loop = loop
+        self.timeout = timeout
+        self.current = None
+        self.cancelled = threading.Event()
+
+    def event(self, event):
+        self.msgout(FormatEvent(event))
+        if self.recordout is not None:
+            self.recordout(event)
+
+    def Run(self, argv, timeout=None):
+        """Run argv and return its exit code. Raises CommandCancelled if Cancel()
+        was called, and CommandTimeout if it ran out of time."""
+        from concurrent.futures import CancelledError
+
+        if self.cancelled.is_set():
+            raise CommandCancelled(argv[0])
+
+        coro = RunCommand(argv, self.event, timeout if timeout is not None else self.timeout)
+
+        if self.loop is None:
+            return asyncio.run(coro)
+
+        self.current = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return self.current.result()
+        except CancelledError:
+            raise CommandCancelled(argv[0])
+        finally:
+            self.current = None
+
+    def Cancel(self):
+        """Stop the command that's running (if any), and don't start any more. This
+        can be called from any thread."""
+        self.cancelled.set()
+        current = self.current
+        if current is not None:
+            current.cancel()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+This module schedules the I/O of vault transfers, so a backup can run during the day
+without the person at the keyboard noticing. A C_TransferPolicy says how hard a
+transfer is allowed to push:
+
+    workers         - how many bands are copied at the same time
+    bytes_per_sec   - cap on the copy bandwidth (0 means no cap)
+    iops            - cap on I/O requests per second, i.e. copy chunks (0 means no cap)
+    idle            - run the copy threads at idle CPU and I/O priority
+
+The caps are token buckets that every copy thread draws from before each chunk it
+moves. Bands are handed out largest first, so the big ones don't end up trailing at
+the end with only one worker busy.
+
+Policies are per vault. The default comes from C_EVDefaults.TransferPolicy, and a
+vault can override any part of it in its C_EVPlist state (see the 'policy' verb).
+"""
+
+import os
+import sys
+import time
+import threading
+
+POLICY_KEYS = ('workers', 'bytes_per_sec', 'iops', 'idle')
+
+def ParseSize(value):
+    """Parse a size like 1048576, 512K, 20M or 1G (powers of 1024)"""
+    if isinstance(value, int):
+        return value
+
+    value = str(value).strip().upper()
+    for suffix, scale in (('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * scale)
+
+    return int(value)
+
+class C_TransferPolicy:
+    """How hard a transfer is allowed to push (see the module docstring)"""
+
+    def __init__(self, workers=4, bytes_per_sec=0, iops=0, idle=False):
+        self.workers = max(1, int(workers))
+        self.bytes_per_sec = ParseSize(bytes_per_sec)
+        self.iops = int(iops)
+        self.idle = idle if isinstance(idle, bool) else str(idle).lower() in ('1', 'yes', 'true', 'on')
+
+    @classmethod
+    def FromDict(cls, *dicts):
+        """Build a policy from one or more dictionaries, later ones overriding earlier
+        ones. Keys that aren't policy keys are ignored."""
+        settings = {}
+        for d in dicts:
+            settings.update({k: v for k, v in (d or {}).items() if k in POLICY_KEYS})
+
+        return cls(**settings)
+
+    def ToDict(self):
+        return {'workers': self.workers, 'bytes_per_sec': self.bytes_per_sec,
+                'iops': self.iops, 'idle': self.idle}
+
+    def __str__(self):
+        return "workers=%d bytes_per_sec=%s iops=%s idle=%s" % (
+            self.workers, self.bytes_per_sec or 'unlimited', self.iops or 'unlimited',
+            'yes' if self.idle else 'no')
+
+class C_TokenBucket:
+    """A thread-safe token bucket. Take() blocks until the tokens are there.
+
+    rate  - tokens added per second
+    burst - most tokens the bucket holds
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def Take(self, count):
+        # A request bigger than the bucket would never be satisfied, so it's allowed
+        # to take the bucket into debt instead, which later requests pay back.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+
+# ioprio_set() isn't in the os module. These are the syscall numbers for it.
+_IOPRIO_SET = {'x86_64': 251, 'aarch64': 30, 'i686': 289, 'armv7l': 314}
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_WHO_PROCESS = 1
+
+def LowerThreadPriority():
+    """Put the calling thread at idle CPU and I/O priority, as far as the platform
+    lets us. This is best effort, so failures are ignored."""
+
+    if sys.platform.startswith('linux'):
+        tid = threading.get_native_id()
+
+        # On Linux, nice values are per thread
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, 19)
+        except (OSError, AttributeError):
+            pass
+
+        nr = _IOPRIO_SET.get(os.uname().machine)
+        if nr is not None:
+            try:
+                import ctypes
+                libc = ctypes.CDLL(None, use_errno=True)
+                libc.syscall(nr, _IOPRIO_WHO_PROCESS, tid, _IOPRIO_CLASS_IDLE << 13)
+            except (OSError, AttributeError):
+                pass
+
+    elif sys.platform == 'darwin':
+        # setiopolicy_np(IOPOL_TYPE_DISK, IOPOL_SCOPE_THREAD, IOPOL_THROTTLE)
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.setiopolicy_np(0, 1, 3)
+        except (OSError, AttributeError):
+            pass
+
+class C_TransferScheduler:
+    """Applies a C_TransferPolicy to a transfer.
+
+    policy - The C_TransferPolicy to enforce
+    """
+    def __init__(self, policy=None):
+        self.policy = policy or C_TransferPolicy()
+
+        self.bytes = None
+        if self.policy.bytes_per_sec:
+            self.bytes = C_TokenBucket(self.policy.bytes_per_sec)
+
+        self.ops = None
+        if self.policy.iops:
+            self.ops = C_TokenBucket(self.policy.iops)
+
+    def Order(self, copy):
+        """Returns the (band name, size) list copy in the order the bands should be
+        handed to the workers: largest first."""
+        return sorted(copy, key=lambda c: c[1] or 0, reverse=True)
+
+    def Throttle(self, nbytes):
+        """Called by the copy code before each chunk it moves. Blocks as long as it
+        takes to stay under the caps."""
+        if self.ops is not None:
+            self.ops.Take(1)
+
+        if self.bytes is not None:
+            self.bytes.Take(nbytes)
+
+    def Throttled(self):
+        """Returns True if there are caps, i.e. Throttle() needs calling at all"""
+        return self.bytes is not None or self.ops is not None
+
+    def WorkerInitializer(self):
+        """Returns the function to initialize each copy thread with, or None"""
+        return LowerThreadPriority if self.policy.idle else None
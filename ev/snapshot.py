@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+"""
+This module takes cheap snapshots of the LOCAL copy of a vault, so there's always a
+way back if a restore (or anything else) goes wrong. A snapshot is a copy of the
+sparsebundle, laid out just like a vault store, so a C_VaultStore can point at it:
+
+    ~/vaults/.evsnapshots/VAULT/NAME/snapshot.plist
+    ~/vaults/.evsnapshots/VAULT/NAME/VAULT/VAULT.sparsebundle/...
+
+The bands aren't copied. Each one is cloned, in order of preference:
+
+    reflink   - FICLONE on Linux (btrfs, xfs, ...), clonefile() on macOS (APFS). The
+                clone shares blocks with the band until one of them is written, so
+                the snapshot is independent of the vault from then on.
+    hardlink  - A second name for the same file. The sync engine always replaces a
+                band by renaming a new file over it, so a restore or rollback never
+                touches the snapshot's copy. Writes made while the image is mounted
+                DO go into the shared file though, so mounting the vault read/write
+                marks hardlink snapshots as stale (see MarkStale()).
+
+The small files in the bundle (Info.plist, token, etc.) are just copied.
+"""
+
+import os
+import sys
+import shutil
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+SNAPSHOT_PLIST = 'snapshot.plist'
+
+METHOD_REFLINK = 'reflink'
+METHOD_HARDLINK = 'hardlink'
+
+def _reflink(src, dst):
+    """Clone src to dst sharing its blocks. Returns True if it worked."""
+
+    if sys.platform.startswith('linux'):
+        import fcntl
+
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            try:
+                os.unlink(dst)
+            except OSError:
+                pass
+            return False
+
+        shutil.copystat(src, dst)
+        return True
+
+    if sys.platform == 'darwin':
+        import ctypes
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            clonefile = libc.clonefile
+        except (OSError, AttributeError):
+            return False
+
+        # clonefile() carries the times and mode over by itself
+        return clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+
+    return False
+
+def CloneFile(src, dst, allow_reflink=True):
+    """Clone src to dst, with a reflink if we can, otherwise a hardlink.
+    Returns the method that was used (METHOD_REFLINK or METHOD_HARDLINK)."""
+
+    if allow_reflink and _reflink(src, dst):
+        return METHOD_REFLINK
+
+    os.link(src, dst)
+    return METHOD_HARDLINK
+
+class C_Snapshots:
+    """This object manages the snapshots of one vault.
+
+    root - The directory the snapshots of all vaults are kept in
+    vaultname - Name of the vault
+    """
+    def __init__(self, root, vaultname):
+        self.vaultname = vaultname
+        self.path = os.path.join(root, vaultname)
+
+    def SnapshotPath(self, name):
+        """Returns the directory of the snapshot name. Pass this and the vault name to
+        C_VaultStore to get a store for the snapshot."""
+        return os.path.join(self.path, name)
+
+    def Info(self, name):
+        """Returns the snapshot.plist dictionary of the snapshot name, or None"""
+        from plistlib import load
+
+        try:
+            with open(os.path.join(self.SnapshotPath(name), SNAPSHOT_PLIST), 'rb') as f:
+                info = load(f)
+        except (OSError, ValueError):
+            return None
+
+        info['name'] = name
+        return info
+
+    def write_info(self, name, info):
+        from plistlib import dump
+
+        info = dict(info)
+        info.pop('name', None)
+
+        tmp = os.path.join(self.SnapshotPath(name), SNAPSHOT_PLIST + '.tmp')
+        with open(tmp, 'wb') as f:
+            dump(info, f)
+        os.replace(tmp, os.path.join(self.SnapshotPath(name), SNAPSHOT_PLIST))
+
+    def List(self):
+        """Returns a list of the snapshot info dictionaries, oldest first. Snapshots
+        that didn't finish (no snapshot.plist) aren't listed."""
+        if not os.path.isdir(self.path):
+            return []
+
+        snapshots = [self.Info(name) for name in sorted(os.listdir(self.path))]
+
+        return sorted([s for s in snapshots if s is not None], key=lambda s: s['created'])
+
+    def Create(self, store, label='manual'):
+        """Snapshot the sparsebundle of the C_VaultStore store. Returns the info
+        dictionary of the new snapshot. label is part of the snapshot's directory
+        name, so it has to be a plain one (see ev.verbs.ParseLabel()), or this
+        raises ValueError."""
+        import datetime
+        from ev.verbs import ParseLabel
+
+        label = ParseLabel(label)
+
+        created = datetime.datetime.now()
+        name = created.strftime('%Y%m%d-%H%M%S-%f') + '-' + label
+
+        bundle = os.path.join(self.SnapshotPath(name), self.vaultname,
+                              os.path.basename(store.getBundlePath()))
+        bands = os.path.join(bundle, 'bands')
+
+        os.makedirs(bands)
+
+        method = METHOD_REFLINK
+        reflink = True
+
+        try:
+            with os.scandir(store.getBands()) as it:
+                for entry in it:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+
+                    used = CloneFile(entry.path, os.path.join(bands, entry.name), reflink)
+
+                    # If the first reflink fails, don't keep trying them
+                    if used == METHOD_HARDLINK:
+                        method = METHOD_HARDLINK
+                        reflink = False
+
+            with os.scandir(store.getBundlePath()) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False):
+                        shutil.copy2(entry.path, os.path.join(bundle, entry.name))
+
+            info = {'created': created, 'label': label, 'method': method, 'stale': False}
+            self.write_info(name, info)
+        except BaseException:
+            shutil.rmtree(self.SnapshotPath(name), ignore_errors=True)
+            raise
+
+        info['name'] = name
+        return info
+
+    def Delete(self, name):
+        """Delete the snapshot name"""
+        shutil.rmtree(self.SnapshotPath(name))
+
+    def Prune(self, keep, label=None):
+        """Delete all but the newest keep snapshots. If label is given, only snapshots
+        with that label are considered. Returns the names of the ones deleted."""
+        snapshots = [s for s in self.List() if label is None or s['label'] == label]
+
+        deleted = []
+        for info in snapshots[:max(0, len(snapshots) - keep)]:
+            self.Delete(info['name'])
+            deleted.append(info['name'])
+
+        return deleted
+
+    def MarkStale(self):
+        """Mark every hardlink snapshot as stale, because the vault is about to be
+        written in place, which changes the files they share with it. Returns the
+        number of snapshots that were marked."""
+        marked = 0
+
+        for info in self.List():
+            if info['method'] == METHOD_HARDLINK and not info['stale']:
+                info['stale'] = True
+                self.write_info(info['name'], info)
+                marked += 1
+
+        return marked
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+This module times the phases of a vault operation, so when 'about' or 'backup' is
+slow, there's a way to tell whether it's the validation, the band scans, the diff,
+hdiutil or the transfer. A span is one named stretch of work:
+
+    with Span('store.scan') as span:
+        ...
+        span.add(bands=len(table))
+
+When a span ends, the span hook is called with (name, seconds, counts). There's no
+hook unless somebody installs one, with SetSpanHook() or the spans argument of
+C_EncryptedVault (right next to its message handler), and without one Span() hands
+back the same do-nothing object every time, so the spans cost about as much as the
+function call.
+
+C_SpanProfile is a hook that adds the spans up per phase; it's what 'ev --profile'
+prints. Spans nest (a backup's transfer is inside the backup), so the phases add up
+to more than the total.
+"""
+
+import time
+import threading
+
+_hook = None
+
+class _NullSpan:
+    """What Span() returns when nobody is listening"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def add(self, **counts):
+        pass
+
+_null = _NullSpan()
+
+class C_Span:
+    """One running span (see Span())"""
+    __slots__ = ('name', 'hook', 'counts', 'started')
+
+    def __init__(self, name, hook, counts):
+        self.name = name
+        self.hook = hook
+        self.counts = counts
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.hook(self.name, time.perf_counter() - self.started, self.counts)
+        return False
+
+    def add(self, **counts):
+        """Count things the span did, e.g. bands=n or bytes=n"""
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+def Span(name, **counts):
+    """Returns a context manager that times name (see the module docstring)"""
+    hook = _hook
+    if hook is None:
+        return _null
+    return C_Span(name, hook, counts)
+
+def SetSpanHook(hook):
+    """Install hook, a function called with (name, seconds, counts) for every span
+    that ends, in any thread. None turns the spans off. Returns the old hook."""
+    global _hook
+
+    previous = _hook
+    _hook = hook
+    return previous
+
+class C_SpanProfile:
+    """A span hook that keeps the calls, time and counts of each phase"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}        # name -> {'calls', 'seconds', 'max', counts...}; in order of first use
+        self.started = time.perf_counter()
+
+    def __call__(self, name, seconds, counts):
+        with self.lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = {'calls': 0, 'seconds': 0.0, 'max': 0.0}
+            phase['calls'] += 1
+            phase['seconds'] += seconds
+            phase['max'] = max(phase['max'], seconds)
+            for key, value in counts.items():
+                phase[key] = phase.get(key, 0) + value
+
+    def Report(self, message, records=None):
+        """Send the per-phase breakdown to the message handler, and a record per
+        phase to the records handler, if there is one"""
+        total = time.perf_counter() - self.started
+
+        message("%-20s %6s %10s %6s %10s %14s %12s" % ('phase', 'calls', 'seconds', '%', 'bands', 'bytes', 'bands/sec'))
+
+        with self.lock:
+            phases = [(name, dict(phase)) for name, phase in self.phases.items()]
+
+        for name, phase in phases:
+            bands = phase.get('bands')
+            rate = bands / phase['seconds'] if bands and phase['seconds'] else None
+            message("%-20s %6d %10.4f %6.1f %10s %14s %12s" %
+                    (name, phase['calls'], phase['seconds'], 100.0 * phase['seconds'] / total if total else 0.0,
+                     '-' if bands is None else bands, '-' if 'bytes' not in phase else phase['bytes'],
+                     '-' if rate is None else '%.0f' % rate))
+            if records is not None:
+                records(dict(phase, kind='span', phase=name))
+
+        message("%.4f seconds in all (phases nest, so they add up to more)" % total)
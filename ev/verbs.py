@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+This module is the registry of the verbs, i.e. the C_EncryptedVault methods that
+can be run from the command line, the daemon, a batch or C_AsyncVault. For each
+one it knows:
+
+    needs       which stores have to be there before it runs, so a verb that only
+                touches LOCAL doesn't wait on a stat of the Dropbox folder
+    args        how many arguments it takes (min, max; None for no limit)
+    types       a parser for each argument, in order, that raises ValueError if
+                the argument is no good (e.g. ParseFlag, ParseCount)
+    exclusive   it changes the vault, so the daemon runs it one at a time per vault
+    password    it asks for the vault password, so it can't run in a batch
+
+None of this needs anything else from ev, so the command line can find the verb
+and check its arguments before it imports or builds anything else.
+"""
+
+import re
+
+LOCAL = 'local'
+REMOTE = 'remote'
+
+FLAG_TRUE = ('1', 'yes', 'true', 'on', 'readonly', 'ro')
+FLAG_FALSE = ('0', 'no', 'false', 'off', 'readwrite', 'rw')
+
+def ParseFlag(value):
+    """Returns True or False for a yes/no argument, which comes from the command line
+    (or the daemon) as a string. Anything that isn't clearly one or the other raises
+    ValueError, rather than a non-empty string like 'no' counting as True."""
+    if isinstance(value, bool):
+        return value
+
+    value = str(value).strip().lower()
+    if value in FLAG_TRUE:
+        return True
+    if value in FLAG_FALSE:
+        return False
+
+    raise ValueError("'%s' isn't yes or no" % value)
+
+def ParseCount(value):
+    """Returns a count argument (0 or more) as an int, or raises ValueError"""
+    try:
+        count = int(str(value).strip())
+    except ValueError:
+        raise ValueError("'%s' isn't a number" % value) from None
+
+    if count < 0:
+        raise ValueError("'%s' can't be negative" % value)
+
+    return count
+
+def ParsePositive(value):
+    """Returns a count argument that has to be at least 1 as an int, or raises ValueError"""
+    count = ParseCount(value)
+    if count < 1:
+        raise ValueError("'%s' has to be at least 1" % value)
+
+    return count
+
+# Letters, digits, '.', '_' and '-', and not starting with a dot, so it's one plain
+# directory name component (no '..', no '/', nothing hidden)
+LABEL_PATTERN = re.compile(r'[A-Za-z0-9_-][A-Za-z0-9._-]*\Z')
+
+def ParseLabel(value):
+    """Returns a snapshot label, which ends up in a directory name (see ev.snapshot),
+    or raises ValueError if it isn't a safe one"""
+    value = str(value)
+    if not LABEL_PATTERN.match(value):
+        raise ValueError("'%s' isn't a label; use letters, digits, '.', '_' and '-', and don't start with a dot" % value)
+
+    return value
+
+class C_Verb:
+    """One verb (see the module docstring)"""
+
+    def __init__(self, name, needs=(LOCAL, REMOTE), args=(0, 0), types=(), exclusive=False, password=False, usage=''):
+        self.name = name
+        self.needs = needs
+        self.args = args
+        self.types = types
+        self.exclusive = exclusive
+        self.password = password
+        self.usage = usage
+
+    def CheckArgs(self, args):
+        """Returns None if args are right for this verb, or what's wrong with them"""
+        low, high = self.args
+
+        if len(args) < low or (high is not None and len(args) > high):
+            if high is None:
+                wanted = 'at least %d argument(s)' % low
+            elif low == high:
+                wanted = '%d argument(s)' % low if low else 'no arguments'
+            else:
+                wanted = '%d to %d arguments' % (low, high)
+            return "'%s' takes %s, not %d%s" % (self.name, wanted, len(args),
+                                                 ' (%s %s)' % (self.name, self.usage) if self.usage else '')
+
+        for parse, arg in zip(self.types, args):
+            try:
+                parse(arg)
+            except ValueError as e:
+                return "'%s': %s%s" % (self.name, e, ' (%s %s)' % (self.name, self.usage) if self.usage else '')
+
+        return None
+
+VERBS = {verb.name: verb for verb in [
+    C_Verb('about'),
+    C_Verb('diff'),
+    C_Verb('usage'),
+    C_Verb('metrics'),
+    C_Verb('plan', exclusive=True),
+    C_Verb('verify', args=(0, 1), types=(ParsePositive,), usage='[WORKERS]'),
+    C_Verb('mount', needs=(LOCAL,), args=(0, 1), types=(ParseFlag,), exclusive=True, password=True,
+           usage='[READONLY: yes|no]'),
+    C_Verb('attach', needs=(LOCAL,), exclusive=True, password=True),
+    C_Verb('dismount', needs=(LOCAL,), exclusive=True),
+    C_Verb('eject', needs=(LOCAL,), exclusive=True),        # same as dismount
+    C_Verb('detach', needs=(LOCAL,), exclusive=True),       # same as dismount
+    C_Verb('backup', exclusive=True),
+    C_Verb('restore', args=(0, 1), exclusive=True, usage='[VERSION]'),
+    C_Verb('replicas', needs=(LOCAL,)),
+    C_Verb('versions', needs=(LOCAL,)),
+    C_Verb('gc', needs=(LOCAL,), args=(0, 1), types=(ParseCount,), exclusive=True, usage='[KEEP]'),
+    C_Verb('snapshot', needs=(LOCAL,), args=(0, 1), types=(ParseLabel,), exclusive=True, usage='[LABEL]'),
+    C_Verb('snapshots', needs=(LOCAL,)),
+    C_Verb('prune', needs=(LOCAL,), args=(0, 2), types=(ParseCount,), exclusive=True,
+           usage='[KEEP [LABEL]]'),
+    C_Verb('rollback', needs=(LOCAL,), args=(1, 1), exclusive=True, usage='SNAPSHOT'),
+    C_Verb('policy', needs=(LOCAL,), args=(0, None), exclusive=True, usage='[KEY=VALUE ...]'),
+]}
+
+def Lookup(name):
+    """Returns the C_Verb called name (any case), or None if there isn't one"""
+    return VERBS.get(name.lower())
+
+def ExclusiveVerbs():
+    return {name for name, verb in VERBS.items() if verb.exclusive}
+
+def PasswordVerbs():
+    return {name for name, verb in VERBS.items() if verb.password}
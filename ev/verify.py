@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+This module hashes bands for the 'verify' verb, which compares content instead of
+the mtimes the band diff uses, so it catches silent corruption or a Dropbox
+conflict copy that kept the timestamp.
+
+Bands are hashed in a pool of processes, one band per task, so it runs on every
+core instead of one thread of hashlib. Each process reads its band through mmap in
+big chunks, which hands the kernel the whole read up front. The pool is started with
+forkserver (spawn where there's no such thing), never a plain fork, since verify can
+run in the daemon, and forking a process with other threads in it can deadlock the
+child on a lock one of those threads was holding.
+
+A band that goes away while it's being verified (a sync deleted or replaced it) is
+reported as missing, not an error that stops the whole run.
+
+The hashes are cached per store, keyed by band name and checked against the
+(inode, size, mtime_ns, ctime_ns) of the band, so a repeat run only hashes the
+bands that changed since the last one. The ctime is in there because a write that
+puts the mtime back (which is exactly what we're looking for) can't put the ctime
+back, so every band is stat()ed fresh rather than trusting the band manifest.
+
+The hash is the same blake2b the versioned store uses (see ev.versionstore), so
+LOCAL can be checked against a version without reading anything but LOCAL.
+"""
+
+import os
+import mmap
+import json
+import time
+from hashlib import blake2b
+
+from ev.versionstore import DIGEST_SIZE
+
+MAP_CHUNK = 64 << 20
+
+def HashBand(path):
+    """Returns (hex digest, bytes hashed) of the file at path, or (None, 0) if it
+    isn't there anymore. This runs in the worker processes, so it has to stay a
+    plain function."""
+    h = blake2b(digest_size=DIGEST_SIZE)
+
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None, 0
+
+    with f:
+        size = os.fstat(f.fileno()).st_size
+
+        offset = 0
+        while offset < size:
+            length = min(MAP_CHUNK, size - offset)
+            with mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=offset) as m:
+                if hasattr(m, 'madvise'):
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(m)
+            offset += length
+
+    return h.hexdigest(), size
+
+class C_HashCache:
+    """The cached band hashes of one store.
+
+    path - The cache file (see C_VaultStore.getCacheFile())
+    """
+    def __init__(self, path):
+        self.path = path
+        self.hashes = None
+        self.dirty = False
+
+    def Load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.hashes = json.load(f)
+        except (OSError, ValueError):
+            self.hashes = {}
+
+        return self
+
+    def Get(self, name, st):
+        """Returns the cached hash of band name, whose stat is st, or None if there
+        isn't one or the band changed since it was computed"""
+        cached = self.hashes.get(name)
+        if cached is None or cached[:4] != [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]:
+            return None
+
+        return cached[4]
+
+    def Put(self, name, st, digest):
+        self.hashes[name] = [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, digest]
+        self.dirty = True
+
+    def Save(self, keep=None):
+        """Write the cache, if it changed. keep is the set of band names still in the
+        store; the others are dropped."""
+        if keep is not None:
+            for name in [n for n in self.hashes if n not in keep]:
+                del self.hashes[name]
+                self.dirty = True
+
+        if not self.dirty:
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.hashes, f)
+        os.replace(tmp, self.path)
+
+        self.dirty = False
+
+def HashStore(stores, names, workers=None):
+    """Hash the bands in names in each C_VaultStore of stores, all in one process
+    pool. Each store's band table must be loaded, and have all of names. Returns a
+    list with a dictionary of band name -> digest for each store, and the stats
+    dictionary (hashed, cached, bytes, seconds, missing). A band that isn't there
+    anymore is left out of its store's dictionary, and counted in missing."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    started = time.time()
+    stats = {'hashed': 0, 'cached': 0, 'bytes': 0, 'seconds': 0.0, 'missing': 0}
+
+    caches = []
+    results = []
+    work = []
+
+    for index, store in enumerate(stores):
+        cache = C_HashCache(store.getCacheFile('hashes')).Load()
+        caches.append(cache)
+        results.append({})
+
+        for name in names:
+            path = os.path.join(store.getBands(), name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stats['missing'] += 1
+                continue
+
+            digest = cache.Get(name, st)
+            if digest is not None:
+                results[index][name] = digest
+                stats['cached'] += 1
+            else:
+                work.append((index, name, st, path))
+
+    # Biggest first, so a big band doesn't end up running alone at the end
+    work.sort(key=lambda w: w[2].st_size, reverse=True)
+
+    if work:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                 mp_context=multiprocessing.get_context(method)) as pool:
+            for (index, name, st, path), (digest, size) in zip(work, pool.map(HashBand, [w[3] for w in work])):
+                if digest is None:
+                    stats['missing'] += 1
+                    continue
+                results[index][name] = digest
+                caches[index].Put(name, st, digest)
+                stats['hashed'] += 1
+                stats['bytes'] += size
+
+    for store, cache in zip(stores, caches):
+        cache.Save({entry.name for entry in store.getBandTable().Entries()})
+
+    stats['seconds'] = time.time() - started
+
+    return results, stats
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+"""
+This module implements the versioned remote layout. Instead of a mirror of the
+sparsebundle, the remote root holds a content addressed store, where each band is
+kept once, named by its hash, and each backup is a small manifest that says which
+blob every band of the vault was at that point:
+
+    ROOT/.evstore/blobs/ab/ab12...      one file per distinct band (or metadata file)
+    ROOT/.evstore/versions/VAULT/NAME.json
+
+A version manifest looks like this:
+
+    {"vault": "...", "name": "...", "created": "2026-...", "label": "backup",
+     "computer": "...",
+     "bands": {"1a": ["ab12...", 8388608, 1600000000000000000], ...},
+     "files": {"Info.plist": ["cd34...", 500, 1600000000000000000], ...}}
+
+A backup only writes the blobs that aren't there yet, so it costs the changed bands
+plus the manifest, and since every vault under the same root shares the blobs
+directory, vaults with bands in common (copies of a vault, say) share them too.
+Any version can be restored. Collect() deletes the blobs that no version of any
+vault points at anymore.
+
+Blobs are written with the usual temp file, fsync, rename, and the manifest is
+written last, so a backup that dies halfway leaves some extra blobs behind and no
+new version. Collect() leaves young blobs alone (see GC_GRACE), so it can't pull a
+blob out from under a backup that's still running.
+"""
+
+import os
+import json
+import time
+import threading
+from hashlib import blake2b
+
+from ev.bandsync import CopyFileData, FsyncDirectory, TempPath, DefaultMessageHandler
+
+STORE_DIR = '.evstore'
+
+DIGEST_SIZE = 32
+HASH_CHUNK = 1 << 20
+
+# Blobs younger than this (by mtime) are never collected. A backup touches each
+# blob it reuses, so a blob it's counting on can't age out while it runs.
+GC_GRACE = 24 * 60 * 60
+
+def HashFile(path, throttle=None):
+    """Returns the hex content hash of the file at path"""
+    h = blake2b(digest_size=DIGEST_SIZE)
+
+    with open(path, 'rb') as f:
+        while True:
+            if throttle is not None:
+                throttle(HASH_CHUNK)
+            data = f.read(HASH_CHUNK)
+            if not data:
+                break
+            h.update(data)
+
+    return h.hexdigest()
+
+class C_VersionStore:
+    """This object abstracts the content addressed store under one remote root.
+
+    root - The remote root (e.g. C_EVDefaults.RemotePath); the store is in a
+           .evstore directory under it
+    message - A function that is called with a string to print status messages
+    scheduler - A C_TransferScheduler (see ev.scheduler)
+    """
+    def __init__(self, root, message=DefaultMessageHandler, scheduler=None):
+        from ev.scheduler import C_TransferScheduler
+
+        self.path = os.path.join(os.path.expanduser(root), STORE_DIR)
+        self.blobs = os.path.join(self.path, 'blobs')
+        self.versions = os.path.join(self.path, 'versions')
+        self.msgout = message
+        self.scheduler = scheduler or C_TransferScheduler()
+        self.throttle = self.scheduler.Throttle if self.scheduler.Throttled() else None
+
+    def getPath(self):
+        return self.path
+
+    def BlobPath(self, digest):
+        return os.path.join(self.blobs, digest[:2], digest)
+
+    def VersionPath(self, vault, name):
+        return os.path.join(self.versions, vault, name + '.json')
+
+    def put_blob(self, path, digest):
+        """Store the file at path as blob digest, unless it's already there.
+        Returns the bytes written."""
+        blobpath = self.BlobPath(digest)
+
+        try:
+            st = os.stat(blobpath)
+        except FileNotFoundError:
+            pass
+        else:
+            # Already have it. Make sure Collect() doesn't think it's garbage.
+            if time.time() - st.st_mtime > GC_GRACE / 2:
+                os.utime(blobpath)
+            return 0
+
+        os.makedirs(os.path.dirname(blobpath), exist_ok=True)
+        tmppath = TempPath(blobpath)
+
+        try:
+            with open(path, 'rb') as fsrc, open(tmppath, 'wb') as fdst:
+                written = CopyFileData(fsrc, fdst, os.fstat(fsrc.fileno()).st_size, self.throttle)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+            os.chmod(tmppath, 0o600)
+            os.replace(tmppath, blobpath)
+        except BaseException:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+
+        return written
+
+    def Versions(self, vault):
+        """Returns the list of version names of vault, oldest first"""
+        try:
+            names = os.listdir(os.path.join(self.versions, vault))
+        except FileNotFoundError:
+            return []
+
+        # Names start with a timestamp, so they sort by age
+        return sorted(os.path.splitext(n)[0] for n in names
+                      if n.endswith('.json') and not n.startswith('.'))
+
+    def Load(self, vault, name=None):
+        """Returns the manifest dictionary of version name of vault (the latest one if
+        name is None or 'latest'), or None if there isn't one"""
+        if name in (None, 'latest'):
+            versions = self.Versions(vault)
+            if not versions:
+                return None
+            name = versions[-1]
+
+        try:
+            with open(self.VersionPath(vault, name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def BandTable(self, version):
+        """Returns a C_BandTable of the bands in a version manifest, so it can be
+        diffed against a store (see ev.bandtable). There are no inodes in a version."""
+        from ev.bandscan import BandEntry
+        from ev.bandtable import C_BandTable
+
+        bands = version['bands'] if version is not None else {}
+
+        return C_BandTable.FromEntries([BandEntry(name, size, mtime_ns, 0)
+                                        for name, (digest, size, mtime_ns) in bands.items()])
+
+    def Backup(self, store, vault, label='backup', computer=None):
+        """Add a version of the C_VaultStore store as vault. The store's band table
+        must be loaded. Bands whose size and mtime match the latest version aren't
+        read at all; their hash is taken from it. Returns (version, stats)."""
+        from concurrent.futures import ThreadPoolExecutor
+        import datetime
+
+        started = time.time()
+        stats = {'bands': 0, 'hashed': 0, 'blobs': 0, 'bytes': 0, 'seconds': 0.0}
+        lock = threading.Lock()
+
+        previous = self.Load(vault) or {'bands': {}, 'files': {}}
+
+        def entry(kind, name, path, size, mtime_ns):
+            old = previous[kind].get(name)
+            hashed = not (old is not None and (old[1], old[2]) == (size, mtime_ns)
+                          and os.path.isfile(self.BlobPath(old[0])))
+            digest = HashFile(path, self.throttle) if hashed else old[0]
+            written = self.put_blob(path, digest)
+
+            with lock:
+                stats['hashed'] += hashed
+                if written:
+                    stats['blobs'] += 1
+                    stats['bytes'] += written
+
+            return name, [digest, size, mtime_ns]
+
+        work = [('bands', e.name, os.path.join(store.getBands(), e.name), e.size, e.mtime_ns)
+                for e in store.getBandTable().Entries()]
+
+        with os.scandir(store.getBundlePath()) as it:
+            for e in it:
+                if e.is_file(follow_symlinks=False):
+                    st = e.stat(follow_symlinks=False)
+                    work.append(('files', e.name, e.path, st.st_size, st.st_mtime_ns))
+
+        version = {'vault': vault, 'label': label, 'computer': computer, 'bands': {}, 'files': {}}
+
+        with ThreadPoolExecutor(max_workers=self.scheduler.policy.workers,
+                                initializer=self.scheduler.WorkerInitializer()) as pool:
+            results = pool.map(lambda w: (w[0],) + entry(*w), work)
+
+            for kind, name, value in results:
+                version[kind][name] = value
+
+        stats['bands'] = len(version['bands'])
+
+        for directory in {os.path.dirname(self.BlobPath(v[0]))
+                          for kind in ('bands', 'files') for v in version[kind].values()}:
+            FsyncDirectory(directory)
+
+        created = datetime.datetime.now()
+        version['created'] = created.isoformat()
+        version['name'] = created.strftime('%Y%m%d-%H%M%S-%f') + '-' + label
+
+        # The manifest is what makes the version exist, so it goes last
+        path = self.VersionPath(vault, version['name'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = TempPath(path)
+        with open(tmppath, 'w', encoding='utf-8') as f:
+            json.dump(version, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, path)
+        FsyncDirectory(os.path.dirname(path))
+
+        stats['seconds'] = time.time() - started
+
+        return version, stats
+
+    def restore_file(self, digest, size, mtime_ns, dstpath):
+        """Write blob digest to dstpath (temp file, fsync, rename) with the mtime it
+        had when it was backed up. Returns the bytes copied."""
+        tmppath = TempPath(dstpath)
+
+        try:
+            with open(self.BlobPath(digest), 'rb') as fsrc, open(tmppath, 'wb') as fdst:
+                copied = CopyFileData(fsrc, fdst, size, self.throttle)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+            os.chmod(tmppath, 0o600)
+            os.utime(tmppath, ns=(mtime_ns, mtime_ns))
+            os.replace(tmppath, dstpath)
+        except BaseException:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+            raise
+
+        return copied
+
+    def Restore(self, version, store):
+        """Make the C_VaultStore store match a version manifest. Bands that already
+        match (size and mtime, same as a diff) are left alone, bands that aren't in the
+        version are deleted, and the metadata files are written last. It's safe to run
+        again if it gets interrupted. Returns the stats dictionary."""
+        from concurrent.futures import ThreadPoolExecutor
+        from ev.bandsync import SyncLists
+        from ev.bandtable import C_BandTable, DiffBandTables
+
+        started = time.time()
+        stats = {'copied': 0, 'deleted': 0, 'bytes': 0, 'metadata': 0, 'seconds': 0.0}
+
+        store.load_bundle_bands(False)
+        current = store.getBandTable() or C_BandTable.FromEntries([])
+
+        copy, delete = SyncLists(DiffBandTables(self.BandTable(version), current))
+        copy = self.scheduler.Order(copy)
+
+        os.makedirs(store.getBands(), exist_ok=True)
+
+        def restore_band(band):
+            digest, size, mtime_ns = version['bands'][band[0]]
+            return self.restore_file(digest, size, mtime_ns, os.path.join(store.getBands(), band[0]))
+
+        with ThreadPoolExecutor(max_workers=self.scheduler.policy.workers,
+                                initializer=self.scheduler.WorkerInitializer()) as pool:
+            for copied in pool.map(restore_band, copy):
+                stats['copied'] += 1
+                stats['bytes'] += copied
+
+        for name in delete:
+            try:
+                os.unlink(os.path.join(store.getBands(), name))
+            except FileNotFoundError:
+                pass
+            stats['deleted'] += 1
+
+        FsyncDirectory(store.getBands())
+
+        for name, (digest, size, mtime_ns) in version['files'].items():
+            stats['bytes'] += self.restore_file(digest, size, mtime_ns, os.path.join(store.getBundlePath(), name))
+            stats['metadata'] += 1
+
+        # Bundle files the version doesn't have are stale (the bands dir isn't a file)
+        with os.scandir(store.getBundlePath()) as it:
+            stale = [e.path for e in it if e.is_file(follow_symlinks=False) and e.name not in version['files']]
+
+        for path in stale:
+            self.msgout("removing %s, it isn't in version %s" % (path, version['name']))
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        FsyncDirectory(store.getBundlePath())
+
+        # The bands were replaced behind the manifest's back (new inodes, old mtimes)
+        store.getManifest().Invalidate()
+
+        stats['seconds'] = time.time() - started
+
+        return stats
+
+    def Prune(self, vault, keep):
+        """Delete all but the newest keep versions of vault. The blobs stay until
+        Collect() runs. Returns the names of the versions deleted."""
+        versions = self.Versions(vault)
+
+        deleted = []
+        for name in versions[:max(0, len(versions) - keep)]:
+            os.unlink(self.VersionPath(vault, name))
+            deleted.append(name)
+
+        return deleted
+
+    def Collect(self, grace=GC_GRACE):
+        """Delete the blobs that no version of any vault refers to, unless they're
+        younger than grace seconds. Returns (blobs deleted, bytes freed, blobs kept)."""
+        referenced = set()
+
+        if os.path.isdir(self.versions):
+            for vault in os.listdir(self.versions):
+                for name in self.Versions(vault):
+                    version = self.Load(vault, name)
+                    if version is None:
+                        # Can't tell what it needs, so don't delete anything
+                        raise OSError("version %s of %s can't be read, not collecting" % (name, vault))
+                    for kind in ('bands', 'files'):
+                        referenced.update(v[0] for v in version[kind].values())
+
+        deleted = freed = kept = 0
+        cutoff = time.time() - grace
+
+        if not os.path.isdir(self.blobs):
+            return deleted, freed, kept
+
+        for prefix in os.listdir(self.blobs):
+            directory = os.path.join(self.blobs, prefix)
+            with os.scandir(directory) as it:
+                for e in it:
+                    st = e.stat(follow_symlinks=False)
+                    if e.name in referenced or st.st_mtime > cutoff:
+                        kept += 1
+                        continue
+                    os.unlink(e.path)
+                    deleted += 1
+                    freed += st.st_blocks * 512
+
+        return deleted, freed, kept
+
+    def Usage(self):
+        """Returns (blobs, allocated bytes) of the whole store"""
+        count = allocated = 0
+
+        if os.path.isdir(self.blobs):
+            for prefix in os.listdir(self.blobs):
+                with os.scandir(os.path.join(self.blobs, prefix)) as it:
+                    for e in it:
+                        count += 1
+                        allocated += e.stat(follow_symlinks=False).st_blocks * 512
+
+        return count, allocated
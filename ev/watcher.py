@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+"""
+This module watches the LOCAL bands of a vault while it's mounted read/write, and
+keeps a journal of the bands that got written, so backup() can send exactly those
+bands without scanning Dropbox or diffing. LOCAL is still listed and stat'ed once,
+to make sure nothing wrote it while nobody was watching (see State()). The journal lives next to the vault's C_EVPlist
+state, and has one record per line:
+
+    base DEV INO MTIME_NS LOCAL LOCAL and Dropbox were the same after a backup or
+                                restore; the stat of the Dropbox bands, and the
+                                state of the LOCAL bands (see BandsState())
+    local STATE                 the state of the LOCAL bands, right before a
+                                watcher starts and right after it stops
+    start PID MODE              a watcher (inotify or poll) started, before attach
+    band NAME                   NAME was written, created or deleted
+    gap REASON                  the watcher may have missed something
+    stop                        the watcher stopped cleanly, after detach
+
+Each band is only recorded once per watch. The journal is good for a backup if it
+starts with a base, every start has its stop, there are no gaps, and the Dropbox
+bands directory still has the stat in the base (nobody else touched it).
+
+LOCAL can be attached without 'ev mount' too (Finder, hdiutil), and then nobody is
+watching. So the LOCAL state before each watch has to be what it was after the last
+one (or at the base), and what it is at backup time has to be what it was after the
+last watch. The state is a hash over every band's size and mtime (LOCAL's bands are
+rewritten in place, so the directory's stat says nothing), which costs a scan of
+LOCAL, but not of Dropbox, and no diff. Anything else and backup() does a full scan,
+same as without a watcher.
+
+The watcher is a separate process (python -m ev.watcher BANDS JOURNAL), so it
+outlives the 'ev mount' command. On Linux it uses inotify; anywhere else, or if
+inotify isn't there, it polls the bands every few seconds, and once more when it's
+told to stop, so writes that land during the detach aren't missed.
+"""
+
+import os
+import sys
+import time
+import signal
+
+MODE_INOTIFY = 'inotify'
+MODE_POLL = 'poll'
+
+# From sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+class C_DirtyJournal:
+    """This object abstracts the dirty band journal of one vault.
+
+    path - The journal file
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, line, sync=False):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def Base(self, dirstat, local):
+        """Start over: LOCAL and Dropbox are the same right now, dirstat is the stat
+        of the Dropbox bands directory, and local is the state of the LOCAL bands"""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write('base %d %d %d %s\n' % (dirstat.st_dev, dirstat.st_ino, dirstat.st_mtime_ns, local or '-'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def Local(self, local):
+        """Record the state of the LOCAL bands (None if it couldn't be had)"""
+        if os.path.exists(self.path):
+            self.append('local %s' % (local or '-'), sync=True)
+
+    def Discard(self):
+        """Forget the journal, because LOCAL changed in a way it didn't see"""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def Records(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.read().split('\n')
+        except FileNotFoundError:
+            return []
+
+        # The last line is either empty or torn
+        return [line.split(' ') for line in lines[:-1]]
+
+    def Watcher(self):
+        """Returns the pid of the watcher that's running, going by the journal, or None"""
+        pid = None
+
+        for record in self.Records():
+            if record[0] == 'start':
+                pid = int(record[1])
+            elif record[0] == 'stop':
+                pid = None
+
+        return pid
+
+    def State(self, dirstat, local):
+        """Returns (names, reason): the set of band names written since the base, or
+        None and the reason the journal can't be trusted. dirstat is the current stat
+        of the Dropbox bands directory, and local the current state of the LOCAL bands."""
+        records = self.Records()
+
+        if not records or records[0][0] != 'base' or len(records[0]) < 5:
+            return None, "there's no base to start from"
+
+        if tuple(int(v) for v in records[0][1:4]) != (dirstat.st_dev, dirstat.st_ino, dirstat.st_mtime_ns):
+            return None, "Dropbox changed since the last backup or restore"
+
+        names = set()
+        watching = False
+        expect = records[0][4]      # what LOCAL should look like when nobody is watching
+        previous = records[0]
+
+        for record in records[1:]:
+            if record[0] == 'local':
+                if previous[0] == 'stop':
+                    expect = record[1]
+                elif record[1] != expect or expect == '-':
+                    return None, "LOCAL was changed while nobody was watching"
+            elif previous[0] == 'stop':
+                return None, "LOCAL wasn't checked after it was detached"
+
+            if record[0] == 'start':
+                if watching:
+                    return None, "a watcher never stopped"
+                if previous[0] != 'local':
+                    return None, "LOCAL wasn't checked before it was attached"
+                watching = True
+            elif record[0] == 'stop':
+                watching = False
+            elif record[0] == 'band':
+                names.add(record[1])
+            elif record[0] == 'gap':
+                return None, "the watcher missed something (%s)" % ' '.join(record[1:])
+
+            previous = record
+
+        if watching:
+            return None, "the watcher is still running, or died"
+
+        if previous[0] == 'stop':
+            return None, "LOCAL wasn't checked after it was detached"
+
+        if local is None or local != expect:
+            return None, "LOCAL was changed while nobody was watching"
+
+        return names, None
+
+def _inotify():
+    """Returns the libc functions for inotify, or None"""
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+class C_BandWatcher:
+    """Watches one bands directory and records what changes in a C_DirtyJournal.
+
+    bands - The bands directory
+    journal - The C_DirtyJournal
+    interval - Seconds between scans, when polling
+    """
+    def __init__(self, bands, journal, interval=5):
+        self.bands = bands
+        self.journal = journal
+        self.interval = interval
+        self.seen = set()
+        self.stopping = False
+
+    def dirty(self, name):
+        if name not in self.seen and not name.startswith('.'):
+            self.seen.add(name)
+            self.journal.append('band %s' % name)
+
+    def snapshot(self):
+        state = {}
+        with os.scandir(self.bands) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                state[entry.name] = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+        return state
+
+    def poll(self, before):
+        after = self.snapshot()
+        for name in set(before) | set(after):
+            if before.get(name) != after.get(name):
+                self.dirty(name)
+        return after
+
+    def run_poll(self):
+        state = self.snapshot()
+        self.journal.append('start %d %s' % (os.getpid(), MODE_POLL), sync=True)
+
+        while not self.stopping:
+            time.sleep(self.interval)
+            state = self.poll(state)
+
+        self.poll(state)
+
+    def run_inotify(self, functions):
+        import select
+        import struct
+
+        init, add_watch = functions
+
+        fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0 or add_watch(fd, os.fsencode(self.bands), WATCH_MASK) < 0:
+            if fd >= 0:
+                os.close(fd)
+            return self.run_poll()
+
+        event = struct.Struct('iIII')
+
+        def drain():
+            try:
+                buf = os.read(fd, 65536)
+            except BlockingIOError:
+                return False
+
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = event.unpack_from(buf, offset)
+                name = buf[offset + event.size:offset + event.size + length].rstrip(b'\0')
+                offset += event.size + length
+
+                if mask & IN_Q_OVERFLOW:
+                    self.journal.append('gap overflow', sync=True)
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    self.journal.append('gap bands-directory-went-away', sync=True)
+                    self.stopping = True
+                elif name:
+                    self.dirty(os.fsdecode(name))
+
+            return True
+
+        self.journal.append('start %d %s' % (os.getpid(), MODE_INOTIFY), sync=True)
+
+        try:
+            while not self.stopping:
+                ready, _, _ = select.select([fd], [], [], 1.0)
+                if ready:
+                    drain()
+
+            while drain():
+                pass
+        finally:
+            os.close(fd)
+
+    def Run(self):
+        """Watch until SIGTERM or SIGINT, then write the stop record"""
+        def stop(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        functions = _inotify()
+        if functions is not None:
+            self.run_inotify(functions)
+        else:
+            self.run_poll()
+
+        self.journal.append('stop', sync=True)
+
+def StartWatcher(bands, journal, interval=5, timeout=10):
+    """Start a watcher process for bands, and wait until it's watching. Returns its
+    pid, or None if it didn't come up in timeout seconds (then it's stopped, and the
+    journal gets a gap)."""
+    import subprocess
+
+    process = subprocess.Popen([sys.executable, '-m', 'ev.watcher', bands, journal.path, str(interval)],
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, start_new_session=True)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if journal.Watcher() == process.pid:
+            return process.pid
+        if process.poll() is not None:
+            return None
+        time.sleep(0.05)
+
+    # Make sure it's gone, so it can't start watching (and write a start record)
+    # after we've given up on it, and reap it so it doesn't hang around as a zombie
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+    journal.append('gap watcher-failed-to-start', sync=True)
+    return None
+
+def StopWatcher(journal, timeout=30):
+    """Tell the watcher to stop, and wait until it's written its stop record.
+    Returns True if it stopped cleanly."""
+    pid = journal.Watcher()
+    if pid is None:
+        return True
+
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        journal.append('gap watcher-died', sync=True)
+        return False
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if journal.Watcher() is None:
+            return True
+        time.sleep(0.1)
+
+    journal.append('gap watcher-hung', sync=True)
+    return False
+
+if __name__ == "__main__":
+    C_BandWatcher(sys.argv[1], C_DirtyJournal(sys.argv[2]),
+                  int(sys.argv[3]) if len(sys.argv) > 3 else 5).Run()